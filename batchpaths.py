@@ -0,0 +1,229 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+
+
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy
+
+import pathfinder
+
+import logger
+debug = logger.Log()
+
+
+class SharedCosts(object):
+    """Costs of moves in shared memory, with the same width, height, data and grid as a
+    pathfinder.CostGrid so they can be searched by AStar"""
+    def __init__(self, data, width, height):
+        self.width = width
+        self.height = height
+        self.data = data
+        self.grid = numpy.frombuffer(data, dtype=numpy.int32).reshape(height, width, 8)
+
+
+class SharedMap(pathfinder.MapGrid):
+    """Blocked tiles in shared memory, read in place as a pathfinder.MapGrid's blocked
+    array (MapGrid() would copy them). Only for searching, the tiles are never changed"""
+    def __init__(self, data, width, height):
+        self.width = width
+        self.height = height
+        self.blocked = numpy.frombuffer(data, dtype=numpy.bool_).reshape(height, width)
+
+
+class Worker(object):
+    """Search state of a worker process, set up once by init_worker() when the process starts
+    Reference with Worker.var"""
+    astar = None
+
+def init_worker(kind, shared, width, height, jump):
+    """Make the search used by this process over the grid in shared memory
+    kind is "costs" for a copy of a CostGrid's costs, or "map" for a MapGrid's blocked tiles
+    Costs are searched where they are, AStar keeps its own bytearray of blocked tiles (one
+    byte a tile) to search, which for a map is the one copy each process makes"""
+    if kind == "costs":
+        Worker.astar = pathfinder.AStar(costs=SharedCosts(shared, width, height), jump=jump)
+    else:
+        Worker.astar = pathfinder.AStar(SharedMap(shared, width, height), jump=jump)
+
+def find_chunk(chunk):
+    """Search for the routes for a chunk of queries, sorted by start so searches from the
+    same start carry on from one another
+    chunk is (query numbers, start tiles, target tiles) as arrays of tile numbers
+    Returns (query numbers, costs, nodes expanded, path lengths, tiles of all the paths)"""
+    numbers, starts, targets = chunk
+    astar = Worker.astar
+    width = astar.width
+    count = len(numbers)
+    costs = numpy.empty(count, dtype=numpy.int32)
+    expanded = numpy.empty(count, dtype=numpy.int32)
+    lengths = numpy.empty(count, dtype=numpy.int32)
+    tiles = []
+    for i in range(count):
+        s = int(starts[i])
+        t = int(targets[i])
+        # A new search starts its count again, so count each query from nothing
+        astar.expanded = 0
+        path = astar.find_path((s % width, s // width), (t % width, t // width))
+        expanded[i] = astar.expanded
+        if path is None:
+            costs[i] = -1
+            lengths[i] = 0
+        else:
+            costs[i] = astar.g[t]
+            lengths[i] = len(path)
+            tiles.extend([y*width + x for x, y in path])
+    return (numbers, costs, expanded, lengths, numpy.array(tiles, dtype=numpy.int32))
+
+def wait_for(answers, wait):
+    """Yields the answers from a pool's imap_unordered() as they arrive, waiting at most wait
+    seconds at a time, as waiting without a time limit can't be interrupted by signals (so an
+    alarm wouldn't go off until the next answer came in)"""
+    while True:
+        try:
+            answer = answers.next(wait)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+        yield answer
+
+
+class BatchResult(object):
+    """Routes found for a batch of queries, kept in a few flat arrays
+    costs[i] is the cost of the route for query i, or -1 if there's no route
+    expanded[i] is the number of nodes expanded answering it
+    The tiles of the route for query i are tiles[offsets[i]:offsets[i+1]], as tile numbers
+    (y * width + x) from the target back to the start, as returned by AStar.find_path()"""
+    def __init__(self, width, count):
+        self.width = width
+        self.costs = numpy.empty(count, dtype=numpy.int32)
+        self.expanded = numpy.empty(count, dtype=numpy.int32)
+        self.offsets = numpy.zeros(count + 1, dtype=numpy.int64)
+        self.tiles = numpy.empty(0, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.costs)
+
+    def get_path(self, i):
+        """Returns the route for query i as a list of (x, y), or None if there's no route"""
+        if self.costs[i] < 0:
+            return None
+        width = self.width
+        return [(int(n) % width, int(n) // width) for n in self.tiles[self.offsets[i]:self.offsets[i+1]]]
+
+
+class BatchPathfinder(object):
+    """Finds routes for many (start, target) queries at once, spread across a pool of processes
+    The grid is copied once into shared memory, which every process reads from, so later
+    changes to the grid aren't seen, make a new BatchPathfinder to pick them up. Costs are
+    searched in shared memory, for a MapGrid each process also copies the blocked tiles into
+    the bytearray AStar searches (see init_worker())
+    grid is a pathfinder.CostGrid or pathfinder.MapGrid
+    Can be used in a with statement, which stops the processes at the end of it"""
+    # Number of queries given to a process at a time
+    chunk_size = 32
+    # Longest time spent waiting for the processes without checking for signals, in seconds
+    wait_time = 0.1
+
+    def __init__(self, grid, processes=None, jump=False):
+        """Copy the grid into shared memory and start the processes
+        processes defaults to the number of CPUs, with 0 queries are answered in this process
+        jump uses jump point search where the grid allows it (see AStar)"""
+        self.width = grid.width
+        self.height = grid.height
+        size = self.width * self.height
+        if isinstance(grid, pathfinder.MapGrid):
+            kind = "map"
+            self.shared = multiprocessing.sharedctypes.RawArray(ctypes.c_ubyte, size)
+            numpy.frombuffer(self.shared, dtype=numpy.bool_)[:] = grid.blocked.ravel()
+        else:
+            kind = "costs"
+            # Bring the costs up to date with any changes to the World before copying them
+            grid.refresh()
+            self.shared = multiprocessing.sharedctypes.RawArray(ctypes.c_int, size * 8)
+            numpy.frombuffer(self.shared, dtype=numpy.int32)[:] = grid.get_costs(0, 0, self.width, self.height).ravel()
+        args = (kind, self.shared, self.width, self.height, jump)
+        if processes == 0:
+            init_worker(*args)
+            self.pool = None
+        else:
+            self.pool = multiprocessing.Pool(processes, init_worker, args)
+
+    def find_paths(self, queries):
+        """Find the routes for a list of queries, each ((start x, start y), (target x, target y)),
+        or an array of shape (n, 4) of start x, start y, target x, target y
+        Returns a BatchResult"""
+        queries = numpy.array(queries, dtype=numpy.int64).reshape(-1, 4)
+        count = len(queries)
+        starts = queries[:,1] * self.width + queries[:,0]
+        targets = queries[:,3] * self.width + queries[:,2]
+        # Queries from the same start go to the same process one after another
+        order = numpy.argsort(starts, kind="mergesort")
+        chunks = []
+        for i in range(0, count, self.chunk_size):
+            numbers = order[i:i + self.chunk_size]
+            chunks.append((numbers, starts[numbers], targets[numbers]))
+        if self.pool is None:
+            answers = map(find_chunk, chunks)
+        else:
+            answers = wait_for(self.pool.imap_unordered(find_chunk, chunks), self.wait_time)
+        result = BatchResult(self.width, count)
+        lengths = numpy.zeros(count, dtype=numpy.int64)
+        parts = []
+        for numbers, costs, expanded, chunk_lengths, tiles in answers:
+            result.costs[numbers] = costs
+            result.expanded[numbers] = expanded
+            lengths[numbers] = chunk_lengths
+            parts.append((numbers, chunk_lengths, tiles))
+        # Put the tiles of every path in query order
+        numpy.cumsum(lengths, out=result.offsets[1:])
+        result.tiles = numpy.empty(result.offsets[-1], dtype=numpy.int32)
+        for numbers, chunk_lengths, tiles in parts:
+            start = 0
+            for n, length in zip(numbers, chunk_lengths):
+                result.tiles[result.offsets[n]:result.offsets[n] + length] = tiles[start:start + length]
+                start += length
+        debug("Batch of %s queries answered, %s routes found" % (count, (result.costs >= 0).sum()))
+        return result
+
+    def close(self):
+        """Stop the processes"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        """Stop the processes straight away, without waiting for the queries they're working on"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,477 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+import os, sys
+
+
+
+import time
+import json
+import array
+import signal
+import optparse
+import numpy
+
+import pathfinder
+import hpastar
+import flowfield
+import routecache
+import batchpaths
+
+import logger
+debug = logger.Log()
+
+
+# Written as the first line of every results file
+FILE_VERSION = "pytile-benchmark 1"
+
+# Map families, each is (name, function which makes the grid, arguments for it)
+# Every family makes the same maps for the same size and seed
+families = [
+    ("open", "make_random", [0.0]),
+    ("random10", "make_random", [0.1]),
+    ("random20", "make_random", [0.2]),
+    ("random30", "make_random", [0.3]),
+    ("maze", "make_maze", []),
+    ("terrain", "make_terrain", []),
+    ]
+
+# Pathfinders benchmarked, the first which answers every query is the reference others are
+# compared with, so exact searches come first
+variants = ["astar", "bidirectional", "jps", "flowfield", "routecache", "batch", "hpastar"]
+exact = ["astar", "bidirectional", "jps", "flowfield", "batch"]
+
+default_sizes = [64, 256, 1024, 4096]
+
+
+class TerrainGrid(pathfinder.CostGrid):
+    """Costs worked out in the same way as CostGrid, but from an array of vertex heights
+    rather than the World, so terrain of any size can be made up for benchmarking"""
+    # Columns of tiles worked out at a time, to keep the size of temporary arrays down
+    strip = 256
+
+    def __init__(self, v):
+        """v is an array of shape (width, height, 4) of vertex heights (see World.get_vertex_heights())"""
+        self.width, self.height = v.shape[:2]
+        self.data = array.array("i", [-1]) * (self.width * self.height * 8)
+        self.grid = numpy.frombuffer(self.data, dtype=numpy.int32).reshape(self.height, self.width, 8)
+        self.changed = set()
+        for x0 in range(0, self.width, self.strip):
+            x1 = min(x0 + self.strip, self.width)
+            # With a border of one column each side, for the moves out of the strip
+            bx0 = max(x0 - 1, 0)
+            costs = self.find_costs(v[bx0:min(x1 + 1, self.width)])
+            self.grid[:,x0:x1] = costs[x0-bx0:x1-bx0].transpose(1,0,2)
+
+    def watch(self):
+        """The terrain never changes"""
+        return set()
+
+
+def make_random(size, rng, density):
+    """Open field with a proportion (density) of tiles blocked at random"""
+    return pathfinder.MapGrid(rng.rand(size, size) < density)
+
+def make_maze(size, rng):
+    """Maze of corridors one tile wide with walls between, exactly one route between any two
+    tiles of corridor, made by a depth first search which carves out passages as it goes"""
+    cells = (size - 1) / 2
+    blocked = numpy.ones((size, size), dtype=numpy.bool_)
+    seen = bytearray(cells * cells)
+    # Random numbers are drawn a block at a time
+    choices = rng.randint(0, 12, size=cells * cells * 2).tolist()
+    c = 0
+    stack = [0]
+    seen[0] = 1
+    blocked[1,1] = False
+    while stack:
+        n = stack[-1]
+        x = n % cells
+        y = n / cells
+        options = []
+        if x > 0 and not seen[n - 1]:
+            options.append(n - 1)
+        if x < cells - 1 and not seen[n + 1]:
+            options.append(n + 1)
+        if y > 0 and not seen[n - cells]:
+            options.append(n - cells)
+        if y < cells - 1 and not seen[n + cells]:
+            options.append(n + cells)
+        if not options:
+            stack.pop()
+            continue
+        if c == len(choices):
+            choices = rng.randint(0, 12, size=cells * cells).tolist()
+            c = 0
+        m = options[choices[c] % len(options)]
+        c += 1
+        seen[m] = 1
+        stack.append(m)
+        mx = m % cells
+        my = m / cells
+        # Open the cell and the wall between the two cells
+        blocked[2*my + 1, 2*mx + 1] = False
+        blocked[y + my + 1, x + mx + 1] = False
+    return pathfinder.MapGrid(blocked)
+
+def make_terrain(size, rng, levels=16, octaves=5, persistence=0.5):
+    """Hilly terrain from value noise, made in the same way as noise.Perlin2D (random heights
+    on coarse grids smoothly interpolated and added together, each octave twice as fine as
+    the last and persistence times as strong) but a whole array at a time
+    Costs come from the heights as in the game, tiles too steep to cross are blocked"""
+    n = size + 1
+    heights = numpy.zeros((n, n))
+    strength = 1.0
+    total = 0.0
+    step = max(size / 4, 2)
+    for o in range(octaves):
+        if step < 1:
+            break
+        points = n / step + 2
+        coarse = rng.rand(points, points)
+        # Interpolate the coarse grid at each vertex, with smoothstep easing
+        i = numpy.arange(n) / float(step)
+        i0 = i.astype(numpy.int64)
+        f = i - i0
+        f = f * f * (3 - 2 * f)
+        rows = coarse[i0] * (1 - f)[:,numpy.newaxis] + coarse[i0 + 1] * f[:,numpy.newaxis]
+        heights += (rows[:,i0] * (1 - f) + rows[:,i0 + 1] * f) * strength
+        total += strength
+        strength *= persistence
+        step /= 2
+    heights = (heights / total * levels).astype(numpy.int32)
+    # Vertices of tile (x, y) are left (x+1,y), bottom (x+1,y+1), right (x,y+1), top (x,y),
+    # heights is indexed [y][x] so turn it round to [x][y] first
+    h = heights.T
+    v = numpy.empty((size, size, 4), dtype=numpy.int32)
+    v[:,:,0] = h[1:,:-1]
+    v[:,:,1] = h[1:,1:]
+    v[:,:,2] = h[:-1,1:]
+    v[:,:,3] = h[:-1,:-1]
+    return TerrainGrid(v)
+
+def make_map(family, size, seed):
+    """Make the grid for a map family at a size"""
+    for name, function, args in families:
+        if name == family:
+            rng = numpy.random.RandomState([seed, size, families.index((name, function, args))])
+            return globals()[function](size, rng, *args)
+    raise ValueError("Unknown map family: %s" % family)
+
+def get_open_tiles(grid):
+    """Returns the tile numbers of the tiles which can be moved out of"""
+    if isinstance(grid, pathfinder.MapGrid):
+        return numpy.flatnonzero(~grid.blocked)
+    return numpy.flatnonzero((grid.grid >= 0).any(axis=2))
+
+def make_queries(grid, count, seed):
+    """Pick count (start, target) pairs of open tiles at random"""
+    tiles = get_open_tiles(grid)
+    rng = numpy.random.RandomState([seed, grid.width])
+    picks = tiles[rng.randint(0, len(tiles), size=(count, 2))]
+    w = grid.width
+    return [((int(s) % w, int(s) / w), (int(t) % w, int(t) / w)) for s, t in picks]
+
+def path_cost(grid, path):
+    """Cost of a path as returned by AStar.find_path(), from the grid's costs"""
+    moves = [(dx, dy) for dx, dy, c in pathfinder.AStar.moves]
+    cost = 0
+    for i in range(len(path) - 1, 0, -1):
+        x, y = path[i]
+        nx, ny = path[i - 1]
+        cost += int(grid.get_costs(x, y, x + 1, y + 1)[0,0,moves.index((nx - x, ny - y))])
+    return cost
+
+
+class Timeout(Exception):
+    """Raised when a variant runs out of time"""
+    pass
+
+def make_astar(grid, **options):
+    """AStar over a MapGrid or a CostGrid"""
+    if isinstance(grid, pathfinder.MapGrid):
+        return pathfinder.AStar(grid, **options)
+    return pathfinder.AStar(costs=grid, **options)
+
+def run_variant(variant, grid, queries, result):
+    """Answer the queries with one pathfinder, filling in result as it goes so that what has
+    been done is kept if it runs out of time
+    result gets "build" (seconds of setting up before the first query) and lists "times"
+    (seconds), "costs" (-1 for no route) and "expanded", one entry for each query answered"""
+    times = result["times"]
+    costs = result["costs"]
+    expanded = result["expanded"]
+    w = grid.width
+    t0 = time.time()
+    if variant in ["astar", "bidirectional", "jps"]:
+        astar = make_astar(grid, jump=variant == "jps", bidirectional=variant == "bidirectional")
+        if variant == "jps" and not astar.jump:
+            result["notes"] = "costs vary, searched with A*"
+        result["build"] = time.time() - t0
+        for s, t in queries:
+            # Searches with a new start count from nothing anyway
+            astar.expanded = 0
+            t0 = time.time()
+            path = astar.find_path(s, t)
+            times.append(time.time() - t0)
+            costs.append(path is None and -1 or astar.g[t[1]*w + t[0]])
+            expanded.append(astar.expanded)
+    elif variant == "hpastar":
+        h = hpastar.HPAStar(grid)
+        result["build"] = time.time() - t0
+        result["notes"] = "expanded counts abstract nodes"
+        for s, t in queries:
+            t0 = time.time()
+            path = h.find_path(s, t)
+            times.append(time.time() - t0)
+            costs.append(path is None and -1 or h.cost)
+            expanded.append(h.expanded)
+    elif variant == "flowfield":
+        result["build"] = 0.0
+        result["notes"] = "a field for each query's target, expanded counts tiles reached"
+        for s, t in queries:
+            t0 = time.time()
+            field = flowfield.FlowField(grid, t)
+            cost = field.get_cost(s)
+            times.append(time.time() - t0)
+            costs.append(cost)
+            expanded.append(int((field.dist >= 0).sum()))
+    elif variant == "routecache":
+        # The first pass fills the cache and counts as the build, the times are of asking again
+        astar = make_astar(grid)
+        cache = routecache.RouteCache(grid)
+        for s, t in queries:
+            cache.find_path(s, t, astar.find_path)
+        result["build"] = time.time() - t0
+        result["notes"] = "build is the first pass, times are the same queries again"
+        for s, t in queries:
+            astar.expanded = 0
+            t0 = time.time()
+            path = cache.find_path(s, t, astar.find_path)
+            times.append(time.time() - t0)
+            costs.append(path is None and -1 or path_cost(grid, path))
+            expanded.append(astar.expanded)
+    elif variant == "batch":
+        batch = batchpaths.BatchPathfinder(grid)
+        result["build"] = time.time() - t0
+        result["notes"] = "one batch, times are the batch time shared between the queries, peak excludes workers"
+        try:
+            t0 = time.time()
+            answers = batch.find_paths(queries)
+            t = (time.time() - t0) / max(len(queries), 1)
+        except:
+            # On a Timeout the workers are still busy, close() would wait for them to finish
+            batch.terminate()
+            raise
+        batch.close()
+        times.extend([t] * len(queries))
+        costs.extend(answers.costs.tolist())
+        expanded.extend(answers.expanded.tolist())
+    else:
+        raise ValueError("Unknown pathfinder variant: %s" % variant)
+
+def get_rss():
+    """Resident memory of this process, in kilobytes"""
+    f = open("/proc/self/statm")
+    pages = int(f.read().split()[1])
+    f.close()
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024
+
+def on_alarm(signum, frame):
+    raise Timeout()
+
+def measure(variant, grid, queries, limit):
+    """Run a variant in a child process, so its peak memory can be measured on its own and
+    it can be stopped if it takes longer than limit seconds
+    Returns the result from run_variant() with "peak_kb" (peak memory above what the
+    process started with) and "timeout" added"""
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        result = {"times": [], "costs": [], "expanded": [], "build": None, "notes": "", "timeout": False}
+        try:
+            result["start_kb"] = get_rss()
+            signal.signal(signal.SIGALRM, on_alarm)
+            if limit:
+                signal.alarm(int(limit))
+            try:
+                run_variant(variant, grid, queries, result)
+            except Timeout:
+                result["timeout"] = True
+            signal.alarm(0)
+            data = json.dumps(result)
+        except Exception, e:
+            data = json.dumps({"error": "%s: %s" % (e.__class__.__name__, e)})
+        f = os.fdopen(writer, "w")
+        f.write(data)
+        f.close()
+        os._exit(0)
+    os.close(writer)
+    f = os.fdopen(reader, "r")
+    data = f.read()
+    f.close()
+    pid, status, usage = os.wait4(pid, 0)
+    if not data:
+        return {"error": "process ended with status %s" % status}
+    result = json.loads(data)
+    if result.has_key("start_kb"):
+        # ru_maxrss is in kilobytes on Linux
+        result["peak_kb"] = max(usage.ru_maxrss - result.pop("start_kb"), 0)
+    return result
+
+
+def summarise(result, reference):
+    """Work out the statistics written for one variant, compared with the reference's costs"""
+    times = sorted(result["times"])
+    n = len(times)
+    line = {"answered": n,
+            "timeout": result["timeout"],
+            "build_s": round(result["build"], 4) if result["build"] is not None else None,
+            "peak_kb": result.get("peak_kb"),
+            "notes": result["notes"],
+            }
+    if n:
+        line["found"] = len([c for c in result["costs"] if c >= 0])
+        line["total_s"] = round(sum(times), 4)
+        line["query_mean_ms"] = round(sum(times) / n * 1000, 3)
+        line["query_median_ms"] = round(times[n / 2] * 1000, 3)
+        line["query_max_ms"] = round(times[-1] * 1000, 3)
+        line["expanded_mean"] = round(float(sum(result["expanded"])) / n, 1)
+    if reference is not None and n:
+        ratios = []
+        mismatches = 0
+        for c, r in zip(result["costs"], reference):
+            if (c < 0) != (r < 0):
+                mismatches += 1
+            elif r > 0:
+                ratios.append(float(c) / r)
+        line["reachability_mismatches"] = mismatches
+        if ratios:
+            line["optimality_mean"] = round(sum(ratios) / len(ratios), 4)
+            line["optimality_max"] = round(max(ratios), 4)
+    return line
+
+def run(sizes, family_names, variant_names, count, seed, limit, filename, label):
+    """Benchmark every variant on every map family at every size, write the results to
+    filename and print a summary line for each as it's finished"""
+    f = open(filename, "w")
+    f.write(FILE_VERSION + "\n")
+    f.write(json.dumps({"label": label, "seed": seed, "queries": count, "limit": limit,
+                        "python": sys.version.split()[0], "numpy": numpy.__version__,
+                        "date": time.strftime("%Y-%m-%d %H:%M:%S")}) + "\n")
+    f.flush()
+    print "%-9s %5s %-13s %9s %9s %10s %9s %8s %s" % ("family", "size", "variant", "build_s",
+                                                       "mean_ms", "expanded", "peak_kb", "optimal", "notes")
+    for size in sizes:
+        for family in family_names:
+            t0 = time.time()
+            grid = make_map(family, size, seed)
+            queries = make_queries(grid, count, seed)
+            debug("Made %s map of size %s in %.2f s" % (family, size, time.time() - t0))
+            reference = None
+            reference_name = None
+            for variant in variant_names:
+                result = measure(variant, grid, queries, limit)
+                if result.has_key("error"):
+                    line = {"error": result["error"]}
+                else:
+                    line = summarise(result, reference)
+                    if reference is None and variant in exact and not result["timeout"]:
+                        reference = result["costs"]
+                        reference_name = variant
+                line.update({"family": family, "size": size, "variant": variant,
+                             "reference": reference_name})
+                f.write(json.dumps(line, sort_keys=True) + "\n")
+                f.flush()
+                print "%-9s %5s %-13s %9s %9s %10s %9s %8s %s" % (family, size, variant,
+                    line.get("build_s"), line.get("query_mean_ms"), line.get("expanded_mean"),
+                    line.get("peak_kb"), line.get("optimality_mean"),
+                    line.get("error") or (line["timeout"] and "TIMED OUT " or "") + line["notes"])
+                sys.stdout.flush()
+    f.close()
+
+def load(filename):
+    """Read a results file, returns (run information, dict of results keyed by (family, size, variant))"""
+    f = open(filename, "r")
+    if f.readline().strip() != FILE_VERSION:
+        raise ValueError("%s is not a pyTile benchmark results file" % filename)
+    info = json.loads(f.readline())
+    results = {}
+    for line in f:
+        if line.strip():
+            r = json.loads(line)
+            results[(r["family"], r["size"], r["variant"])] = r
+    f.close()
+    return info, results
+
+def compare(old_filename, new_filename):
+    """Print how each result in new_filename compares with the same one in old_filename,
+    as ratios of new to old (below 1 is better)"""
+    old_info, old = load(old_filename)
+    new_info, new = load(new_filename)
+    print "Comparing %s (%s) with %s (%s)" % (new_filename, new_info["label"], old_filename, old_info["label"])
+    print "%-9s %5s %-13s %9s %9s %9s %9s %9s" % ("family", "size", "variant", "build", "mean",
+                                                   "expanded", "peak", "optimal")
+    for key in sorted(new.keys()):
+        if not old.has_key(key):
+            continue
+        ratios = []
+        for field in ["build_s", "query_mean_ms", "expanded_mean", "peak_kb", "optimality_mean"]:
+            a = old[key].get(field)
+            b = new[key].get(field)
+            if a and b is not None:
+                ratios.append("%.3f" % (float(b) / a))
+            else:
+                ratios.append("-")
+        print "%-9s %5s %-13s %9s %9s %9s %9s %9s" % (key + tuple(ratios))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options]\n       %prog --compare OLD NEW")
+    parser.add_option("--sizes", dest="sizes", default=",".join([str(s) for s in default_sizes]),
+                      help="comma separated map sizes [default: %default]")
+    parser.add_option("--families", dest="families", default=",".join([f[0] for f in families]),
+                      help="comma separated map families [default: %default]")
+    parser.add_option("--variants", dest="variants", default=",".join(variants),
+                      help="comma separated pathfinders [default: %default]")
+    parser.add_option("--queries", dest="queries", type="int", default=20,
+                      help="queries on each map [default: %default]")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="seed for making maps and queries [default: %default]")
+    parser.add_option("--limit", dest="limit", type="int", default=300,
+                      help="seconds each pathfinder gets on each map, 0 for no limit [default: %default]")
+    parser.add_option("--output", dest="output", default="benchmark.jsonl", metavar="FILE",
+                      help="file to write the results to [default: %default]")
+    parser.add_option("--label", dest="label", default="",
+                      help="name for this run, e.g. the version being benchmarked")
+    parser.add_option("--compare", dest="compare", action="store_true", default=False,
+                      help="compare two results files instead of running the benchmark")
+    options, args = parser.parse_args()
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two results files")
+        compare(args[0], args[1])
+    else:
+        run([int(s) for s in options.sizes.split(",")], options.families.split(","),
+            options.variants.split(","), options.queries, options.seed, options.limit,
+            options.output, options.label)
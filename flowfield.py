@@ -0,0 +1,210 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+
+
+import array
+import collections
+import heapq
+import numpy
+
+import pathfinder
+
+import logger
+debug = logger.Log()
+
+# Cost used for tiles which can't be reached
+INF = 1 << 29
+
+class FlowField(object):
+    """Cost of the best route from every tile of a grid to one target, and the move to make
+    from each tile to follow it, so any number of agents can head for the target by looking
+    up the tile they're on
+    Worked out by Dijkstra's algorithm run backwards from the target, a band of tiles at a
+    time rather than one tile at a time: every tile whose cost is less than the lowest cost
+    not yet settled plus the cheapest move can't get any cheaper, so all of them are settled
+    together and the moves into them relaxed with array operations
+    Where only a few tiles are being reached at a time (corridors, mazes) they're settled
+    one at a time instead, which is quicker than array operations on a handful of tiles"""
+    # Frontiers with fewer tiles than narrow are settled one tile at a time, until they
+    # have grown to wide tiles
+    narrow = 64
+    wide = 512
+
+    def __init__(self, grid, target, costs=None):
+        """Work out the field for target (x, y) over grid (pathfinder.CostGrid or MapGrid)
+        costs is the grid's costs from get_costs() if they've already been fetched"""
+        self.target = target
+        self.width = w = grid.width
+        self.height = h = grid.height
+        if costs is None:
+            costs = grid.get_costs(0, 0, w, h)
+        # Costs of moves out of each tile with a border of one tile all round, so moves
+        # never wrap from one row to the next, tiles are numbered (y + 1) * (w + 2) + x + 1
+        # Arrays are kept in array.arrays and bytearrays for looking at one tile at a time,
+        # with NumPy views of the same memory for working on many tiles at once
+        pw = w + 2
+        size = (h + 2) * pw
+        moves_a = array.array("i", [INF]) * (size * 8)
+        padded = numpy.frombuffer(moves_a, dtype=numpy.int32).reshape(h + 2, pw, 8)
+        padded[1:h+1,1:w+1] = numpy.where(costs >= 0, costs, INF)
+        padded = padded.reshape(-1, 8)
+        possible = costs[costs >= 0]
+        if len(possible):
+            cheapest = int(possible.min())
+        else:
+            cheapest = 1
+        dist_a = array.array("i", [INF]) * size
+        dist = numpy.frombuffer(dist_a, dtype=numpy.int32)
+        settled_a = bytearray(size)
+        settled = numpy.frombuffer(settled_a, dtype=numpy.bool_)
+        offsets = [dy*pw + dx for dx, dy, base in pathfinder.AStar.moves]
+        t = (target[1] + 1)*pw + target[0] + 1
+        dist[t] = 0
+        # Tiles which have been reached but not settled, may hold repeats and tiles
+        # settled since they were added, which are skipped
+        frontier = numpy.array([t])
+        bands = 0
+        while len(frontier):
+            if len(frontier) < self.narrow:
+                # Too few tiles for array operations to pay, e.g. along a corridor, so
+                # settle them one at a time from a heap until the frontier widens
+                heap = [(dist_a[n], n) for n in frontier.tolist()]
+                heapq.heapify(heap)
+                while heap and len(heap) < self.wide:
+                    d, n = heapq.heappop(heap)
+                    if settled_a[n]:
+                        continue
+                    settled_a[n] = 1
+                    for k, offset in enumerate(offsets):
+                        m = n - offset
+                        nd = d + moves_a[m*8 + k]
+                        if nd < dist_a[m] and not settled_a[m]:
+                            dist_a[m] = nd
+                            heapq.heappush(heap, (nd, m))
+                frontier = numpy.array([n for d, n in heap], dtype=numpy.int64)
+                continue
+            frontier = frontier[~settled[frontier]]
+            if not len(frontier):
+                break
+            d = dist[frontier]
+            lowest = d.min()
+            chosen = d < lowest + cheapest
+            band = numpy.unique(frontier[chosen])
+            frontier = frontier[~chosen]
+            settled[band] = True
+            bands += 1
+            found = [frontier]
+            for k, offset in enumerate(offsets):
+                # Tiles which can move into the band with move k
+                n = band - offset
+                new = dist[band] + padded[n,k]
+                better = (new < dist[n]) & ~settled[n]
+                n = n[better]
+                # Within one move every tile moved from is different, so this can't clash
+                dist[n] = new[better]
+                found.append(n)
+            frontier = numpy.concatenate(found)
+        dist = dist.reshape(h + 2, pw)
+        # Best move out of each tile, the one with the lowest cost plus cost from where it goes
+        best = numpy.empty((h, w), dtype=numpy.int32)
+        best.fill(INF)
+        directions = numpy.empty((h, w), dtype=numpy.int8)
+        directions.fill(-1)
+        moves = padded.reshape(h + 2, pw, 8)
+        for k, (dx, dy, base) in enumerate(pathfinder.AStar.moves):
+            via = moves[1:h+1,1:w+1,k] + dist[1+dy:h+1+dy,1+dx:w+1+dx]
+            better = via < best
+            best[better] = via[better]
+            directions[better] = k
+        self.dist = numpy.array(dist[1:h+1,1:w+1])
+        directions[self.dist >= INF] = -1
+        directions[target[1],target[0]] = -1
+        self.directions = directions
+        # Costs are -1 for tiles which can't reach the target
+        self.dist[self.dist >= INF] = -1
+        debug("Flow field to %s worked out in %s bands" % (target, bands))
+
+    def get_cost(self, tile):
+        """Returns the cost of the best route from tile to the target, or -1 if there's none"""
+        return int(self.dist[tile[1],tile[0]])
+
+    def get_next(self, tile):
+        """Returns the tile to move to from tile to head for the target, or None if tile is
+        the target or can't reach it"""
+        k = self.directions[tile[1],tile[0]]
+        if k < 0:
+            return None
+        dx, dy, base = pathfinder.AStar.moves[k]
+        return (tile[0] + dx, tile[1] + dy)
+
+    def get_path(self, start):
+        """Returns the route from start to the target in the same form as AStar.find_path(),
+        from the target back to the start, or None if there's no route"""
+        if self.dist[start[1],start[0]] < 0:
+            return None
+        path = [start]
+        tile = self.get_next(start)
+        while tile is not None:
+            path.append(tile)
+            tile = self.get_next(tile)
+        path.reverse()
+        return path
+
+
+class FlowFields(object):
+    """Flow fields over a grid, kept for the targets most recently asked for
+    Every field depends on the whole grid, so they're all dropped when any tile changes"""
+    # Number of fields kept, each takes 5 bytes per tile
+    max_fields = 16
+
+    def __init__(self, grid, max_fields=None):
+        self.grid = grid
+        if max_fields:
+            self.max_fields = max_fields
+        # Fields keyed by target, least recently used first
+        self.fields = collections.OrderedDict()
+        self.changed = grid.watch()
+
+    def refresh(self):
+        """Drop all the fields if the grid has changed, returns True if it had"""
+        if not self.changed:
+            return False
+        self.changed.clear()
+        self.fields.clear()
+        return True
+
+    def get_field(self, target):
+        """Returns the FlowField for target, working it out if it isn't already kept"""
+        self.refresh()
+        field = self.fields.pop(target, None)
+        if field is None:
+            self.grid.refresh()
+            field = FlowField(self.grid, target)
+            while len(self.fields) >= self.max_fields:
+                self.fields.popitem(last=False)
+        self.fields[target] = field
+        return field
+
+    def find_path(self, start, target):
+        """Returns the route from start to target in the same form as AStar.find_path()"""
+        return self.get_field(target).get_path(start)
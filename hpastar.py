@@ -0,0 +1,649 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+
+
+
+
+import bisect
+import heapq
+import numpy
+
+import pathfinder
+
+import logger
+debug = logger.Log()
+
+# Cost used for tiles which can't be reached
+INF = 1 << 29
+
+# Index of each move (dx, dy) in pathfinder.AStar.moves
+move_index = dict([((dx, dy), k) for k, (dx, dy, cost) in enumerate(pathfinder.AStar.moves)])
+
+class HPAStar(object):
+    """Hierarchical pathfinding (HPA*) over a grid divided into square clusters
+    Where the tiles along the border between two clusters can be crossed, entrances are
+    placed, the tiles either side of them are the nodes of an abstract graph. Nodes in the
+    same cluster are joined by the cost of the best route between them inside the cluster
+    A search finds the best way to the nodes of the start's cluster, searches the abstract
+    graph from there to the nodes of the target's cluster and then fills in the route
+    between each pair of nodes, so only a few clusters are ever searched tile by tile
+    grid is a pathfinder.CostGrid or pathfinder.MapGrid, when tiles of it change only the
+    clusters around them are worked out again
+    Every move across a border (straight, diagonal, across the corner into a diagonal
+    neighbour, or one way only) belongs to a run of moves whose tiles are joined along the
+    border on both sides, and each run gets at least one entrance, so any route which can
+    be made across a border can also be made through an entrance
+    Routes are a few percent longer than the best possible on average, since they have to
+    go through entrances, and can be as much as a third longer on small crowded maps"""
+    # Width and height of each cluster, in tiles
+    cluster_size = 32
+    # Runs of crossings along a border which start from fewer tiles than this get one
+    # entrance in the middle, longer ones get one at each end
+    long_entrance = 6
+    # Runs of crossings which could stand in for one another are all given entrances if they
+    # are at least this far apart along the border, as a fraction of the cluster size
+    far_entrance = 0.5
+    # Number of clusters of the same size worked out together
+    batch_size = 64
+
+    def __init__(self, grid, cluster_size=None):
+        """Divide the grid into clusters and work out the abstract graph"""
+        self.grid = grid
+        if cluster_size:
+            self.cluster_size = cluster_size
+        self.width = grid.width
+        self.height = grid.height
+        cs = self.cluster_size
+        self.clusters_x = (self.width + cs - 1) / cs
+        self.clusters_y = (self.height + cs - 1) / cs
+        # Entrances on each border, as lists of (tile in the first cluster, tile in the second)
+        # Keyed by (cx, cy, side), side 0 is the border with cluster (cx+1, cy), 1 with (cx, cy+1)
+        self.borders = {}
+        # Nodes (tile numbers, y * width + x) in each cluster, keyed by (cx, cy)
+        self.nodes = {}
+        # Edges across borders, crossings[node][node2] = cost
+        self.crossings = {}
+        # Edges inside clusters, between[cluster][i,j] is the cost of the best route inside
+        # the cluster from its node i to its node j (in the order of nodes[cluster]), INF if
+        # there isn't one
+        self.between = {}
+        # Areas of each cluster which can be moved around in, as the lowest number (within
+        # the cluster, y * width + x) of any tile in the area, see find_components()
+        if cs * cs < 1 << 15:
+            self.components = numpy.zeros((self.height, self.width), dtype=numpy.int16)
+        else:
+            self.components = numpy.zeros((self.height, self.width), dtype=numpy.int32)
+        # Tiles which have changed since the clusters were worked out
+        self.changed = grid.watch()
+        clusters = [(cx, cy) for cx in range(self.clusters_x) for cy in range(self.clusters_y)]
+        self.update_components(clusters)
+        for cx in range(self.clusters_x):
+            for cy in range(self.clusters_y):
+                self.update_border(cx, cy, 0)
+                self.update_border(cx, cy, 1)
+        self.update_clusters(clusters)
+        # Number of abstract nodes expanded by the last search
+        self.expanded = 0
+        # Cost of the last route found
+        self.cost = None
+        debug("HPA* clusters built, %s nodes in %s clusters" % (sum([len(n) for n in self.nodes.values()]), len(self.nodes)))
+
+    def get_bounds(self, cluster):
+        """Returns the tiles a cluster covers, from (x0,y0) up to but not including (x1,y1)"""
+        cs = self.cluster_size
+        cx, cy = cluster
+        return (cx*cs, cy*cs, min((cx+1)*cs, self.width), min((cy+1)*cs, self.height))
+
+    def get_area(self, a, b):
+        """Returns the area covered by the clusters tiles a and b are in, as (x0, y0, x1, y1)"""
+        ax0, ay0, ax1, ay1 = self.get_bounds(self.get_cluster(a))
+        bx0, by0, bx1, by1 = self.get_bounds(self.get_cluster(b))
+        return (min(ax0, bx0), min(ay0, by0), max(ax1, bx1), max(ay1, by1))
+
+    def get_cluster(self, tile):
+        """Returns the cluster a tile is in"""
+        return (tile[0] / self.cluster_size, tile[1] / self.cluster_size)
+
+    def get_costs_around(self, x0, y0, x1, y1):
+        """As grid.get_costs(), but the area may go off the edges of the map, moves out of
+        tiles off the map cost -1"""
+        costs = numpy.empty((y1 - y0, x1 - x0, 8), dtype=numpy.int32)
+        costs.fill(-1)
+        cx0 = max(x0, 0)
+        cy0 = max(y0, 0)
+        cx1 = min(x1, self.width)
+        cy1 = min(y1, self.height)
+        if cx0 < cx1 and cy0 < cy1:
+            costs[cy0-y0:cy1-y0,cx0-x0:cx1-x0] = self.grid.get_costs(cx0, cy0, cx1, cy1)
+        return costs
+
+    def get_enterable(self, costs):
+        """Returns an array of shape (height, width) for an area which is True for the tiles
+        which can be moved into from one of their neighbours in the area, costs are the
+        area's costs from get_costs_around()"""
+        h, w = costs.shape[:2]
+        enterable = numpy.zeros((h, w), dtype=numpy.bool_)
+        for k, (dx, dy, base) in enumerate(pathfinder.AStar.moves):
+            # Tile (x, y) is entered by move k from (x - dx, y - dy)
+            possible = costs[max(-dy, 0):h-max(dy, 0),max(-dx, 0):w-max(dx, 0),k] >= 0
+            enterable[max(dy, 0):h-max(-dy, 0),max(dx, 0):w-max(-dx, 0)] |= possible
+        return enterable
+
+    def update_border(self, cx, cy, side):
+        """Work out the entrances on one border of a cluster and the edges across them
+        Side 0 is the border with cluster (cx+1, cy), and holds every move across it, including
+        diagonal moves into (cx+1, cy-1) or (cx+1, cy+1) from this cluster and into (cx, cy-1)
+        or (cx, cy+1) from the other. Side 1 is the border with (cx, cy+1), and holds the
+        moves across it which stay in the same column of clusters
+        Returns the set of clusters whose nodes have changed"""
+        x0, y0, x1, y1 = self.get_bounds((cx, cy))
+        if side == 0:
+            if cx + 1 >= self.clusters_x:
+                return set()
+            # Tiles either side of the border are (x1 - 1, y) and (x1, y), moves between
+            # them go across (x) and along the border (y)
+            costs = self.get_costs_around(x1 - 2, y0 - 1, x1 + 2, y1 + 1)
+            count = y1 - y0
+            def tile(line, i):
+                return (x1 - 1 + line, y0 + i)
+            def move(across, along):
+                return move_index[(across, along)]
+        else:
+            if cy + 1 >= self.clusters_y:
+                return set()
+            costs = self.get_costs_around(x0 - 1, y1 - 2, x1 + 1, y1 + 2)
+            count = x1 - x0
+            def tile(line, i):
+                return (x0 + i, y1 - 1 + line)
+            def move(across, along):
+                return move_index[(along, across)]
+        enterable = self.get_enterable(costs)
+        # The costs and enterable flags along each side of the border, tile i at i + 1
+        if side == 0:
+            lines = [costs[:, 1], costs[:, 2]]
+            entry = [enterable[:, 1], enterable[:, 2]]
+        else:
+            lines = [costs[1], costs[2]]
+            entry = [enterable[1], enterable[2]]
+        # joined[line][i + 1] is set if tiles i and i + 1 along a side of the border can be
+        # moved between both ways, for i from -1 to count - 1
+        joined = [((l[:-1, move(0, 1)] >= 0) & (l[1:, move(0, -1)] >= 0)).tolist() for l in lines]
+        width = self.width
+        new = []
+        # Moves from this cluster's side (line 0) across to the other's (line 1), then back
+        for line, across in [(0, 1), (1, -1)]:
+            other = 1 - line
+            moves = []
+            crossing = [lines[line][1:-1, move(across, along)].tolist() for along in [-1, 0, 1]]
+            for i, ok in enumerate(entry[line][1:-1].tolist()):
+                # Moves out of tiles which can't be entered only start routes, find_path() deals with those
+                if not ok:
+                    continue
+                src = tile(line, i)
+                for along in [-1, 0, 1]:
+                    j = i + along
+                    # Moves to the side of the next border along belong to that border
+                    if side == 1 and (j < 0 or j >= count):
+                        continue
+                    c = crossing[along + 1][i]
+                    if c >= 0:
+                        dst = tile(other, j)
+                        moves.append((i, j, c, src, dst, self.get_cluster(dst)))
+            # Split the moves into runs, within a run the tiles moved from are joined along
+            # the border, as are the tiles moved to, so any of them can be used in place
+            # of another by moving along the border first and after
+            runs = []
+            for m in moves:
+                if runs:
+                    i, j, c, src, dst, cluster = runs[-1][-1]
+                    if cluster == m[5] and \
+                       (m[0] == i or (m[0] == i + 1 and joined[line][i + 1])) and \
+                       (m[1] == j or (abs(m[1] - j) == 1 and joined[other][min(m[1], j) + 1])):
+                        runs[-1].append(m)
+                        continue
+                runs.append([m])
+            # Runs which start from the same area of this side's cluster and go to the same
+            # area of a cluster on the other side can stand in for each other, by going round
+            # inside the clusters, so only the widest of them gets entrances
+            # Tiles of a run are all in the same area, as they're joined. The widest run of
+            # each kind gets entrances, and so do any others far enough along the border from
+            # every run already given entrances that going round to them could be a long way
+            kinds = {}
+            for run in runs:
+                i, j, c, src, dst, cluster = run[0]
+                key = (self.components[src[1],src[0]], cluster, self.components[dst[1],dst[0]])
+                kinds.setdefault(key, []).append(run)
+            given = []
+            for kind in kinds.values():
+                kind.sort(key=lambda run: -len(run))
+                kept = []
+                far = self.far_entrance * self.cluster_size
+                for run in kind:
+                    if not [k for k in kept if run[0][0] - k[-1][0] < far and k[0][0] - run[-1][0] < far]:
+                        kept.append(run)
+                given.extend(kept)
+            given.sort()
+            for run in given:
+                starts = sorted(set([m[0] for m in run]))
+                if len(starts) < self.long_entrance:
+                    chosen = [starts[(len(starts) - 1) / 2]]
+                else:
+                    chosen = [starts[0], starts[-1]]
+                for i in chosen:
+                    # Straight across if possible, so the same tiles are used both ways
+                    options = [m for m in run if m[0] == i]
+                    options.sort(key=lambda m: abs(m[1] - m[0]))
+                    i, j, c, src, dst, cluster = options[0]
+                    new.append((src[1]*width + src[0], dst[1]*width + dst[0], c))
+        # Replace the edges across the old entrances
+        old = self.borders.get((cx, cy, side), [])
+        for a, b, c in old:
+            self.crossings.get(a, {}).pop(b, None)
+        for a, b, c in new:
+            self.crossings.setdefault(a, {})[b] = c
+        self.borders[(cx, cy, side)] = new
+        # Clusters which have gained or lost nodes
+        changed = set()
+        for a, b, c in set(old) ^ set(new):
+            changed.add(self.get_tile_cluster(a))
+            changed.add(self.get_tile_cluster(b))
+        return changed
+
+    def get_tile_cluster(self, n):
+        """Returns the cluster tile number n is in"""
+        return ((n % self.width) / self.cluster_size, (n / self.width) / self.cluster_size)
+
+    def get_borders(self, cluster):
+        """Returns the keys of the borders which can have moves into or out of a cluster"""
+        cx, cy = cluster
+        keys = [(bx, by, 0) for bx in [cx - 1, cx] for by in [cy - 1, cy, cy + 1]]
+        keys.extend([(cx, cy - 1, 1), (cx, cy, 1)])
+        return [(bx, by, side) for bx, by, side in keys
+                if 0 <= bx < self.clusters_x and 0 <= by < self.clusters_y]
+
+    def get_nodes(self, cluster):
+        """Returns the nodes in a cluster, from the entrances on the borders around it"""
+        nodes = set()
+        for key in self.get_borders(cluster):
+            for a, b, c in self.borders.get(key, []):
+                for n in (a, b):
+                    if self.get_tile_cluster(n) == cluster:
+                        nodes.add(n)
+        return sorted(nodes)
+
+    def update_clusters(self, clusters):
+        """Work out the costs of the best routes between each pair of nodes in each cluster"""
+        # Clusters are worked out in batches of the same size (clusters at the far edges may be smaller)
+        batches = {}
+        for cluster in clusters:
+            nodes = self.get_nodes(cluster)
+            self.nodes[cluster] = nodes
+            self.between.pop(cluster, None)
+            if nodes:
+                x0, y0, x1, y1 = self.get_bounds(cluster)
+                batches.setdefault((x1 - x0, y1 - y0), []).append(cluster)
+        width = self.width
+        for size, batch in batches.items():
+            # Clusters with similar numbers of nodes go together, as every cluster in a
+            # batch is worked out for as many nodes as the one with the most
+            batch.sort(key=lambda cluster: len(self.nodes[cluster]))
+            for i in range(0, len(batch), self.batch_size):
+                part = batch[i:i+self.batch_size]
+                costs = []
+                sources = []
+                for cluster in part:
+                    x0, y0, x1, y1 = self.get_bounds(cluster)
+                    costs.append(self.grid.get_costs(x0, y0, x1, y1))
+                    sources.append([(n % width - x0, n / width - y0) for n in self.nodes[cluster]])
+                dist = self.relax_areas(numpy.array(costs), sources)
+                for j, cluster in enumerate(part):
+                    nodes = self.nodes[cluster]
+                    lx = numpy.array([x for x, y in sources[j]])
+                    ly = numpy.array([y for x, y in sources[j]])
+                    # Cost from each node (rows) to each node (columns)
+                    self.between[cluster] = dist[j,:len(nodes)][:,ly,lx].copy()
+
+    def relax(self, costs, sources, reverse=False):
+        """Returns the cost of the best route from each source to every tile of an area, as an
+        array of shape (len(sources), height, width), routes can't leave the area
+        costs is the area's costs from get_costs(), sources are (x, y) within the area
+        If reverse is True costs are of routes to the sources instead"""
+        return self.relax_areas(costs[numpy.newaxis], [sources], reverse)[0]
+
+    def relax_areas(self, costs, sources, reverse=False):
+        """As relax() for several areas of the same size at once, costs has shape
+        (areas, height, width, 8) and sources is a list of lists of sources for each area
+        Returns an array of shape (areas, most sources, height, width)"""
+        areas, h, w = costs.shape[:3]
+        count = max([len(s) for s in sources])
+        # Arrays are laid out with the areas and sources last, so that each line of tiles
+        # is one block of memory whichever way it runs
+        # Costs of the best routes, with a border of one tile which can't be reached
+        padded = numpy.empty((h + 2, w + 2, areas, count), dtype=numpy.int32)
+        padded.fill(INF)
+        for a, area_sources in enumerate(sources):
+            for i, (x, y) in enumerate(area_sources):
+                padded[y+1,x+1,a,i] = 0
+        # Costs of moves, with a border of moves which can't be made
+        c = numpy.empty((h + 2, w + 2, 8, areas, 1), dtype=numpy.int32)
+        c.fill(INF)
+        c[1:h+1,1:w+1,:,:,0] = numpy.where(costs >= 0, costs, INF).transpose(1,2,3,0)
+        return self.spread(padded, c, reverse).transpose(2,3,0,1)
+
+    def find_components(self, costs):
+        """Returns the areas of tiles which can be reached from each other (both ways) inside
+        each of several areas of the same size, costs has shape (areas, height, width, 8)
+        Each tile is given the lowest number (y * width + x within the area) of any tile in
+        its area, as an array of shape (areas, height, width)"""
+        areas, h, w = costs.shape[:3]
+        # Moves which can be made both ways, with a border of moves which can't be made
+        both = costs >= 0
+        for k, (dx, dy, base) in enumerate(pathfinder.AStar.moves):
+            back = move_index[(-dx, -dy)]
+            src = (slice(None), slice(max(-dy, 0), h - max(dy, 0)), slice(max(-dx, 0), w - max(dx, 0)), k)
+            dst = (slice(None), slice(max(dy, 0), h - max(-dy, 0)), slice(max(dx, 0), w - max(-dx, 0)), back)
+            both[src] &= costs[dst] >= 0
+        c = numpy.empty((h + 2, w + 2, 8, areas, 1), dtype=numpy.int32)
+        c.fill(INF)
+        c[1:h+1,1:w+1,:,:,0] = numpy.where(both, 0, INF).transpose(1,2,3,0)
+        # Numbers spread like routes which cost nothing, so each tile ends up with the lowest
+        padded = numpy.empty((h + 2, w + 2, areas, 1), dtype=numpy.int32)
+        padded.fill(INF)
+        padded[1:h+1,1:w+1,:,0] = numpy.arange(h * w).reshape(h, w, 1)
+        return self.spread(padded, c).transpose(2,3,0,1)[:,0]
+
+    def update_components(self, clusters):
+        """Work out the areas which can be moved around in inside each of the clusters"""
+        batches = {}
+        for cluster in clusters:
+            x0, y0, x1, y1 = self.get_bounds(cluster)
+            batches.setdefault((x1 - x0, y1 - y0), []).append(cluster)
+        for size, batch in batches.items():
+            for i in range(0, len(batch), self.batch_size):
+                part = batch[i:i+self.batch_size]
+                costs = numpy.array([self.grid.get_costs(*self.get_bounds(cluster)) for cluster in part])
+                components = self.find_components(costs)
+                for j, cluster in enumerate(part):
+                    x0, y0, x1, y1 = self.get_bounds(cluster)
+                    self.components[y0:y1,x0:x1] = components[j]
+
+    def spread(self, padded, c, reverse=False):
+        """Spread the lowest costs in padded along the moves in c until nothing improves, for
+        relax_areas(), padded has shape (height + 2, width + 2, areas, sources) and c has shape
+        (height + 2, width + 2, 8, areas, 1), both with a border of one tile
+        padded is changed in place, returns the part of it without the border"""
+        h = padded.shape[0] - 2
+        w = padded.shape[1] - 2
+        dist = padded[1:h+1,1:w+1]
+        # Routes are spread a line at a time, down then up the rows and right then left
+        # along the columns, so a route going one way is found in a single sweep
+        # Columns are swept as the rows of transposed views of the arrays
+        sweeps = []
+        for rows in [True, False]:
+            if rows:
+                p, cv, n, m = padded, c, h, w
+            else:
+                p, cv, n, m = padded.transpose(1,0,2,3), c.transpose(1,0,2,3,4), w, h
+            for step in [1, -1]:
+                # Moves which go from one line to the next in this direction (for reverse routes,
+                # from the next line back to this one), with their offset along the line
+                moves = []
+                for k, (dx, dy, base) in enumerate(pathfinder.AStar.moves):
+                    across, along = (dy, dx) if rows else (dx, dy)
+                    if across == (-step if reverse else step):
+                        moves.append((k, along))
+                if step == 1:
+                    lines = range(2, n + 1)
+                else:
+                    lines = range(n - 1, 0, -1)
+                sweeps.append((p, cv, m, step, lines, moves))
+        # Keep sweeping until nothing improves
+        while True:
+            before = dist.copy()
+            for p, cv, m, step, lines, moves in sweeps:
+                for r in lines:
+                    last = r - step
+                    line = p[r,1:m+1]
+                    for k, along in moves:
+                        if reverse:
+                            # Cost of the move out of this line, plus the route on from where it goes
+                            new = p[last,1+along:1+along+m] + cv[r,1:m+1,k]
+                        else:
+                            # Route to where the move starts on the last line, plus the cost of the move
+                            new = p[last,1-along:1-along+m] + cv[last,1-along:1-along+m,k]
+                        numpy.minimum(line, new, out=line)
+            if numpy.array_equal(before, dist):
+                break
+        return dist
+
+    def trace(self, costs, dist, tile, reverse=False):
+        """Follow a route back through an area from the distances worked out by relax()
+        If reverse is False returns the route from the source to tile, otherwise the route
+        from tile to the source, tiles are (x, y) within the area
+        Returns None if the tile can't be reached"""
+        h, w = dist.shape
+        x, y = tile
+        route = [tile]
+        if dist[y,x] >= INF:
+            return None
+        while dist[y,x] != 0:
+            found = False
+            for k, (dx, dy, base) in enumerate(pathfinder.AStar.moves):
+                if reverse:
+                    nx, ny = x + dx, y + dy
+                else:
+                    nx, ny = x - dx, y - dy
+                if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                    continue
+                if reverse:
+                    c = costs[y,x,k]
+                    found = c >= 0 and c + dist[ny,nx] == dist[y,x]
+                else:
+                    c = costs[ny,nx,k]
+                    found = c >= 0 and dist[ny,nx] + c == dist[y,x]
+                if found:
+                    x, y = nx, ny
+                    route.append((x, y))
+                    break
+            if not found:
+                # Distances don't match the costs, so there's no way back
+                return None
+        if not reverse:
+            route.reverse()
+        return route
+
+    def refresh(self):
+        """Work out the clusters around any tiles which have changed again"""
+        if not self.changed:
+            return False
+        tiles = list(self.changed)
+        self.changed.clear()
+        self.grid.refresh()
+        self.update(tiles)
+        return True
+
+    def update(self, tiles):
+        """Work out the clusters around the tiles given again"""
+        # Costs of moves into a tile belong to its neighbours, which may be in other clusters
+        dirty = set()
+        for x, y in tiles:
+            for nx in [x - 1, x, x + 1]:
+                for ny in [y - 1, y, y + 1]:
+                    if 0 <= nx < self.width and 0 <= ny < self.height:
+                        dirty.add(self.get_cluster((nx, ny)))
+        self.update_components(dirty)
+        rebuild = set(dirty)
+        borders = set()
+        for cluster in dirty:
+            borders.update(self.get_borders(cluster))
+        for bx, by, side in borders:
+            # If the entrances have moved, the nodes in the clusters either side have too
+            rebuild.update(self.update_border(bx, by, side))
+        self.update_clusters(list(rebuild))
+        debug("HPA* updated %s clusters" % len(rebuild))
+
+    def heuristic(self, n, tx, ty):
+        """Octile distance from tile number n to (tx, ty), as for AStar"""
+        dx = abs(n % self.width - tx)
+        dy = abs(n / self.width - ty)
+        if dx > dy:
+            return 14*dy + 10*(dx-dy)
+        else:
+            return 14*dx + 10*(dy-dx)
+
+    def find_path(self, start, target, refine=True):
+        """Find a route from start to target, returns a list of tiles from the target back to
+        the start (like AStar.find_path()), or None if there's no route
+        If refine is False only the start, the nodes the route goes through and the target
+        are returned, the tiles between them can be found later with refine_path()"""
+        self.refresh()
+        width = self.width
+        s_cluster = self.get_cluster(start)
+        t_cluster = self.get_cluster(target)
+        sx0, sy0, sx1, sy1 = self.get_bounds(s_cluster)
+        tx0, ty0, tx1, ty1 = self.get_bounds(t_cluster)
+        # Best routes from the start to the tiles of its cluster, and from those of the target's cluster to the target
+        s_costs = self.grid.get_costs(sx0, sy0, sx1, sy1)
+        s_dist = self.relax(s_costs, [(start[0] - sx0, start[1] - sy0)])[0]
+        t_costs = self.grid.get_costs(tx0, ty0, tx1, ty1)
+        t_dist = self.relax(t_costs, [(target[0] - tx0, target[1] - ty0)], reverse=True)[0]
+        tx, ty = target
+        # Nodes the target can be reached from, and the cost from each
+        ends = {}
+        for n in self.nodes[t_cluster]:
+            d = t_dist[n / width - ty0, n % width - tx0]
+            if d < INF:
+                ends[n] = int(d)
+        g = {}
+        parents = {}
+        # Open list entries are (f, -g, node, end), end is True for the end of a route, then
+        # node is the last node on the route (None for a route which stays near the start)
+        # Of entries with the same F the one furthest along is taken first
+        for n in self.nodes[s_cluster]:
+            d = s_dist[n / width - sy0, n % width - sx0]
+            if d < INF:
+                g[n] = int(d)
+                parents[n] = None
+        # Moves out of a start which can't be entered (a blocked tile on a MapGrid) have no
+        # entrances, so routes may also begin by going straight into a neighbouring cluster
+        # vias[node] is the tile next to the start such a route goes through
+        vias = {}
+        around = self.get_costs_around(start[0] - 1, start[1] - 1, start[0] + 2, start[1] + 2)
+        if not self.get_enterable(around)[1,1]:
+            for k, (dx, dy, base) in enumerate(pathfinder.AStar.moves):
+                via = (start[0] + dx, start[1] + dy)
+                cluster = self.get_cluster(via)
+                c = int(around[1,1,k])
+                if c < 0 or cluster == s_cluster:
+                    continue
+                x0, y0, x1, y1 = self.get_bounds(cluster)
+                dist = self.relax(self.grid.get_costs(x0, y0, x1, y1), [(via[0] - x0, via[1] - y0)])[0]
+                for n in self.nodes[cluster]:
+                    d = dist[n / width - y0, n % width - x0]
+                    if d < INF and (not g.has_key(n) or c + d < g[n]):
+                        g[n] = int(c + d)
+                        parents[n] = None
+                        vias[n] = via
+        open = [(gn + self.heuristic(n, tx, ty), -gn, n, False) for n, gn in g.items()]
+        if abs(s_cluster[0] - t_cluster[0]) <= 1 and abs(s_cluster[1] - t_cluster[1]) <= 1:
+            # Start and target are close, so the best route may not go through any entrances
+            x0, y0, x1, y1 = self.get_area(start, target)
+            d = self.relax(self.grid.get_costs(x0, y0, x1, y1), [(start[0] - x0, start[1] - y0)])[0][ty - y0, tx - x0]
+            if d < INF:
+                open.append((int(d), -int(d), None, True))
+        heapq.heapify(open)
+        closed = set()
+        expanded = 0
+        self.cost = None
+        while open:
+            f, gn, n, end = heapq.heappop(open)
+            gn = -gn
+            if end:
+                # End of a route is the cheapest thing left, so this is the best route
+                self.cost = gn
+                break
+            if n in closed or gn != g[n]:
+                continue
+            closed.add(n)
+            expanded += 1
+            if ends.has_key(n):
+                heapq.heappush(open, (gn + ends[n], -(gn + ends[n]), n, True))
+            cluster = self.get_tile_cluster(n)
+            nodes = self.nodes[cluster]
+            i = bisect.bisect_left(nodes, n)
+            edges = [(m, cost) for m, cost in zip(nodes, self.between[cluster][i].tolist()) if cost < INF and m != n]
+            for m, cost in edges + self.crossings.get(n, {}).items():
+                if m in closed:
+                    continue
+                gm = gn + cost
+                if not g.has_key(m) or gm < g[m]:
+                    g[m] = gm
+                    parents[m] = n
+                    heapq.heappush(open, (gm + self.heuristic(m, tx, ty), -gm, m, False))
+        self.expanded = expanded
+        if self.cost is None:
+            return None
+        # Nodes along the route, from the target's end back to the start's
+        waypoints = [target]
+        while n is not None:
+            waypoints.append((n % width, n / width))
+            if parents[n] is None and vias.has_key(n):
+                waypoints.append(vias[n])
+            n = parents[n]
+        waypoints.append(start)
+        if not refine:
+            return waypoints
+        return self.refine_path(waypoints)
+
+    def refine_path(self, waypoints):
+        """Fill in the tiles between the waypoints returned by find_path() with refine=False
+        Each pair of waypoints is either next to each other across a cluster border or in
+        the same or neighbouring clusters, the searches between them are done together
+        Returns None if the tiles between a pair of waypoints can't be found"""
+        waypoints = list(reversed(waypoints))
+        pieces = []
+        # Searches to do, grouped by the size of the area they cover
+        searches = {}
+        for i, (a, b) in enumerate(zip(waypoints, waypoints[1:])):
+            if max(abs(a[0] - b[0]), abs(a[1] - b[1])) <= 1 and self.get_cluster(a) != self.get_cluster(b):
+                pieces.append([a, b])
+            else:
+                pieces.append(None)
+                x0, y0, x1, y1 = self.get_area(a, b)
+                searches.setdefault((x1 - x0, y1 - y0), []).append((i, (x0, y0, x1, y1), a, b))
+        for size, group in searches.items():
+            for j in range(0, len(group), self.batch_size):
+                part = group[j:j+self.batch_size]
+                costs = numpy.array([self.grid.get_costs(*area) for i, area, a, b in part])
+                dist = self.relax_areas(costs, [[(a[0] - area[0], a[1] - area[1])] for i, area, a, b in part])
+                for k, (i, (x0, y0, x1, y1), a, b) in enumerate(part):
+                    route = self.trace(costs[k], dist[k,0], (b[0] - x0, b[1] - y0))
+                    if route is None:
+                        return None
+                    pieces[i] = [(x + x0, y + y0) for x, y in route]
+        path = [waypoints[0]]
+        for piece in pieces:
+            path.extend(piece[1:])
+        path.reverse()
+        return path
+
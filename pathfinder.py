@@ -24,6 +24,11 @@
 import os, sys
 import pygame
 import random
+import math
+import heapq
+import array
+import numpy
+import weakref
 
 import world
 World = world.World()
@@ -44,6 +49,10 @@ p16 = p / 16
 #tile height difference
 ph = 8
 
+# Values in bytearrays of blocked tiles, for searching them
+BLOCKED_BYTE = "\x01"
+OPEN_BYTE = "\x00"
+
 #
 class Lookup(dict):
     """A dictionary which can lookup value by key, or keys by value"""
@@ -66,66 +75,147 @@ class AStarError(Exception):
         return repr(self.value)
 
 class AStar(object):
+    """A* search over a grid of tiles, moving in 8 directions
+    The open list is a binary heap, nodes are pushed again when a cheaper route to them
+    is found and the out of date entries are skipped when they come off the heap
+    G costs, parents and the open/closed state of each tile are kept in flat arrays
+    indexed by tile number (y * width + x)
+    With jump set, grids where every move costs the flat 10/14 are searched with Jump Point
+    Search, which only expands tiles where the route may need to turn (jump points) and scans
+    straight over the open ground in between, giving the same cost of route"""
     # Variables that persist through instances of this class
-    # Reference with Pathfinder.var
+    # Reference with AStar.var
     # G = the movement cost to move from the starting point A to a given square on the grid, following the path generated to get there
     # H = the estimated movement cost to move from that given square on the grid to the final destination
     # F = G + H
 
+    # Tile states
+    UNSEEN = 0
+    OPEN = 1
+    CLOSED = 2
+    # Moves to the 8 neighbouring tiles, (dx, dy, cost)
+    moves = [(-1,-1,14), (0,-1,10), (1,-1,14),
+             (-1, 0,10),            (1, 0,10),
+             (-1, 1,14), (0, 1,10), (1, 1,14)]
     width = 1
-    def __init__(self, map):
-        """"""
-        # Needs to store:
-        # Tile location (UID)
-        # Parent tile location (UID)
-        # G cost to this square via best route so far
-        # H cost from this square to the target
-        # F cost (G + H)
-        # (x, y): ((px, py), g, h, f)
-        self.open = {}
-        self.closed = {}
+    def __init__(self, map=None, costs=None, jump=False, bidirectional=False):
+        """map is a list of rows, map[y][x][1] is 1 for tiles which can't be crossed, or a MapGrid
+        costs is an optional CostGrid, used instead of the flat 10/14 cost of each move
+        At least one of them must be given
+        jump turns on Jump Point Search, if the costs vary it's turned off again and
+        the grid is searched normally
+        bidirectional searches from both ends at once (see find_bidirectional_path()),
+        if jump is also on and the grid allows it jump point search is used instead"""
         self.map = map
-        self.width = len(map[0])
-        self.height = len(map)
+        self.costs = costs
+        if isinstance(map, MapGrid):
+            self.width = map.width
+            self.height = map.height
+        elif map is not None:
+            self.width = len(map[0])
+            self.height = len(map)
+        else:
+            self.width = costs.width
+            self.height = costs.height
+        self.blocked = bytearray(self.width * self.height)
+        if isinstance(map, MapGrid):
+            # Straight from the array's memory, True is the same byte as BLOCKED_BYTE
+            self.blocked = bytearray(numpy.ascontiguousarray(map.blocked, dtype=numpy.bool_).data)
+        elif map is not None:
+            for y, line in enumerate(map):
+                for x, tile in enumerate(line):
+                    if tile[1] == 1:
+                        self.blocked[y*self.width + x] = 1
+        if jump and costs is not None:
+            # Costs which are the same as a map of blocked tiles can still be jumped over
+            blocked = self.find_uniform_blocked(costs)
+            if blocked is None:
+                debug("Costs vary, not using jump point search")
+                jump = False
+            else:
+                self.blocked = blocked
+        self.jump = jump
+        self.bidirectional = bidirectional
+        if jump:
+            # Blocked tiles again, column by column (x * height + y), for scanning up and down
+            rows = numpy.frombuffer(self.blocked, dtype=numpy.uint8).reshape(self.height, self.width)
+            self.blocked_columns = bytearray(rows.T.tostring())
+        # The search is kept between calls to find_path() with the same start
+        self.start = None
+        self.target = None
+        self.reset()
+
+    def reset(self):
+        """Clear the search state"""
+        n = self.width * self.height
+        # G cost of the best route found so far to each tile
+        self.g = array.array("i", [0]) * n
+        # Tile number of the parent of each tile on that route
+        self.parents = array.array("i", [-1]) * n
+        self.state = bytearray(n)
+        # Open list, entries are (f, h, tile number)
+        self.heap = []
+        if self.bidirectional:
+            # The same again for the search back from the target, where parents are the
+            # next tile on the way to the target
+            self.back_g = array.array("i", [0]) * n
+            self.back_parents = array.array("i", [-1]) * n
+            self.back_state = bytearray(n)
+        # Number of nodes expanded by the search so far
+        self.expanded = 0
 
-    def get_lowest_f(self):
-        """Returns the tile(s) from the open list with the lowest F value, which should be considered next"""
-        debug("min of open list is: %s" % str(min(self.open.items(), key=lambda x: x[1][3])))
-        lowfs = [item[0] for item in self.open.items() if item[1] == min(self.open.values(), key=lambda x: x[3])]
-        debug("items equal to the min of open list: %s" % lowfs)
-        return lowfs
+    def find_uniform_blocked(self, costs):
+        """If every move in a CostGrid either costs the flat 10/14 or is impossible because
+        the tile moved to can't be entered from anywhere, returns those tiles as a bytearray
+        in the same form as blocked, otherwise (the costs vary) returns None"""
+        grid = costs.grid
+        h, w = grid.shape[:2]
+        # Tiles which can be moved into from at least one neighbour
+        reached = numpy.zeros((h, w), dtype=numpy.bool_)
+        slices = []
+        for k, (dx, dy, base) in enumerate(AStar.moves):
+            src = (slice(max(-dy, 0), h - max(dy, 0)), slice(max(-dx, 0), w - max(dx, 0)))
+            dst = (slice(max(dy, 0), h - max(-dy, 0)), slice(max(dx, 0), w - max(-dx, 0)))
+            slices.append((src, dst))
+            reached[dst] |= grid[src][:,:,k] >= 0
+        blocked = ~reached
+        # Costs there would be on a map with just those tiles blocked
+        expected = numpy.empty(grid.shape, dtype=numpy.int32)
+        expected.fill(-1)
+        for k, (dx, dy, base) in enumerate(AStar.moves):
+            src, dst = slices[k]
+            expected[src][:,:,k] = numpy.where(blocked[dst], -1, base)
+        if not numpy.array_equal(grid, expected):
+            return None
+        return bytearray(blocked.astype(numpy.uint8).tostring())
 
     def in_open_list(self, node):
         """Returns true if the node specified is on the open list"""
-        return self.open.has_key(node)
+        return self.state[node[1]*self.width + node[0]] == AStar.OPEN
 
     def in_closed_list(self, node):
         """Returns true if the node specified is on the closed list"""
-        return self.closed.has_key(node)
+        return self.state[node[1]*self.width + node[0]] == AStar.CLOSED
 
     def get_adjacent(self, node):
         """Finds adjacent nodes to the current node"""
-        debug("node is: %s" % str(node))
-        xmin = max(node[0]-1, 0)
-        xmax = min(node[0]+1, self.width)
-        ymin = max(node[1]-1, 0)
-        ymax = min(node[1]+1, self.height)
-
-        debug("xmin: %s, xmax: %s, ymin: %s, ymax: %s" % (xmin, xmax, ymin, ymax))
-        adjacencies = [(x,y) for x in range(xmin, xmax+1) for y in range(ymin, ymax+1) if self.map[y-1][x-1][1] != 1 and (x,y) != node]
-        debug("adjacencies: %s" % adjacencies)
-
+        adjacencies = []
+        for dx, dy, cost in self.moves:
+            x = node[0] + dx
+            y = node[1] + dy
+            if 0 <= x < self.width and 0 <= y < self.height and not self.blocked[y*self.width + x]:
+                adjacencies.append((x,y))
         return adjacencies
 
     def get_move_cost(self, node1, node2):
         """Returns the cost to move from node1 to node2"""
+        if self.costs:
+            return self.costs.get_cost(node1, node2)
         # If node1 x and node2 x are the same, or node1 y and node2 y are the same then cost is 10, else it's 14
         if node1[0] == node2[0] or node1[1] == node2[1]:
-            cost = 10
+            return 10
         else:
-            cost = 14
-        debug("Movement cost from %s to %s is: %s" % (node1, node2, cost))
-        return cost
+            return 14
 
     def heuristic(self, node, target):
         """Returns approximate cost to move from node to target"""
@@ -133,87 +223,765 @@ class AStar(object):
         xdistance = abs(node[0] - target[0])
         ydistance = abs(node[1] - target[1])
         if xdistance > ydistance:
-            H = 14*ydistance + 10*(xdistance-ydistance)
+            return 14*ydistance + 10*(xdistance-ydistance)
         else:
-            H = 14*xdistance + 10*(ydistance-xdistance)
-        debug("Heuristic distance from %s to %s calculated as: %s" % (node, target, H))
-        return H
+            return 14*xdistance + 10*(ydistance-xdistance)
 
+    def set_target(self, target):
+        """Change the target of an ongoing search
+        Costs of nodes already on the closed list are the best possible whatever the target
+        (the heuristic never overestimates), so only the open list needs updating"""
+        debug("Changing target from %s to %s" % (self.target, target))
+        width = self.width
+        heap = []
+        for f, h, n in self.heap:
+            # Skip entries which are out of date
+            if self.state[n] == AStar.OPEN and f - h == self.g[n]:
+                h = self.heuristic((n % width, n // width), target)
+                heap.append((self.g[n] + h, h, n))
+        heapq.heapify(heap)
+        self.heap = heap
+        self.target = target
+
+    def make_path(self, start, target):
+        """Follow chain of parent relations back from the target to the start
+        Parents found by jump point search can be several tiles away in a straight or
+        diagonal line, the tiles in between are filled in"""
+        width = self.width
+        s = start[1]*width + start[0]
+        n = target[1]*width + target[0]
+        x, y = target
+        path = [target]
+        while n != s:
+            # Add parent
+            n = self.parents[n]
+            px = n % width
+            py = n // width
+            dx = (px > x) - (px < x)
+            dy = (py > y) - (py < y)
+            while (x, y) != (px, py):
+                x += dx
+                y += dy
+                path.append((x, y))
+        debug("Path calculated as: %s" % path)
+        return path
 
     def find_path(self, start, target):
         """Implementation of the a* algorithm"""
         # This operates across the world, based on the start and end tile specified
 
-        # Not taking terrain into account, world is flat grid etc.
-
-        # Add start to open list
-        # (x, y): ((px, py), g, h, f)
-        debug("\nPathfinding start, adding: %s to open list as starting node, parent: %s, values: %s" % (start, start, (0,0,0)))
-        self.open[start] = (start, 0, 0, 0)
-
-        # Loop
-        done = False
-        while not done:
-            debug("self.open: %s" % self.open)
-            debug("self.closed: %s" % self.closed)
-
-            # For lowest F cost in open list:
-            lowf = self.get_lowest_f()[0]
-            debug("lowf is: %s" % str(lowf))
-
-            # Find neighbours, 8 tiles surrounding it
-            adj = self.get_adjacent(lowf)
-            debug("adj is: %s" % str(adj))
-
-            for a in adj:
-                # Check if each of these is in closed list, if so do nothing with it
-                if not self.in_closed_list(a):
-                    # If not in closed list, check if it's in the open list
-                    if not self.in_open_list(a):
-                        # If it is not in the open list, add it to the open list with this square as its parent
-                        # Cost to get here is cost to get to parent plus cost from parent to this node
-                        g = self.open[lowf][1] + self.get_move_cost(lowf, a)
-                        # Heuristic for this node to target
-                        h = self.heuristic(a, target)
-                        debug("Adding %s to open list with parent: %s and values: %s" % (a, lowf, (g,h,g+h)))
-                        self.open[a] = (lowf, g, h, g+h)
-                    # If it is in the open list, check if the path via the current square is better (compare G cost)
-                    else:
-                        g = self.open[lowf][1] + self.get_move_cost(lowf, a)
-                        if g < self.open[a][1]:
-                            # Path via this node is better, change parent to this node
-                            h = self.heuristic(a, target)
-                            debug("Changing parent of %s to: %s, new values: %s" % (a, lowf, (g,h,g+h)))
-                            self.open[a] = (lowf, g, h, g+h)
+        # Terrain is only taken into account if the search has a CostGrid
 
-            # Move current node from open to closed list
-            debug("Moving node: %s from open to closed list" % str(lowf))
-            self.closed[lowf] = self.open.pop(lowf)
+        if self.jump:
+            return self.find_jump_path(start, target)
+        if self.bidirectional:
+            return self.find_bidirectional_path(start, target)
 
-            # Check for completion, is target in closed list?
-            if self.closed.has_key(target):
-                debug("Completion test passed, target: %s is in closed list, calculating path..." % str(target))
-                done = True
-                path = [target]
-                part = target
-                # Follow chain of parent relations back to the start
-                while part != start:
-                    # Add parent
-                    part = self.closed[part][0]
-                    path.append(part)
-                debug("Path calculated as: %s" % path)
-                    
-            # Is the open list empty?
-            if len(self.open) == 0:
-                debug("Completion test passed, open list is empty, pathfinding failure")
-                done = True
-                path = None
+        width = self.width
+        height = self.height
+        if start != self.start:
+            # New search, add start to open list
+            debug("Pathfinding start, adding: %s to open list as starting node" % (start,))
+            self.reset()
+            s = start[1]*width + start[0]
+            self.state[s] = AStar.OPEN
+            self.heap = [(0, 0, s)]
+            self.start = start
+            self.target = target
+        elif target != self.target:
+            # Same start, carry on the existing search towards the new target
+            self.set_target(target)
+
+        t = target[1]*width + target[0]
+        # Target may already have been reached by an earlier search
+        if self.state[t] == AStar.CLOSED:
+            return self.make_path(start, target)
+
+        # Local names for everything used in the loop
+        heap = self.heap
+        g = self.g
+        parents = self.parents
+        state = self.state
+        blocked = self.blocked
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        moves = [(k, dx, dy, dy*width + dx, cost) for k, (dx, dy, cost) in enumerate(self.moves)]
+        # Cost of each move out of each tile, tile number * 8 + move
+        costs = None
+        if self.costs:
+            costs = self.costs.data
+        tx, ty = target
+        OPEN = AStar.OPEN
+        CLOSED = AStar.CLOSED
+        expanded = 0
 
         # Stop when target square is added to the closed list = route
         # Stop when open list is empty and the target square has not been found = no route
+        path = None
+        while heap:
+            # Node with the lowest F cost in open list
+            f, h, n = heappop(heap)
+            gn = g[n]
+            # Lazy deletion, entries for nodes already closed or since reached more cheaply are skipped
+            if state[n] == CLOSED or f - h != gn:
+                continue
+            state[n] = CLOSED
+            expanded += 1
+            x = n % width
+            y = n // width
+            for k, dx, dy, d, cost in moves:
+                ax = x + dx
+                ay = y + dy
+                if ax < 0 or ay < 0 or ax >= width or ay >= height:
+                    continue
+                a = n + d
+                if blocked[a] or state[a] == CLOSED:
+                    continue
+                if costs:
+                    cost = costs[n*8 + k]
+                    # Move isn't possible
+                    if cost < 0:
+                        continue
+                ga = gn + cost
+                # Add to the open list, or update it if the path via this node is better
+                if state[a] != OPEN or ga < g[a]:
+                    g[a] = ga
+                    parents[a] = n
+                    state[a] = OPEN
+                    # Heuristic for this node to target
+                    hx = abs(ax - tx)
+                    hy = abs(ay - ty)
+                    if hx > hy:
+                        ha = 14*hy + 10*(hx-hy)
+                    else:
+                        ha = 14*hx + 10*(hy-hx)
+                    heappush(heap, (ga + ha, ha, a))
+            # Check for completion, is target in closed list?
+            if n == t:
+                path = self.make_path(start, target)
+                break
+        self.expanded += expanded
+        if path is None:
+            debug("Completion test passed, open list is empty, pathfinding failure")
         return path
+
+    def find_jump_path(self, start, target):
+        """Jump Point Search, for grids where every move costs the flat 10/14
+        Jump points found depend on the target, so the search is only kept between
+        calls with the same start and target"""
+        width = self.width
+        if start == self.start and target == self.target:
+            t = target[1]*width + target[0]
+            if self.state[t] == AStar.CLOSED:
+                return self.make_path(start, target)
+            return None
+        debug("Jump point search start, adding: %s to open list as starting node" % (start,))
+        self.reset()
+        self.start = start
+        self.target = target
+        s = start[1]*width + start[0]
+        t = target[1]*width + target[0]
+        self.state[s] = AStar.OPEN
+        heap = [(0, 0, s)]
+        g = self.g
+        parents = self.parents
+        state = self.state
+        blocked = self.blocked
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        tx, ty = target
+        OPEN = AStar.OPEN
+        CLOSED = AStar.CLOSED
+        expanded = 0
+
+        path = None
+        while heap:
+            f, h, n = heappop(heap)
+            gn = g[n]
+            if state[n] == CLOSED or f - h != gn:
+                continue
+            state[n] = CLOSED
+            expanded += 1
+            if n == t:
+                path = self.make_path(start, target)
+                break
+            x = n % width
+            y = n // width
+            for dx, dy in self.get_directions(x, y, parents[n]):
+                jp = self.jump_from(x, y, dx, dy)
+                if jp is None:
+                    continue
+                ax, ay = jp
+                a = ay*width + ax
+                if state[a] == CLOSED:
+                    continue
+                # Jumps are in a straight or diagonal line
+                steps = max(abs(ax - x), abs(ay - y))
+                if dx and dy:
+                    ga = gn + 14*steps
+                else:
+                    ga = gn + 10*steps
+                if state[a] != OPEN or ga < g[a]:
+                    g[a] = ga
+                    parents[a] = n
+                    state[a] = OPEN
+                    hx = abs(ax - tx)
+                    hy = abs(ay - ty)
+                    if hx > hy:
+                        ha = 14*hy + 10*(hx-hy)
+                    else:
+                        ha = 14*hx + 10*(hy-hx)
+                    heappush(heap, (ga + ha, ha, a))
+        self.heap = heap
+        self.expanded += expanded
+        if path is None:
+            debug("Completion test passed, open list is empty, pathfinding failure")
+        return path
+
+    def find_bidirectional_path(self, start, target):
+        """A* from the start towards the target and from the target back towards the start
+        at the same time, expanding whichever side has the shorter open list
+        Each side estimates the rest of the way to its own goal with the same octile
+        heuristic as find_path(), so neither side can find anything cheaper once the lowest
+        F on its open list is as much as the best route found where the two sides have met,
+        and the search stops as soon as that's true of either side. Of tiles with the same F
+        the search from the start takes the one furthest along first, like find_path(), so
+        it goes diagonally and then straight. The search back takes the one the most moves
+        along and then the cheapest, so it goes straight and then diagonally, along the same
+        route, and the two meet as soon as they can
+        Moves for the search back from the target are taken in reverse, so costs which
+        differ each way (e.g. climbing and descending) are handled"""
+        width = self.width
+        height = self.height
+        self.reset()
+        self.start = start
+        self.target = target
+        s = start[1]*width + start[0]
+        t = target[1]*width + target[0]
+        blocked = self.blocked
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        OPEN = AStar.OPEN
+        CLOSED = AStar.CLOSED
+        costs = None
+        if self.costs:
+            costs = self.costs.data
+        moves = [(k, dx, dy, dy*width + dx, cost) for k, (dx, dy, cost) in enumerate(self.moves)]
+        # Each side is (g, parents, state, open list, 1 forwards or -1 backwards, the side's
+        # goal), open list entries are (F, tie break, G, tile number), the tie break is -G
+        # forwards and minus the number of moves from the target backwards
+        h = self.heuristic(start, target)
+        forward = [self.g, self.parents, self.state, [(h, 0, 0, s)], 1, target]
+        back = [self.back_g, self.back_parents, self.back_state, [(h, 0, 0, t)], -1, start]
+        self.state[s] = OPEN
+        self.back_state[t] = OPEN
+        # Cost of the best route found so far, and the tile where its two halves meet
+        best = sys.maxint
+        meet = -1
+        if s == t:
+            best = 0
+            meet = s
+        expanded = 0
+        while True:
+            # Drop out of date entries from the tops of both open lists
+            for g, parents, state, heap, direction, goal in (forward, back):
+                while heap and (state[heap[0][3]] == CLOSED or heap[0][2] != g[heap[0][3]]):
+                    heappop(heap)
+            if not forward[3] or not back[3]:
+                break
+            # Every route still to be found from one side costs at least its lowest F
+            if forward[3][0][0] >= best or back[3][0][0] >= best:
+                break
+            if len(forward[3]) <= len(back[3]):
+                side, other = forward, back
+            else:
+                side, other = back, forward
+            g, parents, state, heap, direction, goal = side
+            gx, gy = goal
+            other_g = other[0]
+            other_state = other[2]
+            f, tie, gn, n = heappop(heap)
+            state[n] = CLOSED
+            # Routes through a tile the other side has finished with were counted when the
+            # two sides met there, so there's nothing to gain by going on from it
+            if other_state[n] == CLOSED:
+                continue
+            expanded += 1
+            x = n % width
+            y = n // width
+            for k, dx, dy, d, cost in moves:
+                # Backwards, move k is taken from the neighbour into this tile
+                if direction < 0:
+                    dx = -dx
+                    dy = -dy
+                    d = -d
+                ax = x + dx
+                ay = y + dy
+                if ax < 0 or ay < 0 or ax >= width or ay >= height:
+                    continue
+                a = n + d
+                if state[a] == CLOSED:
+                    continue
+                if direction > 0:
+                    if blocked[a]:
+                        continue
+                    if costs:
+                        cost = costs[n*8 + k]
+                else:
+                    # Going forwards the start can be a blocked tile, but no other
+                    if blocked[n] or (blocked[a] and a != s):
+                        continue
+                    if costs:
+                        cost = costs[a*8 + k]
+                if cost < 0:
+                    continue
+                ga = gn + cost
+                if state[a] != OPEN or ga < g[a]:
+                    g[a] = ga
+                    parents[a] = n
+                    state[a] = OPEN
+                    # Estimate to this side's goal
+                    hx = abs(ax - gx)
+                    hy = abs(ay - gy)
+                    if hx > hy:
+                        ha = 14*hy + 10*(hx-hy)
+                    else:
+                        ha = 14*hx + 10*(hy-hx)
+                    # Reached from the other side too
+                    if other_state[a] and ga + other_g[a] < best:
+                        best = ga + other_g[a]
+                        meet = a
+                    # Tiles which can't be on a better route than the best one are never expanded
+                    if ga + ha < best:
+                        if direction > 0:
+                            heappush(heap, (ga + ha, -ga, ga, a))
+                        else:
+                            heappush(heap, (ga + ha, tie - 1, ga, a))
+        self.expanded += expanded
+        if meet < 0:
+            debug("Completion test passed, open lists are empty, pathfinding failure")
+            return None
+        # Route from the meeting tile back to the start, then on from it to the target
+        path = []
+        n = meet
+        while n != t:
+            n = self.back_parents[n]
+            path.append((n % width, n // width))
+        path.reverse()
+        n = meet
+        path.append((n % width, n // width))
+        while n != s:
+            n = self.parents[n]
+            path.append((n % width, n // width))
+        self.g[t] = best
+        debug("Path calculated as: %s" % path)
+        return path
+
+    def is_open(self, x, y):
+        """Returns true if the tile is on the map and can be crossed"""
+        return 0 <= x < self.width and 0 <= y < self.height and not self.blocked[y*self.width + x]
+
+    def get_directions(self, x, y, parent):
+        """Directions worth jumping in from a tile reached from parent (tile number, -1 for
+        the start), these are straight on plus any turns forced by blocked tiles alongside,
+        every other neighbour can be reached at least as cheaply without going through here"""
+        if parent < 0:
+            return [(dx, dy) for dx, dy, cost in self.moves]
+        px = parent % self.width
+        py = parent // self.width
+        dx = (x > px) - (x < px)
+        dy = (y > py) - (y < py)
+        is_open = self.is_open
+        if dx and dy:
+            directions = [(dx, 0), (0, dy), (dx, dy)]
+            # Blocked tiles beside the diagonal force turns back across it
+            if not is_open(x - dx, y) and is_open(x - dx, y + dy):
+                directions.append((-dx, dy))
+            if not is_open(x, y - dy) and is_open(x + dx, y - dy):
+                directions.append((dx, -dy))
+        elif dx:
+            directions = [(dx, 0)]
+            for side in (-1, 1):
+                if not is_open(x, y + side) and is_open(x + dx, y + side):
+                    directions.append((dx, side))
+        else:
+            directions = [(0, dy)]
+            for side in (-1, 1):
+                if not is_open(x + side, y) and is_open(x + side, y + dy):
+                    directions.append((side, dy))
+        return directions
+
+    def jump_from(self, x, y, dx, dy):
+        """Move from (x,y) in direction (dx,dy) until reaching the target or a jump point,
+        returns it, or None if a blocked tile or the edge of the map is reached first"""
+        tx, ty = self.target
+        if dx and dy:
+            is_open = self.is_open
+            while True:
+                x += dx
+                y += dy
+                if not is_open(x, y):
+                    return None
+                if x == tx and y == ty:
+                    return (x, y)
+                # Turns forced by blocked tiles beside the diagonal
+                if (not is_open(x - dx, y) and is_open(x - dx, y + dy)) or \
+                   (not is_open(x, y - dy) and is_open(x + dx, y - dy)):
+                    return (x, y)
+                # Tiles which are jump points along the straight lines from here
+                if self.scan(self.blocked, self.width, self.height, y, x, dx, ty == y and tx) is not None or \
+                   self.scan(self.blocked_columns, self.height, self.width, x, y, dy, tx == x and ty) is not None:
+                    return (x, y)
+        elif dx:
+            p = self.scan(self.blocked, self.width, self.height, y, x, dx, ty == y and tx)
+            if p is not None:
+                return (p, y)
+        else:
+            p = self.scan(self.blocked_columns, self.height, self.width, x, y, dy, tx == x and ty)
+            if p is not None:
+                return (x, p)
+        return None
+
+    def scan(self, cells, length, lines, line, position, direction, target):
+        """Scan a line of tiles for the next jump point in a straight line
+        cells holds lines of tiles one after another (rows of blocked, or columns of
+        blocked_columns), length is the number of tiles in each line
+        Returns the position along the line of the target (if it's on this line, otherwise
+        target is False) or of the first tile with a blocked tile beside it and an open
+        tile diagonally ahead (a forced turn), or None if a blocked tile comes first
+        Searching the bytearray does the scanning a line at a time rather than tile by tile"""
+        base = line * length
+        if direction > 0:
+            # Tiles which can be reached are up to the first blocked tile
+            end = cells.find(BLOCKED_BYTE, base + position + 1, base + length)
+            if end < 0:
+                end = length
+            else:
+                end -= base
+            best = None
+            if target is not False and position < target < end:
+                best = target
+            for side in (line - 1, line + 1):
+                if side < 0 or side >= lines:
+                    continue
+                sbase = side * length
+                # First tile of a run of blocked tiles beside the line, the turn is
+                # forced at the last tile of the run, where the next tile is open
+                b = cells.find(BLOCKED_BYTE, sbase + position + 1, sbase + end)
+                if b < 0:
+                    continue
+                o = cells.find(OPEN_BYTE, b, sbase + length)
+                if o < 0:
+                    continue
+                p = o - 1 - sbase
+                if p < end and (best is None or p < best):
+                    best = p
+            return best
+        else:
+            end = cells.rfind(BLOCKED_BYTE, base, base + position)
+            if end < 0:
+                end = -1
+            else:
+                end -= base
+            best = None
+            if target is not False and end < target < position:
+                best = target
+            for side in (line - 1, line + 1):
+                if side < 0 or side >= lines:
+                    continue
+                sbase = side * length
+                b = cells.rfind(BLOCKED_BYTE, sbase + end + 1, sbase + position)
+                if b < 0:
+                    continue
+                o = cells.rfind(OPEN_BYTE, sbase, b)
+                if o < 0:
+                    continue
+                p = o + 1 - sbase
+                if p > end and (best is None or p > best):
+                    best = p
+            return best
         
 
+class CostGrid(object):
+    """Cost of moving between each pair of neighbouring tiles, worked out from the World's terrain
+    Costs are in a flat array, the cost of move k (in the order of AStar.moves) out of the tile
+    at (x, y) is at (y * width + x) * 8 + k, with -1 for moves which aren't possible
+    The same memory is available as a NumPy array of shape (height, width, 8) in grid
+    Moves never cost less than on flat ground so that AStar's heuristic stays admissible"""
+    # Tiles whose highest and lowest vertices differ by more than this can't be crossed
+    max_slope = 1
+    # Extra cost for every quarter of a height level climbed or descended between tile middles
+    climb_cost = 5
+    descent_cost = 1
+    # Changed tiles are grouped into square blocks this many tiles across when refreshing,
+    # the costs around the changes in each block are worked out separately
+    refresh_block = 16
+    # For each move in AStar.moves, pairs of vertex indices (this tile, the neighbour) which are
+    # the same point, if their heights differ there's a cliff between the tiles
+    # Vertices are [left, bottom, right, top]
+    shared_vertices = [[(3,1)], [(3,2),(0,1)], [(0,2)],
+                       [(3,0),(2,1)],          [(0,3),(1,2)],
+                       [(2,0)], [(2,3),(1,0)], [(1,3)]]
+    def __init__(self):
+        """Work out the costs for the whole World"""
+        self.width = World.WorldX
+        self.height = World.WorldY
+        self.data = array.array("i", [-1]) * (self.width * self.height * 8)
+        self.grid = numpy.frombuffer(self.data, dtype=numpy.int32).reshape(self.height, self.width, 8)
+        # Tiles changed since the costs were last worked out
+        self.changed = World.watch()
+        self.changed.clear()
+        self.update_area(0, 0, self.width, self.height)
+
+    def get_cost(self, node1, node2):
+        """Returns the cost to move from node1 to neighbouring node2, or -1 if it isn't possible"""
+        k = [(dx, dy) for dx, dy, c in AStar.moves].index((node2[0] - node1[0], node2[1] - node1[1]))
+        return self.data[(node1[1]*self.width + node1[0])*8 + k]
+
+    def get_costs(self, x0, y0, x1, y1):
+        """Returns the costs of moves out of tiles from (x0,y0) up to but not including (x1,y1),
+        as an array of shape (y1 - y0, x1 - x0, 8)"""
+        return self.grid[y0:y1,x0:x1]
+
+    def watch(self):
+        """Returns a set which every tile that changes from now on is added to (see World.watch())"""
+        return World.watch()
+
+    def get_model(self):
+        """Returns a description of how costs are worked out, routes found with the same
+        description over the same terrain cost the same"""
+        return ("terrain", self.max_slope, self.climb_cost, self.descent_cost)
+
+    def refresh(self):
+        """Update the costs around any tiles which have changed since the last refresh
+        Returns True if anything changed"""
+        if not self.changed:
+            return False
+        # Area covered by the changed tiles in each block, as [x0, y0, x1, y1]
+        areas = {}
+        size = self.refresh_block
+        for x, y in self.changed:
+            key = (x / size, y / size)
+            if areas.has_key(key):
+                area = areas[key]
+                area[0] = min(area[0], x)
+                area[1] = min(area[1], y)
+                area[2] = max(area[2], x + 1)
+                area[3] = max(area[3], y + 1)
+            else:
+                areas[key] = [x, y, x + 1, y + 1]
+        self.changed.clear()
+        for x0, y0, x1, y1 in areas.values():
+            # Moves into and out of the changed tiles, so their neighbours need updating too
+            self.update_area(max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, self.width), min(y1 + 1, self.height))
+        return True
+
+    def update_area(self, x0, y0, x1, y1):
+        """Work out the costs of moves out of tiles from (x0,y0) up to but not including (x1,y1)"""
+        # Heights of those tiles plus a border of one tile, which the moves can go to
+        bx0 = max(x0 - 1, 0)
+        by0 = max(y0 - 1, 0)
+        v = World.get_vertex_heights(bx0, by0, min(x1 + 1, self.width), min(y1 + 1, self.height))
+        costs = self.find_costs(v)
+        self.grid[y0:y1,x0:x1] = costs[x0-bx0:x1-bx0,y0-by0:y1-by0].transpose(1,0,2)
+
+    def find_costs(self, v):
+        """Returns the costs of every move out of every tile in a (x, y, 4) array of vertex heights,
+        as an array of shape (x, y, 8), moves off the edge of the array cost -1"""
+        wx, wy = v.shape[:2]
+        costs = numpy.empty((wx, wy, 8), dtype=numpy.int32)
+        costs.fill(-1)
+        passable = (v.max(axis=2) - v.min(axis=2)) <= self.max_slope
+        # Height of each tile's middle, in quarter levels
+        middle = v.sum(axis=2)
+        for k, (dx, dy, base) in enumerate(AStar.moves):
+            # Tiles which have a neighbour in this direction, and those neighbours
+            src = (slice(max(-dx, 0), wx - max(dx, 0)), slice(max(-dy, 0), wy - max(dy, 0)))
+            dst = (slice(max(dx, 0), wx - max(-dx, 0)), slice(max(dy, 0), wy - max(-dy, 0)))
+            ok = passable[src] & passable[dst]
+            for i, j in self.shared_vertices[k]:
+                ok &= v[src][:,:,i] == v[dst][:,:,j]
+            rise = middle[dst] - middle[src]
+            cost = base + self.climb_cost * numpy.maximum(rise, 0) + self.descent_cost * numpy.maximum(-rise, 0)
+            costs[src][:,:,k] = numpy.where(ok, cost, -1)
+        return costs
+
+
+class MapGrid(object):
+    """Grid of open and blocked tiles where every move costs the flat 10/14, for searching
+    maps which don't come from the World. Has the same get_costs(), watch() and refresh()
+    as CostGrid, but only keeps one byte per tile so it can be used for very large maps"""
+    def __init__(self, blocked):
+        """blocked is a NumPy array of shape (height, width) which is True for tiles that can't
+        be crossed, or a map in the form taken by AStar"""
+        if isinstance(blocked, list):
+            blocked = [[tile[1] == 1 for tile in line] for line in blocked]
+        self.blocked = numpy.array(blocked, dtype=numpy.bool_)
+        self.height, self.width = self.blocked.shape
+        # Sets of tiles changed by set_blocked(), one for each user of watch(), keyed by id()
+        # and weakly held as for World.watch()
+        self.watchers = weakref.WeakValueDictionary()
+
+    def watch(self):
+        """Returns a set which every tile changed from now on is added to"""
+        w = world.Changes()
+        self.watchers[id(w)] = w
+        return w
+
+    def get_model(self):
+        """Returns a description of how costs are worked out (see CostGrid.get_model())"""
+        return ("map",)
+
+    def set_blocked(self, tile, blocked=True):
+        """Block or unblock a tile"""
+        x, y = tile
+        self.blocked[y,x] = blocked
+        for w in self.watchers.values():
+            w.add((x,y))
+
+    def refresh(self):
+        """Costs are worked out when asked for, so there's never anything to refresh"""
+        return False
+
+    def get_costs(self, x0, y0, x1, y1):
+        """Returns the costs of moves out of tiles from (x0,y0) up to but not including (x1,y1),
+        as an array of shape (y1 - y0, x1 - x0, 8), moves into blocked tiles or off the map cost -1"""
+        # Blocked tiles with a border of one tile, tiles off the map count as blocked
+        padded = numpy.ones((y1 - y0 + 2, x1 - x0 + 2), dtype=numpy.bool_)
+        by0 = max(y0 - 1, 0)
+        bx0 = max(x0 - 1, 0)
+        by1 = min(y1 + 1, self.height)
+        bx1 = min(x1 + 1, self.width)
+        padded[by0-y0+1:by1-y0+1,bx0-x0+1:bx1-x0+1] = self.blocked[by0:by1,bx0:bx1]
+        h = y1 - y0
+        w = x1 - x0
+        costs = numpy.empty((h, w, 8), dtype=numpy.int32)
+        for k, (dx, dy, base) in enumerate(AStar.moves):
+            costs[:,:,k] = numpy.where(padded[1+dy:1+dy+h,1+dx:1+dx+w], -1, base)
+        return costs
+
+
+class TrackRouter(object):
+    """Routes track between endpoint positions across many tiles
+    Nodes are (x, y, point) where track enters tile (x,y) at one of its 8 endpoint
+    positions (see World.endpoint_neighbours). Track through a tile can go straight
+    across it or curve by 45 degrees, and leaves it into the tile which meets it there
+    The search is kept between calls to route(), so as the target moves (e.g. while
+    dragging) only the part of the graph not already searched is explored"""
+    # Extra cost of a curve over its length, so straight track is preferred
+    curve_cost = 0.1
+    # Maximum number of nodes to expand per call to route()
+    max_expansions = 20000
+    # Position of each endpoint position in the tile, in tile vertex grid units
+    # (top vertex at (0,0), right vertex (0,1), left vertex (1,0))
+    positions = [(0,0.5), (0,1), (0.5,1), (1,1), (1,0.5), (1,0), (0.5,0), (0,0)]
+
+    def __init__(self, start):
+        """start is the (x, y, point) the track starts from"""
+        self.start = start
+        self.target = None
+        # Cost of the best route so far to each node, and the node before it on that route
+        self.g = {start: 0}
+        self.parents = {start: None}
+        self.closed = {}
+        # Open list is a heap of [f, g, node], node is None for the end of the route
+        self.open = [[0, 0, start]]
+        self.end = None
+
+    def get_exits(self, point):
+        """Positions track entering at point can leave the tile by, and the cost of each"""
+        exits = []
+        for turn in [3, 4, 5]:
+            out = (point + turn) % 8
+            cost = self.distance(self.positions[point], self.positions[out])
+            if turn != 4:
+                cost += self.curve_cost
+            exits.append((out, cost))
+        return exits
+
+    def distance(self, a, b):
+        """Straight line distance between two positions"""
+        return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+
+    def heuristic(self, node):
+        """Returns the straight line distance from a node to the target"""
+        x, y, point = node
+        tx, ty, tpoint = self.target
+        return self.distance((x + self.positions[point][0], y + self.positions[point][1]),
+                             (tx + self.positions[tpoint][0], ty + self.positions[tpoint][1]))
+
+    def set_target(self, target):
+        """Change the target, re-ordering the open list for the new heuristic
+        Nodes already closed keep their costs, these are optimal whatever the target"""
+        self.target = target
+        self.end = None
+        open = []
+        for entry in self.open:
+            f, g, node = entry[:3]
+            # Drop stale entries and ends of routes to the old target
+            if node is not None and not self.closed.has_key(node) and g == self.g[node]:
+                open.append([g + self.heuristic(node), g, node])
+        heapq.heapify(open)
+        self.open = open
+        # Closed nodes in the target tile may already finish a route
+        x, y, point = target
+        for n in range(8):
+            if self.closed.has_key((x, y, n)):
+                self.push_end((x, y, n))
+
+    def push_end(self, node):
+        """If the target can be reached from a node, add the end of the route to the open list"""
+        for out, cost in self.get_exits(node[2]):
+            if out == self.target[2]:
+                g = self.g[node] + cost
+                heapq.heappush(self.open, [g, g, None, node])
+
+    def route(self, target):
+        """Find the best route to track leaving tile (x,y) at point, target is (x, y, point)
+        Returns a list of [(x,y), in point, out point] for each tile along the route, or
+        None if there's no route (or it hasn't been found yet, calling again continues)"""
+        if target != self.target:
+            self.set_target(target)
+        if self.end:
+            return self.end
+        expansions = 0
+        while self.open and expansions < self.max_expansions:
+            entry = heapq.heappop(self.open)
+            f, g, node = entry[:3]
+            if node is None:
+                # The end of a route is the cheapest thing left, so this is the best route
+                self.end = self.make_route(entry[3])
+                return self.end
+            if self.closed.has_key(node) or g != self.g[node]:
+                continue
+            self.closed[node] = True
+            expansions += 1
+            x, y, point = node
+            if (x, y) == target[:2]:
+                self.push_end(node)
+            for out, cost in self.get_exits(point):
+                next = World.get_endpoint_neighbour(x, y, out)
+                if next is None or self.closed.has_key(next):
+                    continue
+                ng = g + cost
+                if not self.g.has_key(next) or ng < self.g[next]:
+                    self.g[next] = ng
+                    self.parents[next] = node
+                    heapq.heappush(self.open, [ng + self.heuristic(next), ng, next])
+        return None
+
+    def make_route(self, node):
+        """Follow the chain of parents back from the last node to make a route"""
+        route = [[node[:2], node[2], self.target[2]]]
+        while self.parents[node] is not None:
+            parent = self.parents[node]
+            # Track left the parent's tile at the position which meets this node
+            route.append([parent[:2], parent[2], World.endpoint_neighbours[node[2]][2]])
+            node = parent
+        route.reverse()
+        return route
+
+
 if __name__ == "__main__":
 
     map = []
@@ -228,9 +996,11 @@ if __name__ == "__main__":
 
     debug("map is: %s" % map)
 
-    p = AStar(map)
+    # Add "jump" or "bidirectional" after the start and target to use jump point search
+    # or search from both ends
+    p = AStar(map, jump="jump" in sys.argv, bidirectional="bidirectional" in sys.argv)
 
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 4:
         start = (int(sys.argv[1]), int(sys.argv[2]))
         target = (int(sys.argv[3]), int(sys.argv[4]))
     else:
@@ -240,23 +1010,24 @@ if __name__ == "__main__":
     path = p.find_path(start,target)
     if path is None:
         path = []
+    print "Nodes expanded: %s" % p.expanded
 
     # Map is a 50x50 grid, print out results
-    for y in range(1,51):
+    for y in range(50):
         line = ""
-        for x in range(1,51):
+        for x in range(50):
             if (x,y) == start:
                 line = line + "S "
             elif (x,y) == target:
                 line = line + "T "
             elif (x,y) in path:
                 line = line + "0 "
-            elif (x,y) in p.closed:
+            elif p.in_closed_list((x,y)):
                 line = line + "- "
-            elif (x,y) in p.open:
+            elif p.in_open_list((x,y)):
                 line = line + "+ "
             else:
-                if map[y-1][x-1][1] == 1:
+                if map[y][x][1] == 1:
                     line = line + "X "
                 else:
                     line = line + ". "
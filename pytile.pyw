@@ -44,9 +44,11 @@
 
 
 
-import os, sys, operator
+import os, sys, operator, time
+import optparse
 import pygame
 import random, math
+import numpy
 from copy import copy, deepcopy
 
 import logger
@@ -59,6 +61,7 @@ import bezier
 from vec2d import *
 
 import tools
+import replay
 
 
 # Some useful colours
@@ -78,16 +81,9 @@ yellow = (255,255,0)
 
 transparent = (231,255,255)
 
-# Pre-compute often used multiples
-p = 64
-p2 = p / 2
-p4 = p / 4
-p4x3 = p4 * 3
-p8 = p / 8
-p16 = p / 16
-
-#tile height difference
-ph = 8
+# Often used multiples of the full size tile, these are defined in world.py
+# Sizes at the current zoom level are available from World (e.g. World.p)
+from world import p, p2, p4, p4x3, p8, p16, ph
 
 FPS_REFRESH = 500
 WINDOW_WIDTH = 800
@@ -158,8 +154,27 @@ class TrackSprite(pygame.sprite.Sprite):
     init = True
     image = None
     cache = {}
+    # Finished tile images, keyed by own paths plus overlapping neighbour paths
+    composite_cache = {}
+    # Both caches are kept separately for each zoom level and level of detail,
+    # keyed by (zoom, detail)
+    detail_caches = {}
+    zoom = None
+    detail = None
     bezier = None
     TILE_SIZE = p
+    # Level of detail policy, see choose_detail()
+    # Smallest tile size (in pixels) at which each layer is still drawn
+    lod_layers = [("ballast", 0),
+                  ("sleepers", 32),
+                  ("rails", 0),
+                  ]
+    # Below this tile size rails are drawn as a single line down the middle of the track
+    lod_single_rail = 16
+    # Each of these numbers of visible track tiles that is exceeded halves curve sampling
+    lod_density = [150, 400]
+    # Number of track tiles in view, set by whatever is painting the screen
+    visible_tracks = 0
     props = {
              "track_width": 0.05,           # Relative to tile size
              "track_spacing": 2.5,
@@ -186,11 +201,9 @@ class TrackSprite(pygame.sprite.Sprite):
             TrackSprite.bezier = bezier.Bezier()
             tex = pygame.image.load("ballast_texture.png")
             TrackSprite.ballast_texture = tex.convert()
-            TrackSprite.size = TrackSprite.TILE_SIZE
-            TrackSprite.bezier_steps = 30
-            self.update_dimensions()
-            self.gen_box()
-            TrackSprite.tilemask = self.make_mask()
+        detail = self.choose_detail(World.p, TrackSprite.visible_tracks)
+        if TrackSprite.zoom != World.zoom or TrackSprite.detail != detail:
+            self.set_detail(World.zoom, detail)
         self.xWorld = xWorld
         self.yWorld = yWorld
         self.zWorld = zWorld
@@ -206,30 +219,62 @@ class TrackSprite(pygame.sprite.Sprite):
             self.update_neighbour_paths()
         else:
             self.neighbour_paths = init_neighbour_paths
-        # Bottom-most layer first
-        self.layer_profiles = [
-                               {"name": "ballast",
-                                "render": self.map_ballast_texture,
-                                "function": self.draw_ballast_mask,
-                                },
-                               {"name": "sleepers",
-                                "render": False,
-                                "function": self.draw_sleepers,
-                                },
-                               {"name": "rails",
-                                "render": False,
-                                "function": self.draw_rails,
-                                },
-                              ]
+        # Bottom-most layer first, only layers drawn at this level of detail are used
+        layer_profiles = [
+                          {"name": "ballast",
+                           "render": self.map_ballast_texture,
+                           "function": self.draw_ballast_mask,
+                           },
+                          {"name": "sleepers",
+                           "render": False,
+                           "function": self.draw_sleepers,
+                           },
+                          {"name": "rails",
+                           "render": False,
+                           "function": self.draw_rails,
+                           },
+                         ]
+        self.layer_profiles = [l for l in layer_profiles if l["name"] in TrackSprite.layers]
         self.update()
 
+    def choose_detail(self, size, visible_tracks):
+        """Return the level of detail to draw track at, for a tile size in
+        pixels and a number of track tiles in view
+        Detail is (names of layers to draw, single rail, bezier steps)"""
+        layers = tuple([name for name, min_size in TrackSprite.lod_layers if size >= min_size])
+        single_rail = size < TrackSprite.lod_single_rail
+        # Smaller tiles need fewer steps along each curve to look smooth
+        steps = 30 * size / TrackSprite.TILE_SIZE
+        # Busy views get coarser curves still
+        for threshold in TrackSprite.lod_density:
+            if visible_tracks > threshold:
+                steps /= 2
+        return (layers, single_rail, max(steps, 4))
+
+    def set_detail(self, zoom, detail):
+        """Switch track drawing to the tile size of a zoom level and a level
+        of detail produced by choose_detail()"""
+        TrackSprite.zoom = zoom
+        TrackSprite.detail = detail
+        TrackSprite.size = world.ZOOM_LEVELS[zoom]
+        TrackSprite.layers, TrackSprite.single_rail, TrackSprite.bezier_steps = detail
+        self.update_dimensions()
+        self.gen_box()
+        TrackSprite.tilemask = self.make_mask()
+        if not TrackSprite.detail_caches.has_key((zoom, detail)):
+            TrackSprite.detail_caches[(zoom, detail)] = ({}, {})
+        TrackSprite.cache, TrackSprite.composite_cache = TrackSprite.detail_caches[(zoom, detail)]
+
     def make_mask(self):
         """Make a mask image ready for combination with the output image"""
+        s = self.size
+        s2 = s / 2
+        s4 = s / 4
         # Generate a new surface to draw onto
-        surface = pygame.Surface((p, p))
+        surface = pygame.Surface((s, s))
         # Fill surface with transparent colour
         surface.fill(transparent)
-        pointlist = [(p2,p),(0,p4+p2),(p2-1,p2+1),(p2,p2+1),(p-1,p4+p2),(p2,p-1)] 
+        pointlist = [(s2,s),(0,s4+s2),(s2-1,s2+1),(s2,s2+1),(s-1,s4+s2),(s2,s-1)] 
         # Draw the mask in black, transparent background, but this image has its
         # transparency set to black. When blitted over another image the black
         # part won't be drawn, but the transparent colour part will
@@ -281,6 +326,10 @@ class TrackSprite(pygame.sprite.Sprite):
         """Change one of the dimension values, lookup is by key number"""
         TrackSprite.props[TrackSprite.props_lookup[key]] = value
         self.update_dimensions()
+        # Cached images were drawn with the old dimensions
+        TrackSprite.detail_caches = {}
+        TrackSprite.detail_caches[(TrackSprite.zoom, TrackSprite.detail)] = ({}, {})
+        TrackSprite.cache, TrackSprite.composite_cache = TrackSprite.detail_caches[(TrackSprite.zoom, TrackSprite.detail)]
         return True
     def update_dimensions(self):
         """Calculate actual dimensions for drawing track from the multiplier values"""
@@ -314,6 +363,29 @@ class TrackSprite(pygame.sprite.Sprite):
         print self.xWorld, self.yWorld, self.paths, self.neighbour_paths
     def update(self):
         """Draw image and return nothing"""
+        # The finished image only depends on this tile's paths and on those paths of
+        # its neighbours which overlap it, so try to look the whole thing up first
+        outs = World.get_4_overlap_paths(self.neighbour_paths)
+        key = self.make_composite_key(self.paths, outs)
+        if TrackSprite.composite_cache.has_key(key):
+            self.image = TrackSprite.composite_cache[key]
+        else:
+            debug("Compositing track image for key: %s" % str(key))
+            self.image = self.composite_image(self.paths, outs)
+            TrackSprite.composite_cache[key] = self.image
+        self.calc_rect()
+
+    def make_composite_key(self, paths, overlap_paths):
+        """Make a key for the composite cache from this tile's paths and the
+        paths of its 4 neighbours which overlap it"""
+        neighbour_keys = []
+        for out in overlap_paths:
+            neighbour_keys.append(self.make_cache_key(out))
+        return (self.make_cache_key(paths), tuple(neighbour_keys))
+
+    def composite_image(self, paths, overlap_paths):
+        """Composite the layer images for this tile and its overlapping neighbours
+        into a single surface"""
         # Generate a new surface to draw onto
         surface = pygame.Surface((self.size, self.size))
         # Fill surface with transparent colour
@@ -325,25 +397,19 @@ class TrackSprite(pygame.sprite.Sprite):
             all4ims.append([])
 
         # 2. Lookup & generate own image
-        ownims = self.lookup_image(self.paths)
-        if not ownims:
-            ownims = self.generate_image(self.paths)
-            self.add_cache_image(self.paths, ownims)
-        for n, im in enumerate(ownims):
+        for n, im in enumerate(self.get_image(paths)):
             all4ims[n].append((im, (0,0)))
 
-        # 3. Look up neighbours to see if this tile needs to have any of their
-        #    paths drawn on it too
+        # 3. Add the images of any neighbours which need to have their paths
+        #    drawn on this tile too
         # Offsets in x/y to blit neighbours
-        xdiffs = [ p2,  p2, -p2, -p2]
-        ydiffs = [-p4,  p4,  p4, -p4]
-        outs = World.get_4_overlap_paths(self.neighbour_paths)
-        for n, xdiff, ydiff, out in zip([0,1,2,3], xdiffs, ydiffs, outs):
+        s2 = self.size / 2
+        s4 = self.size / 4
+        xdiffs = [ s2,  s2, -s2, -s2]
+        ydiffs = [-s4,  s4,  s4, -s4]
+        for xdiff, ydiff, out in zip(xdiffs, ydiffs, overlap_paths):
             if out != []:
-                ims = self.lookup_image(out)
-                if not ims:
-                    ims = self.generate_image(out)
-                for n, im in enumerate(ims):
+                for n, im in enumerate(self.get_image(out)):
                     # For each layer, add the image and the position to blit it
                     # to in the ouput
                     all4ims[n].append((im, (xdiff,ydiff)))
@@ -358,11 +424,15 @@ class TrackSprite(pygame.sprite.Sprite):
         surface.blit(TrackSprite.tilemask, (0,0))
         # Set transparency
         surface.set_colorkey(transparent)
+        return surface
 
-        # 6. Set self.image to the surface we've created
-        self.image = surface
-
-        self.calc_rect()
+    def get_image(self, paths):
+        """Return the image set for a set of paths, generating and caching it if needed"""
+        ims = self.lookup_image(paths)
+        if not ims:
+            ims = self.generate_image(paths)
+            self.add_cache_image(paths, ims)
+        return ims
 
     def lookup_image(self, paths):
         """Try to lookup an image set in the cache, returns image set or False if it isn't cached"""
@@ -410,121 +480,92 @@ class TrackSprite(pygame.sprite.Sprite):
         # List of surfaces which, when blitted together, make up this graphic
         surfaces = []
         debug("Generating images from paths: %s" % paths)
+        # Control points only depend on the path, so work them out once rather than once per layer
+        control_points = [self.calc_control_points(path[0:2]) for path in paths]
 
         for layer in self.layer_profiles:
             # Generate a new surface to draw onto
             surface = pygame.Surface((self.size, self.size))
             # Fill surface with transparent colour
             surface.fill(transparent)
-            if self.paths != []:
-                for path in self.paths:
-                    # Improvement: Move this out of this look to do it only once per
-                    # path, rather than once per path per layer
-                    cps = self.calc_control_points(path[0:2])
-                    surface.blit(layer["function"](cps), (0, p2))
-                    if layer["render"]:
-                        surface = layer["render"](surface)
+            # Every path is drawn into the same surface, so layers which need rendering
+            # (e.g. ballast) only need to be rendered once for the whole set of paths
+            for cps in control_points:
+                layer["function"](surface, cps)
+            if layer["render"] and control_points:
+                surface = layer["render"](surface)
             surface.set_colorkey(transparent)
             surfaces.append(surface)
         debug("surfaces array = %s" % str(surfaces))
         return surfaces
         
-    def draw_rails(self, control_points):
-        """Draw one set of rails using some control points and return a surface"""
-        # Generate a new surface to draw onto
-        surface = pygame.Surface((self.size, self.size))
-        # Fill surface with transparent colour
-        surface.fill(transparent)
+    def draw_rails(self, surface, control_points):
+        """Draw one set of rails using some control points onto surface"""
         # Calculate bezier curve points and tangents
-        cps, tangents = self.bezier.calculate_bezier(control_points, 30)
-        for s in [1, -1]:
+        cps, tangents = self.bezier.calculate_bezier(control_points, self.bezier_steps)
+        # At low detail a single line down the middle stands in for both rails
+        if TrackSprite.single_rail:
+            sides = [0]
+        else:
+            sides = [1, -1]
+        for s in sides:
             points1 = []
             for p in range(0, len(cps)):
                 points1.append(self.bezier.get_at_width(cps[p], tangents[p], s*self.rail_spacing))
             points1 = self.translate_points(points1)
             pygame.draw.lines(surface, silver, False, points1, self.rail_width)
-        # Finally ensure surface is set back to correct colourkey for further additions
-        surface.set_colorkey(transparent)
-        return surface
 
-    def draw_sleepers(self, control_points):
-        """Draw a set of sleepers and return a surface containing them"""
-        # Draw out to the image
-        surface = pygame.Surface((self.size, self.size))
-        # Fill surface with transparent colour
-        surface.fill(transparent)
+    def draw_sleepers(self, surface, control_points):
+        """Draw a set of sleepers using some control points onto surface"""
         # Calculate bezier curve points and tangents
-        cps, tangents = self.bezier.calculate_bezier(control_points, 30)
-        overflow = self.sleeper_spacing * -0.5
-        sleeper_points = []
-        start = True
-        # calculate total length of this curve section based on the straight lines which make it up
-        total_length = 0
-        for p in range(1, len(cps)):
-            # find gradient of a->b
-            b = cps[p]
-            a = cps[p-1]
-            a_to_b = b - a
-            ab_n = a_to_b.normalized()
-            try:
-                total_length += a_to_b.get_length() / ab_n.get_length()
-            except ZeroDivisionError:
-                total_length += 0
-                pass
-        # number of sleepers is length, (minus one interval to make the ends line up) divided by interval length
-        num_sleepers = float(total_length) / float(TrackSprite.sleeper_spacing)
-        try:
-            true_spacing = float(total_length) / float(math.ceil(num_sleepers))
-        except ZeroDivisionError:
-            true_spacing = 0
-            pass
-        for p in range(1, len(cps)):
-            # find gradient of a->b
-            b = cps[p]
-            a = cps[p-1]
-            a_to_b = b - a
-            ab_n = a_to_b.normalized()
-            # vector to add to start vector, to get offset start location
-            start_vector = overflow * ab_n
-            # number of sleepers to draw in this section
-            try:
-                n_sleepers, overflow = divmod((a_to_b + start_vector).get_length(), (ab_n * true_spacing).get_length())
-            except ZeroDivisionError:
-                n_sleepers = 0
-                overflow = 0
-                pass
-            n_sleepers = int(n_sleepers)
-            # loop through n_sleepers, draw a sleeper at the start of each sleeper spacing interval
-            if start:
-                s = 0
-                start = False
-            else:
-                s = 1
-            for n in range(s, n_sleepers+1):
-                sleep_p = [self.bezier.get_at_width(a - start_vector + n*ab_n*true_spacing - ab_n*0.5*self.sleeper_width, a_to_b, -self.sleeper_length),
-                           self.bezier.get_at_width(a - start_vector + n*ab_n*true_spacing - ab_n*0.5*self.sleeper_width, a_to_b, self.sleeper_length),
-                           self.bezier.get_at_width(a - start_vector + n*ab_n*true_spacing + ab_n*0.5*self.sleeper_width, a_to_b, self.sleeper_length),
-                           self.bezier.get_at_width(a - start_vector + n*ab_n*true_spacing + ab_n*0.5*self.sleeper_width, a_to_b, -self.sleeper_length)]
-                # translate points into iso perspective
-                sleeper_points.append(self.translate_points(sleep_p))
-        # finally draw all the sleeper points
-        for p in sleeper_points:
+        cps, tangents = self.bezier.calculate_bezier(control_points, self.bezier_steps)
+        # Draw all the sleepers
+        for p in self.calc_sleeper_points(cps):
             pygame.draw.polygon(surface, brown, p, 0)
-        # Finally ensure surface is set back to correct colourkey for further additions
-        surface.set_colorkey(transparent)
-        return surface
 
-    def draw_ballast_mask(self, control_points):
+    def calc_sleeper_points(self, cps):
+        """Return a list of iso space quads, one per sleeper, spaced evenly along the polyline cps"""
+        points = numpy.array([(c[0], c[1]) for c in cps], dtype=float)
+        # Segments of the polyline, zero length segments have no direction so drop them
+        segments = numpy.diff(points, axis=0)
+        lengths = numpy.hypot(segments[:,0], segments[:,1])
+        keep = lengths > 0
+        if not keep.any():
+            return []
+        starts = points[:-1][keep]
+        segments = segments[keep]
+        lengths = lengths[keep]
+        # Cumulative arc length at the start of each segment
+        arc = numpy.concatenate(([0.0], numpy.cumsum(lengths)))
+        total_length = arc[-1]
+        # Round the number of sleepers up so that true spacing is never more than sleeper_spacing,
+        # sleepers sit in the middle of each interval so that the ends of neighbouring tiles line up
+        num_sleepers = int(math.ceil(total_length / TrackSprite.sleeper_spacing))
+        true_spacing = total_length / num_sleepers
+        s = (numpy.arange(num_sleepers) + 0.5) * true_spacing
+        # Segment each sleeper falls on, and how far along that segment it is
+        i = numpy.searchsorted(arc, s, side="right") - 1
+        i = numpy.clip(i, 0, len(lengths) - 1)
+        along = segments[i] / lengths[i][:,numpy.newaxis]
+        across = numpy.column_stack((-along[:,1], along[:,0]))
+        centres = starts[i] + along * (s - arc[i])[:,numpy.newaxis]
+        # Offsets of the four corners of each sleeper from its centre
+        w = along * (0.5 * TrackSprite.sleeper_width)
+        l = across * TrackSprite.sleeper_length
+        quads = numpy.array([centres - w - l,
+                             centres - w + l,
+                             centres + w + l,
+                             centres + w - l])
+        # Translate points into iso perspective, giving shape (sleepers, corners, xy)
+        quads = quads.transpose(1, 0, 2) * (1, 0.5) + (0, self.size / 2)
+        return quads.tolist()
+
+    def draw_ballast_mask(self, surface, control_points):
         """Draw the mask used to produce the ballast component of the image"""
-        # Draw out to the image
-        surface = pygame.Surface((self.size, self.size))
-        # Transparent surface, draw mask in white, set colourkey to transparent so blitting these textures
-        # onto one another will result in final mask. When final mask obtained, set colourkey
-        # to white and blit over the texture, see map_ballast_texture
-        # Fill surface with transparent colour
-        surface.fill(transparent)
+        # Masks for all paths are drawn in white onto the same transparent surface,
+        # when the final mask is complete it is textured by map_ballast_texture
         # Calculate bezier curve points and tangents
-        cps, tangents = self.bezier.calculate_bezier(control_points, 30)
+        cps, tangents = self.bezier.calculate_bezier(control_points, self.bezier_steps)
         # Polygon defined by the two lines at either side of the track
         ballast_points = []
         # Add one side
@@ -537,23 +578,18 @@ class TrackSprite(pygame.sprite.Sprite):
         ballast_points = self.translate_points(ballast_points)
         # Draw the polygon to the surface
         pygame.draw.polygon(surface, white, ballast_points, 0)
-        # Set transparency so these surfaces can be composited
-        surface.set_colorkey(transparent)
-        return surface
 
     def map_ballast_texture(self, surface):
         """Take a surface generated by calls to draw_ballast_mask and apply a ballast texture to it"""
-        # Set mask key to white, so only the outline parts drawn
-        surface.set_colorkey(white, pygame.RLEACCEL)
-        outsurface = pygame.Surface((self.size, self.size))
-        # Blit in the texture
-        outsurface.blit(self.ballast_texture, (0,0), (0, 0, self.size, self.size))
-        # Blit in the mask to obscure invisible parts of the texture with black
-        outsurface.blit(surface, (0,0))
-        # Then set colourkey of the final surface to black to remove the mask
+        # Start with a copy of the texture
+        outsurface = self.ballast_texture.subsurface((0, 0, self.size, self.size)).copy()
+        # Anything outside the white mask is set to the transparent colour in one array operation
+        outside = pygame.surfarray.pixels2d(surface) != surface.map_rgb(white)
+        pixels = pygame.surfarray.pixels2d(outsurface)
+        pixels[outside] = outsurface.map_rgb(transparent)
+        # Pixel arrays lock their surfaces, release them before the surfaces are blitted
+        del outside, pixels
         outsurface.set_colorkey(transparent)
-        # Finally ensure surface is set back to correct colourkey for further additions
-        surface.set_colorkey(transparent)
         return outsurface
 
     def calc_control_points(self, p):
@@ -593,18 +629,20 @@ class TrackSprite(pygame.sprite.Sprite):
         y = self.yWorld
         z = self.zWorld
         # Global screen positions
-        self.xpos = World.WorldWidth2 - (x * p2) + (y * p2) - p2
-        self.ypos = (x * p4) + (y * p4) - (z * ph)
+        self.xpos = World.WorldWidth2 - (x * World.p2) + (y * World.p2) - World.p2
+        self.ypos = (x * World.p4) + (y * World.p4) - (z * World.ph)
         # Rect position takes into account the offset
-        self.rect = (self.xpos - World.dxoff, self.ypos - World.dyoff, p, p)
+        self.rect = (self.xpos - World.dxoff, self.ypos - World.dyoff, World.p, World.p)
         return self.rect
 
     def translate_points(self, points):
         """Translate a set of points to convert from world space into iso space"""
+        # Track is drawn onto the bottom half of the tile image
         scale = vec2d(1,0.5)
+        offset = vec2d(0,self.size / 2)
         out = []
         for p in points:
-            out.append(p*scale)
+            out.append(p*scale + offset)
         return out
 
 
@@ -695,6 +733,13 @@ class TileSprite(pygame.sprite.Sprite):
                 TileSprite.highlight_images[i].convert()
                 TileSprite.highlight_images[i].set_colorkey((231,255,255), pygame.RLEACCEL)
 
+            # Downsampled tile and highlight images for each zoom level,
+            # each level is produced from the one above it
+            TileSprite.mipmaps = [(TileSprite.tile_images, TileSprite.highlight_images)]
+            for size in world.ZOOM_LEVELS[1:]:
+                TileSprite.mipmaps.append((self.downsample(TileSprite.mipmaps[-1][0], size),
+                                           self.downsample(TileSprite.mipmaps[-1][1], size)))
+
         self.exclude = exclude
         # x,y,zdim are the global 3D world dimensions of the object
         self.xdim = 1.0
@@ -714,10 +759,10 @@ class TileSprite(pygame.sprite.Sprite):
         y = self.yWorld
         z = self.zWorld
         # Global screen positions
-        self.xpos = World.WorldWidth2 - (x * p2) + (y * p2) - p2
-        self.ypos = (x * p4) + (y * p4) - (z * ph)
+        self.xpos = World.WorldWidth2 - (x * World.p2) + (y * World.p2) - World.p2
+        self.ypos = (x * World.p4) + (y * World.p4) - (z * World.ph)
         # Rect position takes into account the offset
-        self.rect = (self.xpos - World.dxoff, self.ypos - World.dyoff, p, p)
+        self.rect = (self.xpos - World.dxoff, self.ypos - World.dyoff, World.p, World.p)
         return self.rect
     def update_xyz(self):
         """Update xyz coords to match those in the array"""
@@ -727,48 +772,61 @@ class TileSprite(pygame.sprite.Sprite):
         """Update type to match those in the array"""
         self.type = self.array_to_string(World.array[self.xWorld][self.yWorld][1])
 ##        self.update()
+    def downsample(self, images, size):
+        """Return a copy of a dict of tile images scaled down to size"""
+        out = {}
+        for i in images:
+            # Plain scaling so that the edges stay the exact transparent colour
+            out[i] = pygame.transform.scale(images[i], (size, size))
+            out[i].set_colorkey((231,255,255), pygame.RLEACCEL)
+        return out
     def update(self):
         """Update sprite's rect and other attributes"""
         # What tile type should this tile be?
-        self.image = TileSprite.tile_images[self.type]
+        self.image = TileSprite.mipmaps[World.zoom][0][self.type]
         self.calc_rect()
     def change_highlight(self, type):
         """Update this tile's image with a highlight"""
+        tile_images, highlight_images = TileSprite.mipmaps[World.zoom]
+        p = World.p
+        p2 = World.p2
+        p4 = World.p4
+        p4x3 = World.p4x3
         image = pygame.Surface((p,p))
         image.fill((231,255,255))
-        image.blit(TileSprite.tile_images[self.type], (0,0))
+        image.blit(tile_images[self.type], (0,0))
         tiletype = self.type
         if type == 0:
             # Empty Image
             pass
         # Corner bits, made up of two images
         elif type == 1:
-            image.blit(TileSprite.highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (0,0), (0,0,p4,p))
-            image.blit(TileSprite.highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (0,0), (0,0,p4,p))
+            image.blit(highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (0,0), (0,0,p4,p))
+            image.blit(highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (0,0), (0,0,p4,p))
         elif type == 2:
-            image.blit(TileSprite.highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (p4,0), (p4,0,p2,p))
-            image.blit(TileSprite.highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (p4,0), (p4,0,p2,p))
+            image.blit(highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (p4,0), (p4,0,p2,p))
+            image.blit(highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (p4,0), (p4,0,p2,p))
         elif type == 3:
-            image.blit(TileSprite.highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (p4x3,0), (p4x3,0,p4,p))
-            image.blit(TileSprite.highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (p4x3,0), (p4x3,0,p4,p))
+            image.blit(highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (p4x3,0), (p4x3,0,p4,p))
+            image.blit(highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (p4x3,0), (p4x3,0,p4,p))
         elif type == 4:
-            image.blit(TileSprite.highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (p4,0), (p4,0,p2,p))
-            image.blit(TileSprite.highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (p4,0), (p4,0,p2,p))
+            image.blit(highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (p4,0), (p4,0,p2,p))
+            image.blit(highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (p4,0), (p4,0,p2,p))
         # Edge bits, made up of one image
         elif type == 5:
-            image.blit(TileSprite.highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (0,0))
+            image.blit(highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (0,0))
         elif type == 6:
-            image.blit(TileSprite.highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (0,0))
+            image.blit(highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (0,0))
         elif type == 7:
-            image.blit(TileSprite.highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (0,0))
+            image.blit(highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (0,0))
         elif type == 8:
-            image.blit(TileSprite.highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (0,0))
+            image.blit(highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (0,0))
         else:
             # Otherwise highlight whole tile (4 images)
-            image.blit(TileSprite.highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (0,0))
-            image.blit(TileSprite.highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (0,0))
-            image.blit(TileSprite.highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (0,0))
-            image.blit(TileSprite.highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (0,0))
+            image.blit(highlight_images["%s%sXX" % (tiletype[0], tiletype[1])], (0,0))
+            image.blit(highlight_images["X%s%sX" % (tiletype[1], tiletype[2])], (0,0))
+            image.blit(highlight_images["XX%s%s" % (tiletype[2], tiletype[3])], (0,0))
+            image.blit(highlight_images["%sXX%s" % (tiletype[0], tiletype[3])], (0,0))
         image.set_colorkey((231,255,255), pygame.RLEACCEL)
         self.image = image
         self.mask = pygame.mask.from_surface(self.image)
@@ -799,8 +857,16 @@ class DisplayMain(object):
         # Setup fonts
         self.font = pygame.font.Font(None, 12)
 
-    def MainLoop(self):
-        """This is the Main Loop of the Game"""
+    def mouse_move(self, position, buttons):
+        """Send a cursor movement to the tools"""
+        # LMB is pressed, update all the time to keep highlight working
+        self.lmb_tool.mouse_move(position, self.orderedSpritesDict)
+        # RMB is pressed, only update while RMB pressed
+        if buttons[2] == 1:
+            self.rmb_tool.mouse_move(position, self.orderedSpritesDict)
+
+    def init_loop(self):
+        """Set up the world, tools and overlays ready for the first frame"""
         # Initiate the clock
         self.clock = pygame.time.Clock()
 
@@ -813,8 +879,6 @@ class DisplayMain(object):
         self.paint_world()
         self.refresh_screen = 1
 
-        # Sprite used to find what the cursor is selecting
-        self.mouseSprite = None
         # Settings for FPS counter
         self.fps_refresh = FPS_REFRESH
         self.fps_elapsed = 0
@@ -845,125 +909,187 @@ class DisplayMain(object):
                                              fg=(0,0,0), bg=(255,255,255), bold=False)
         self.overlay_sprites.add(self.active_tool_sprite, layer=100)
 
+    def MainLoop(self, recorder=None):
+        """This is the Main Loop of the Game
+        If recorder is given (see replay.Recorder) the input of every frame is recorded"""
+        self.init_loop()
         while True:
             self.clock.tick(0)
             # If there's a quit event, don't bother parsing the event queue
             if pygame.event.peek(pygame.QUIT):
+                if recorder:
+                    recorder.close()
                 pygame.display.quit()
                 sys.exit()
-
-            # Clear the stack of dirty tiles
-            self.dirty = []
-
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_F12:
-                        pygame.image.save(self.screen, "pytile_sc.png")
-                    if not self.lmb_tool.process_key(event.key):
-                        # process_key() will always return False if it hasn't processed the key,
-                        # so that keys can be used for other things if a tool doesn't want them
-                        if event.key == pygame.K_t:
-                            # Activate track drawing mode
-                            debug("Track drawing mode active")
-                            self.lmb_tool = tools.Track()
-                            self.active_tool_sprite.text = ["Track drawing"]
-                            self.dirty.append(self.active_tool_sprite.update())
-                        if event.key == pygame.K_h:
-                            # Activate terrain modification mode
-                            debug("Terrain modification mode active")
-                            self.lmb_tool = tools.Terrain()
-                            self.active_tool_sprite.text = ["Terrain modification"]
-                            self.dirty.append(self.active_tool_sprite.update())
-                        if event.key == pygame.K_p:
-                            # Activate experimental pathfinder test tool
-                            debug("Pathfinder demo tool active")
-                            self.lmb_tool = tools.Pathfinder()
-                            self.active_tool_sprite.text = ["Pathfinder demo"]
-                            self.dirty.append(self.active_tool_sprite.update())
-                        # Some tools may use the escape key
-                        if event.key == pygame.K_ESCAPE:
-                            pygame.display.quit()
-                            sys.exit()
-
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    # LMB
-                    if event.button == 1:
-                        self.lmb_tool.mouse_down(event.pos, self.orderedSprites)
-                    # RMB
-                    if event.button == 3:
-                        self.rmb_tool.mouse_down(event.pos, self.orderedSprites)
-                if event.type == pygame.MOUSEBUTTONUP:
-                    # LMB
-                    if event.button == 1:
-                        self.lmb_tool.mouse_up(event.pos, self.orderedSprites)
-                    # RMB
-                    if event.button == 3:
-                        self.rmb_tool.mouse_up(event.pos, self.orderedSprites)
-                if event.type == pygame.MOUSEMOTION:
-                    # LMB is pressed, update all the time to keep highlight working
-##                    if event.buttons[0] == 1:
-                    self.lmb_tool.mouse_move(event.pos, self.orderedSprites)
-                    # RMB is pressed, only update while RMB pressed
-                    if event.buttons[2] == 1:
-                        self.rmb_tool.mouse_move(event.pos, self.orderedSprites)
-                    # No buttons are pressed
-##                    else:
-##                        pass
-                if event.type == pygame.VIDEORESIZE:
-                    debug("Screen resized, new dimensions: (%s, %s)" % (event.w, event.h))
-                    self.screen_width = event.w
-                    self.screen_height = event.h
-                    self.screen = pygame.display.set_mode((self.screen_width, self.screen_height), pygame.RESIZABLE)
-                    self.paint_world()
-                    self.refresh_screen = 1
-
-            if self.lmb_tool.has_aoe_changed():
-                # Update the screen to reflect changes made by tools
-                aoe = self.lmb_tool.get_last_aoe() + self.lmb_tool.get_aoe()
-                self.update_world(aoe, self.lmb_tool.get_highlight())
-                self.lmb_tool.set_aoe_changed(False)
-                self.lmb_tool.clear_aoe()
-
-            if self.rmb_tool.active():
-                # Repaint the entire screen until something better is implemented
-                self.paint_world()
+            events = pygame.event.get()
+            if recorder:
+                recorder.record(events)
+            self.run_frame(events)
+
+    def Replay(self, player, timings, synchronous=False):
+        """Play back a recorded session (see replay.Player) through the same code as MainLoop,
+        adding the time taken by each frame to timings (a replay.Timings)
+        If synchronous is True terrain edits are applied completely in the frame they're made,
+        so the replay doesn't depend on how quickly the background thread works, otherwise
+        they're committed a little each frame just as they are while playing"""
+        self.init_loop()
+        if synchronous:
+            tools.TerrainEdits.commit_time = None
+        for events in player:
+            self.clock.tick(0)
+            # Input from the window is ignored during the replay
+            pygame.event.clear()
+            start = time.time()
+            try:
+                self.run_frame(events)
+            except SystemExit:
+                # Session was ended with the escape key
+                timings.add(time.time() - start, len(events))
+                return
+            timings.add(time.time() - start, len(events))
+
+    def run_frame(self, events):
+        """Process one frame's list of events, then update the screen"""
+        # Clear the stack of dirty tiles
+        self.dirty = []
+
+        # Mouse motion events are coalesced, tools only see the latest cursor position
+        # each frame (drag tools work from where the drag started, so nothing is lost)
+        motion = None
+        for event in events:
+            if event.type == pygame.MOUSEMOTION:
+                motion = event
+                continue
+            # Any motion before a button event must be sent first, so the button
+            # event applies with the cursor in the right place
+            if motion and event.type in [pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP]:
+                self.mouse_move(motion.pos, motion.buttons)
+                motion = None
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F12:
+                    pygame.image.save(self.screen, "pytile_sc.png")
+                if not self.lmb_tool.process_key(event.key):
+                    # process_key() will always return False if it hasn't processed the key,
+                    # so that keys can be used for other things if a tool doesn't want them
+                    if event.key == pygame.K_t:
+                        # Activate track drawing mode
+                        debug("Track drawing mode active")
+                        self.lmb_tool = tools.Track()
+                        self.active_tool_sprite.text = ["Track drawing"]
+                        self.dirty.append(self.active_tool_sprite.update())
+                    if event.key == pygame.K_h:
+                        # Activate terrain modification mode
+                        debug("Terrain modification mode active")
+                        self.lmb_tool = tools.Terrain()
+                        self.active_tool_sprite.text = ["Terrain modification"]
+                        self.dirty.append(self.active_tool_sprite.update())
+                    if event.key in [pygame.K_EQUALS, pygame.K_KP_PLUS]:
+                        # Zoom in, keeping the middle of the screen in place
+                        self.zoom(World.zoom - 1, (self.screen_width / 2, self.screen_height / 2))
+                    if event.key in [pygame.K_MINUS, pygame.K_KP_MINUS]:
+                        # Zoom out
+                        self.zoom(World.zoom + 1, (self.screen_width / 2, self.screen_height / 2))
+                    if event.key == pygame.K_p:
+                        # Activate experimental pathfinder test tool
+                        debug("Pathfinder demo tool active")
+                        self.lmb_tool = tools.Pathfinder()
+                        self.active_tool_sprite.text = ["Pathfinder demo"]
+                        self.dirty.append(self.active_tool_sprite.update())
+                    # Some tools may use the escape key
+                    if event.key == pygame.K_ESCAPE:
+                        pygame.display.quit()
+                        sys.exit()
+
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                # LMB
+                if event.button == 1:
+                    self.lmb_tool.mouse_down(event.pos, self.orderedSpritesDict)
+                # RMB
+                if event.button == 3:
+                    self.rmb_tool.mouse_down(event.pos, self.orderedSpritesDict)
+                # Mouse wheel zooms in/out around the cursor
+                if event.button == 4:
+                    self.zoom(World.zoom - 1, event.pos)
+                if event.button == 5:
+                    self.zoom(World.zoom + 1, event.pos)
+            if event.type == pygame.MOUSEBUTTONUP:
+                # LMB
+                if event.button == 1:
+                    self.lmb_tool.mouse_up(event.pos, self.orderedSpritesDict)
+                # RMB
+                if event.button == 3:
+                    self.rmb_tool.mouse_up(event.pos, self.orderedSpritesDict)
+            if event.type == pygame.VIDEORESIZE:
+                debug("Screen resized, new dimensions: (%s, %s)" % (event.w, event.h))
+                self.screen_width = event.w
+                self.screen_height = event.h
+                self.screen = pygame.display.set_mode((self.screen_width, self.screen_height), pygame.RESIZABLE)
+                self.paint_world(self.lmb_tool.get_overlay())
                 self.refresh_screen = 1
-
-            # Write some useful info on the top bar
-            self.fps_elapsed += self.clock.get_time()
-            if self.fps_elapsed >= self.fps_refresh:
-                self.fps_elapsed = 0
-                ii = self.lmb_tool.tile
-                if ii:
-                    layer = self.orderedSprites.get_layer_of_sprite(ii)
-                    pygame.display.set_caption("FPS: %i | Tile: (%s,%s) of type: %s, layer: %s | dxoff: %s dyoff: %s" %
-                                               (self.clock.get_fps(), ii.xWorld, ii.yWorld, ii.type, layer, World.dxoff, World.dyoff))
-                else:
-                    pygame.display.set_caption("FPS: %i | dxoff: %s dyoff: %s" %
-                                               (self.clock.get_fps(), World.dxoff, World.dyoff))
-
-            # If land height has been altered, or the screen has been moved
-            # we need to refresh the entire screen
-            if self.refresh_screen == 1:
-                self.screen.fill((0,0,0))
-                rectlist = self.orderedSprites.draw(self.screen)
-                rectlist = self.overlay_sprites.draw(self.screen)
-                pygame.display.update()
-                self.refresh_screen = 0
+        if motion:
+            self.mouse_move(motion.pos, motion.buttons)
+
+        # Commit terrain edits worked out in the background, and redraw the tiles they change
+        if tools.Terrain.edits:
+            edited = tools.Terrain.edits.commit()
+            if edited:
+                self.update_world(edited, self.lmb_tool.get_overlay())
+
+        if self.lmb_tool.has_aoe_changed():
+            # Update the screen to reflect changes made by tools
+            aoe = self.lmb_tool.get_last_aoe() + self.lmb_tool.get_aoe()
+            self.update_world(aoe, self.lmb_tool.get_overlay())
+            self.lmb_tool.set_aoe_changed(False)
+            self.lmb_tool.clear_aoe()
+
+        if self.rmb_tool.active():
+            # Repaint the entire screen until something better is implemented
+            self.paint_world(self.lmb_tool.get_overlay())
+            self.refresh_screen = 1
+
+        # Write some useful info on the top bar
+        self.fps_elapsed += self.clock.get_time()
+        if self.fps_elapsed >= self.fps_refresh:
+            self.fps_elapsed = 0
+            ii = self.lmb_tool.tile
+            if ii:
+                layer = self.orderedSprites.get_layer_of_sprite(ii)
+                pygame.display.set_caption("FPS: %i | Tile: (%s,%s) of type: %s, layer: %s | dxoff: %s dyoff: %s" %
+                                           (self.clock.get_fps(), ii.xWorld, ii.yWorld, ii.type, layer, World.dxoff, World.dyoff))
             else:
-                for r in self.dirty:
-                    self.screen.fill((0,0,0), r)
-                rectlist = self.orderedSprites.draw(self.screen)
-                rectlist = self.overlay_sprites.draw(self.screen)
-                pygame.display.update(self.dirty)
+                pygame.display.set_caption("FPS: %i | dxoff: %s dyoff: %s" %
+                                           (self.clock.get_fps(), World.dxoff, World.dyoff))
+
+        # If land height has been altered, or the screen has been moved
+        # we need to refresh the entire screen
+        if self.refresh_screen == 1:
+            self.screen.fill((0,0,0))
+            rectlist = self.orderedSprites.draw(self.screen)
+            rectlist = self.overlay_sprites.draw(self.screen)
+            pygame.display.update()
+            self.refresh_screen = 0
+        else:
+            for r in self.dirty:
+                self.screen.fill((0,0,0), r)
+            rectlist = self.orderedSprites.draw(self.screen)
+            rectlist = self.overlay_sprites.draw(self.screen)
+            pygame.display.update(self.dirty)
 
 
     def array_to_string(self, array):
         """Convert a heightfield array to a string"""
         return "%s%s%s%s" % (array[0], array[1], array[2], array[3])
 
-    def update_world(self, tiles, highlight={}):
-        """Instead of completely regenerating the entire world, just update certain tiles"""
+    def zoom(self, zoom, centre):
+        """Change zoom level around screen position centre and repaint"""
+        if World.set_zoom(zoom, centre):
+            debug("Zoom level changed to: %s" % World.zoom)
+            self.paint_world(self.lmb_tool.get_overlay())
+            self.refresh_screen = 1
+
+    def update_world(self, tiles, overlay=None):
+        """Instead of completely regenerating the entire world, just update certain tiles
+        overlay holds tool previews to draw over the World (see tools.Overlay)"""
         # Add all the items in tiles to the checked_nearby hash table
         nearbytiles = []
         for t in tiles:
@@ -980,13 +1106,7 @@ class DisplayMain(object):
         tiles.extend(nearbytiles)
         for t in tiles:
             x, y = t
-            # If an override is defined in highlight for this tile,
-            # update based on that rather than on contents of World
-            if highlight.has_key((x,y)):
-                debug("highlight override for %s,%s" % (x,y))
-                tile = highlight[(x,y)]
-            else:
-                tile = World.array[x][y]
+            tile = World.array[x][y]
             # Look the tile up in the group using the position, this will give us the tile and all its cliffs
             if self.orderedSpritesDict.has_key((x, y)):
                 tileset = self.orderedSpritesDict[(x, y)]
@@ -1002,12 +1122,8 @@ class DisplayMain(object):
                 # Update the tile image
                 t.update()
                 # Update cursor highlight for tile (if it has one)
-                try:
-                    tile[3]
-                except IndexError:
-                    pass
-                else:
-                    t.change_highlight(tile[3])
+                if overlay and overlay.get_subtile(x, y) is not None:
+                    t.change_highlight(overlay.get_subtile(x, y))
                 self.dirty.append(t.update_xyz())
                 
                 self.orderedSprites.remove(tileset)
@@ -1022,76 +1138,84 @@ class DisplayMain(object):
                 # Improvement: Track sprite doesn't need to be re-added, only updated!
                 # If there are tracks on this tile, or overlapping tracks on a 
                 # neighbouring tile then add a track sprite
-                try:
-                    paths = tile[2]
-                except IndexError:
-                    paths = World.get_paths(x,y)
+                paths, neighbour_paths = self.get_track_paths(x, y, overlay)
                 if paths == []:
-                    npaths = World.get_4_overlap_paths(World.get_4_neighbour_paths(x,y, highlight))
+                    npaths = World.get_4_overlap_paths(neighbour_paths)
                 if paths != [] or npaths != [[],[],[],[]]:
-                    t = TrackSprite(x, y, tile[0], init_paths=paths, exclude=True)
+                    t = TrackSprite(x, y, tile[0], init_paths=paths, init_neighbour_paths=neighbour_paths, exclude=True)
                     #t.update_xyz()
                     self.orderedSprites.add(t, layer=l+1)
                     self.orderedSpritesDict[(x, y)].append(t)
 
+    def get_track_paths(self, x, y, overlay=None):
+        """Return the paths on a tile and the paths on its 4 neighbours,
+        including any previews in the overlay"""
+        paths = World.get_paths(x,y)
+        if overlay and overlay.paths:
+            if overlay.paths.has_key((x,y)):
+                paths = paths + overlay.paths[(x,y)]
+            return paths, World.get_4_neighbour_paths(x, y, overlay.paths)
+        else:
+            return paths, World.get_4_neighbour_paths(x, y)
+
     def get_layer(self, x, y):
         """Return the layer a sprite should be based on some parameters"""
         return (x + y) * 10
 
-    def paint_world(self, highlight={}):
-        """Paint the world as a series of sprites
-        Includes ground and other objects"""
-        # highlight defines tiles which should override the tiles stored in World
-        # can be accessed in the same way as World
-        self.refresh_screen = 1
-        self.orderedSprites.empty()     # This doesn't necessarily delete the sprites though?
-        self.orderedSpritesDict = {}
+    def visible_tiles(self):
+        """Return the world coordinates of all tiles in the visible area of the screen"""
+        tiles = []
         # Top-left of view relative to world given by self.dxoff, self.dyoff
         # Find the base-level tile at this position
         topleftTileY, topleftTileX = self.screen_to_iso((World.dxoff, World.dyoff))
-        for x1 in range(self.screen_width / p + 1):
-            for y1 in range(self.screen_height / p4):
+        for x1 in range(self.screen_width / World.p + 1):
+            for y1 in range(self.screen_height / World.p4):
                 x = int(topleftTileX - x1 + math.ceil(y1 / 2.0))
                 y = int(topleftTileY + x1 + math.floor(y1 / 2.0))
-                add_to_dict = []
                 # Tile must be within the bounds of the map
                 if (x >= 0 and y >= 0) and (x < World.WorldX and y < World.WorldY):
-                    # If an override is defined in highlight for this tile,
-                    # update based on that rather than on contents of World
-                    if highlight.has_key((x,y)):
-                        tile = highlight[(x,y)]
-                    else:
-                        tile = World.array[x][y]
-                    l = self.get_layer(x,y)
-                    # Add the main tile
-                    tiletype = self.array_to_string(tile[1])
-                    t = TileSprite(tiletype, x, y, tile[0], exclude=False)
-                    # Update cursor highlight for tile (if it has one)
-                    try:
-                        tile[3]
-                    except IndexError:
-                        pass
-                    else:
-                        t.change_highlight(tile[3])
-
-                    add_to_dict.append(t)
-                    self.orderedSprites.add(t, layer=l)
-
-                    # If there are tracks on this tile, or overlapping tracks on a 
-                    # neighbouring tile then add a track sprite
-                    paths = World.get_paths(x,y)
-                    if paths == []:
-                        npaths = World.get_4_overlap_paths(World.get_4_neighbour_paths(x,y))
-                    if paths != [] or npaths != [[],[],[],[]]:
-                        t = TrackSprite(x, y, tile[0], exclude=True)
-                        add_to_dict.append(t)
-                        self.orderedSprites.add(t, layer=l+1)
-
-                    # Add vertical surfaces (cliffs) for this tile (if any)
-                    for t in self.make_cliffs(x, y):
-                        add_to_dict.append(t)
-                        self.orderedSprites.add(t, layer=l)
-                    self.orderedSpritesDict[(x,y)] = add_to_dict
+                    tiles.append((x, y))
+        return tiles
+
+    def paint_world(self, overlay=None):
+        """Paint the world as a series of sprites
+        Includes ground and other objects"""
+        # overlay holds tool previews to draw over the World (see tools.Overlay)
+        self.refresh_screen = 1
+        self.orderedSprites.empty()     # This doesn't necessarily delete the sprites though?
+        self.orderedSpritesDict = {}
+        tiles = self.visible_tiles()
+        # How much detail track is drawn with depends on how much of it is in view
+        TrackSprite.visible_tracks = len([t for t in tiles if World.get_paths(t[0], t[1]) != []])
+        for x, y in tiles:
+            add_to_dict = []
+            tile = World.array[x][y]
+            l = self.get_layer(x,y)
+            # Add the main tile
+            tiletype = self.array_to_string(tile[1])
+            t = TileSprite(tiletype, x, y, tile[0], exclude=False)
+            # Update cursor highlight for tile (if it has one)
+            if overlay and overlay.get_subtile(x, y) is not None:
+                t.change_highlight(overlay.get_subtile(x, y))
+
+            add_to_dict.append(t)
+            self.orderedSprites.add(t, layer=l)
+
+            # If there are tracks on this tile, or overlapping tracks on a 
+            # neighbouring tile then add a track sprite
+            paths, neighbour_paths = self.get_track_paths(x, y, overlay)
+            if paths == []:
+                npaths = World.get_4_overlap_paths(neighbour_paths)
+            if paths != [] or npaths != [[],[],[],[]]:
+                t = TrackSprite(x, y, tile[0], init_paths=paths, init_neighbour_paths=neighbour_paths, exclude=True)
+                add_to_dict.append(t)
+                self.orderedSprites.add(t, layer=l+1)
+
+            # Add vertical surfaces (cliffs) for this tile (if any)
+            for t in self.make_cliffs(x, y):
+                add_to_dict.append(t)
+                self.orderedSprites.add(t, layer=l)
+            self.orderedSpritesDict[(x,y)] = add_to_dict
 
     def make_cliffs(self, x, y):
         """Produce a set of cliff sprites to go with a particular tile"""
@@ -1150,10 +1274,10 @@ class DisplayMain(object):
         TileRatio = 2.0
         # Convert coordinates to be relative to the position of tile (0,0)
         dx = wx - World.WorldWidth2
-        dy = wy - (p2)
+        dy = wy - (World.p2)
         # Do some maths
-        x = int((dy + (dx / TileRatio)) / (p2))
-        y = int((dy - (dx / TileRatio)) / (p2))
+        x = int((dy + (dx / TileRatio)) / (World.p2))
+        y = int((dy - (dx / TileRatio)) / (World.p2))
 ##        if x < 0 or y < 0:
 ##            return (0,0)
 ##        if x >= (World.WorldX) or y >= (World.WorldY):
@@ -1162,11 +1286,38 @@ class DisplayMain(object):
 
 
 if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--record", dest="record", metavar="FILE",
+                      help="record all input to FILE")
+    parser.add_option("--replay", dest="replay", metavar="FILE",
+                      help="play back input recorded to FILE, then report on frame timings")
+    parser.add_option("--headless", dest="headless", action="store_true", default=False,
+                      help="don't open a window (use with --replay)")
+    parser.add_option("--timings", dest="timings", metavar="FILE",
+                      help="write the time taken by each replayed frame to FILE")
+    parser.add_option("--synchronous", dest="synchronous", action="store_true", default=False,
+                      help="apply each terrain edit completely in the frame it's made (use with --replay)")
+    options, args = parser.parse_args()
+    if options.headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
     sys.stderr = debug
     sys.stdout = debug
 #    os.environ["SDL_VIDEO_CENTERED"] = "1"
-    MainWindow = DisplayMain(WINDOW_WIDTH, WINDOW_HEIGHT)
-    MainWindow.MainLoop()
+    if options.replay:
+        player = replay.Player(options.replay)
+        timings = replay.Timings()
+        MainWindow = DisplayMain(player.width, player.height)
+        MainWindow.Replay(player, timings, options.synchronous)
+        debug(timings.report())
+        sys.__stdout__.write(timings.report() + "\n")
+        if options.timings:
+            timings.write(options.timings)
+    else:
+        MainWindow = DisplayMain(WINDOW_WIDTH, WINDOW_HEIGHT)
+        recorder = None
+        if options.record:
+            recorder = replay.Recorder(options.record, WINDOW_WIDTH, WINDOW_HEIGHT)
+        MainWindow.MainLoop(recorder)
 
 
 
@@ -0,0 +1,177 @@
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2009 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+
+import os, sys
+
+
+
+import time
+import json
+import pygame
+
+import logger
+debug = logger.Log()
+
+
+# Event types which are recorded, and the attributes kept for each
+# Events of other types (e.g. ACTIVEEVENT, VIDEOEXPOSE) don't affect the world and are dropped
+event_attributes = {
+    "KEYDOWN":          ["key", "mod"],
+    "KEYUP":            ["key", "mod"],
+    "MOUSEMOTION":      ["pos", "rel", "buttons"],
+    "MOUSEBUTTONDOWN":  ["pos", "button"],
+    "MOUSEBUTTONUP":    ["pos", "button"],
+    "VIDEORESIZE":      ["size", "w", "h"],
+    }
+
+# Written as the first line of every recording
+FILE_VERSION = "pytile-recording 2"
+# Versions Player can read, recordings from version 1 only hold the frames which had events
+READ_VERSIONS = ["pytile-recording 1", FILE_VERSION]
+
+class Recorder(object):
+    """Records the events the main loop processes to a file, one line per event
+    Each line is a JSON object holding the frame the event arrived in, the time
+    since recording started (in seconds), the event type and its attributes
+    Frames without any events are written as a line with just the frame and time, so
+    the replay runs the same number of frames (and so commits terrain edits the same way)"""
+    def __init__(self, filename, width, height):
+        """Start a new recording, width/height are the window size it starts with"""
+        self.file = open(filename, "w")
+        self.file.write(FILE_VERSION + "\n")
+        self.file.write(json.dumps({"width": width, "height": height}) + "\n")
+        self.frame = 0
+        self.start = time.time()
+        self.types = {}
+        for name in event_attributes.keys():
+            self.types[getattr(pygame, name)] = name
+        debug("Recording input to: %s" % filename)
+
+    def record(self, events):
+        """Record one frame's list of events"""
+        t = time.time() - self.start
+        written = False
+        for event in events:
+            if not self.types.has_key(event.type):
+                continue
+            name = self.types[event.type]
+            line = {"frame": self.frame, "time": round(t, 4), "type": name}
+            for a in event_attributes[name]:
+                line[a] = getattr(event, a)
+            self.file.write(json.dumps(line) + "\n")
+            written = True
+        if not written:
+            self.file.write(json.dumps({"frame": self.frame, "time": round(t, 4)}) + "\n")
+        # Written a frame at a time so a session which ends abruptly is still usable
+        if written:
+            self.file.flush()
+        self.frame += 1
+
+    def close(self):
+        """Finish the recording"""
+        if not self.file.closed:
+            debug("Recorded %s frames" % self.frame)
+            self.file.close()
+
+class Player(object):
+    """Reads a recording made by Recorder and hands it back a frame at a time"""
+    def __init__(self, filename):
+        """Load a recording"""
+        f = open(filename, "r")
+        if f.readline().strip() not in READ_VERSIONS:
+            raise ValueError("%s is not a pyTile recording" % filename)
+        header = json.loads(f.readline())
+        self.width = header["width"]
+        self.height = header["height"]
+        # Lists of (time, events) for each recorded frame, in order
+        self.frames = []
+        last = None
+        for line in f:
+            if not line.strip():
+                continue
+            e = json.loads(line)
+            if e["frame"] != last:
+                self.frames.append((e["time"], []))
+                last = e["frame"]
+            # Frame without any events
+            if not e.has_key("type"):
+                continue
+            name = e["type"]
+            attributes = {}
+            for a in event_attributes[name]:
+                v = e[a]
+                if isinstance(v, list):
+                    v = tuple(v)
+                attributes[str(a)] = v
+            self.frames[-1][1].append(pygame.event.Event(getattr(pygame, name), attributes))
+        f.close()
+        debug("Loaded recording: %s, %s frames" % (filename, len(self.frames)))
+
+    def __iter__(self):
+        """Iterate over the events of each frame"""
+        for t, events in self.frames:
+            yield events
+
+class Timings(object):
+    """Collects per-frame timings during a replay and reports on them"""
+    def __init__(self):
+        """"""
+        # Time taken by each frame, in seconds, along with the number of events it processed
+        self.frames = []
+
+    def add(self, t, events):
+        """Record the time taken by one frame"""
+        self.frames.append((t, events))
+
+    def summary(self):
+        """Return a dict of statistics over all the frames, times in milliseconds"""
+        times = sorted([t for t, e in self.frames])
+        n = len(times)
+        if n == 0:
+            return {"frames": 0}
+        total = sum(times)
+        return {"frames": n,
+                "events": sum([e for t, e in self.frames]),
+                "total": total * 1000,
+                "mean": total / n * 1000,
+                "median": times[n / 2] * 1000,
+                "p95": times[min(n - 1, int(n * 0.95))] * 1000,
+                "max": times[-1] * 1000,
+                }
+
+    def report(self):
+        """Return the summary as a block of text"""
+        s = self.summary()
+        if s["frames"] == 0:
+            return "No frames replayed"
+        return ("Frames: %(frames)i, events: %(events)i, total: %(total).1f ms\n"
+                "Per frame - mean: %(mean).2f ms, median: %(median).2f ms, "
+                "95th percentile: %(p95).2f ms, max: %(max).2f ms" % s)
+
+    def write(self, filename):
+        """Write the time taken by each frame to a file, one frame per line"""
+        f = open(filename, "w")
+        f.write("# frame events time_ms\n")
+        for i, (t, e) in enumerate(self.frames):
+            f.write("%i %i %.3f\n" % (i, e, t * 1000))
+        f.close()
+
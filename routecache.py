@@ -0,0 +1,157 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+
+
+import array
+import collections
+
+import logger
+debug = logger.Log()
+
+
+class RouteCache(object):
+    """Routes already found, so the same query doesn't have to be searched for again
+    Routes are keyed by (start, target, cost model). The grid is divided into square regions
+    each with a version number, which goes up whenever a tile in (or next to) the region
+    changes. Each route remembers the regions it passed through and their versions when it
+    was found, it's only thrown away once one of those regions has changed
+    A change elsewhere can make a cheaper route possible without the cached route being
+    dropped, the cached route is still one which can be followed
+    Queries which found no route depend on the whole grid, so they're dropped on any change
+    grid is anything with width, height and watch(), e.g. pathfinder.CostGrid or MapGrid"""
+    # Width and height of each region, in tiles
+    region_size = 16
+    # Number of routes kept, the least recently used are dropped first
+    max_routes = 2000
+
+    def __init__(self, grid, region_size=None, max_routes=None):
+        """Set up an empty cache for routes across grid"""
+        self.grid = grid
+        if region_size:
+            self.region_size = region_size
+        if max_routes:
+            self.max_routes = max_routes
+        rs = self.region_size
+        self.regions_x = (grid.width + rs - 1) / rs
+        self.regions_y = (grid.height + rs - 1) / rs
+        # Version of each region, numbered ry * regions_x + rx
+        self.versions = array.array("i", [0]) * (self.regions_x * self.regions_y)
+        # Goes up on every change anywhere, for queries which found no route
+        self.version = 0
+        # Tiles which have changed since the versions were last updated
+        self.changed = grid.watch()
+        # Cached routes, keyed by (start, target, model), each is (path, list of (region, version),
+        # version of the whole grid), path and the list of regions are None for no route
+        # Kept in order of use, the least recently used first
+        self.routes = collections.OrderedDict()
+        # Counts of lookups which found a route, didn't, and found one which was out of date
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def refresh(self):
+        """Move on the versions of the regions around any tiles which have changed
+        Moves into and out of a tile change with it, so regions holding the tiles next
+        to it are moved on too. Returns True if anything changed"""
+        if not self.changed:
+            return False
+        rs = self.region_size
+        rx = self.regions_x
+        regions = set()
+        for x, y in self.changed:
+            for ry in range(max(y - 1, 0) / rs, min(y + 1, self.grid.height - 1) / rs + 1):
+                for r in range(max(x - 1, 0) / rs, min(x + 1, self.grid.width - 1) / rs + 1):
+                    regions.add(ry * rx + r)
+        self.changed.clear()
+        for r in regions:
+            self.versions[r] += 1
+        self.version += 1
+        debug("Route cache moved on %s regions" % len(regions))
+        return True
+
+    def get_regions(self, path):
+        """Returns the regions a path passes through, with their current versions"""
+        rs = self.region_size
+        rx = self.regions_x
+        regions = set([(y / rs) * rx + x / rs for x, y in path])
+        return [(r, self.versions[r]) for r in sorted(regions)]
+
+    def is_valid(self, entry):
+        """Returns True if none of the regions a cached route passed through have changed"""
+        path, regions, version = entry
+        if regions is None:
+            return version == self.version
+        versions = self.versions
+        for r, v in regions:
+            if versions[r] != v:
+                return False
+        return True
+
+    def lookup(self, start, target, model=None):
+        """Find a cached route, returns (True, path) if there's one which is still valid
+        (path is None if the query found there was no route) or (False, None) if not"""
+        self.refresh()
+        key = (start, target, model)
+        entry = self.routes.get(key)
+        if entry is None:
+            self.misses += 1
+            return (False, None)
+        if not self.is_valid(entry):
+            del self.routes[key]
+            self.invalidated += 1
+            self.misses += 1
+            return (False, None)
+        # Move to the most recently used end
+        del self.routes[key]
+        self.routes[key] = entry
+        self.hits += 1
+        if entry[0] is None:
+            return (True, None)
+        return (True, list(entry[0]))
+
+    def add(self, start, target, path, model=None):
+        """Add the route found from start to target (None for no route) to the cache"""
+        self.refresh()
+        key = (start, target, model)
+        if self.routes.has_key(key):
+            del self.routes[key]
+        if path is None:
+            self.routes[key] = (None, None, self.version)
+        else:
+            self.routes[key] = (tuple(path), self.get_regions(path), self.version)
+        while len(self.routes) > self.max_routes:
+            self.routes.popitem(last=False)
+
+    def find_path(self, start, target, search, model=None):
+        """Returns the cached route from start to target, or finds it by calling
+        search(start, target) (e.g. AStar.find_path) and caches it"""
+        found, path = self.lookup(start, target, model)
+        if found:
+            return path
+        path = search(start, target)
+        self.add(start, target, path, model)
+        return path
+
+    def clear(self):
+        """Drop all cached routes"""
+        self.routes.clear()
@@ -0,0 +1,136 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+import random
+import unittest
+
+import numpy
+
+import pathfinder
+import hpastar
+
+
+def path_cost(path):
+    """Cost of a route with the flat 10/14 costs of a MapGrid"""
+    cost = 0
+    for a, b in zip(path, path[1:]):
+        if a[0] == b[0] or a[1] == b[1]:
+            cost += 10
+        else:
+            cost += 14
+    return cost
+
+
+class HPAStarTest(unittest.TestCase):
+    """Compare routes found by HPAStar with those found by AStar on random maps"""
+    def check(self, blocked, cluster_size, queries):
+        """Check each (start, target) in queries can be reached by HPAStar if and only if it
+        can by AStar, that routes are made of possible moves and cost what HPAStar says
+        Returns the worst ratio of HPAStar's cost to the best possible"""
+        grid = pathfinder.MapGrid(blocked)
+        hpa = hpastar.HPAStar(grid, cluster_size)
+        astar = pathfinder.AStar(grid)
+        worst = 1.0
+        for start, target in queries:
+            best = astar.find_path(start, target)
+            path = hpa.find_path(start, target)
+            self.assertEqual(best is None, path is None, (start, target))
+            if path is None:
+                continue
+            self.assertEqual(path[0], target)
+            self.assertEqual(path[-1], start)
+            for a, b in zip(path, path[1:]):
+                self.assertEqual(max(abs(a[0] - b[0]), abs(a[1] - b[1])), 1)
+            # Routes can start on a blocked tile, but never go into one
+            for x, y in path[:-1]:
+                self.assertFalse(blocked[y,x])
+            self.assertEqual(path_cost(path), hpa.cost)
+            self.assertTrue(hpa.cost >= path_cost(best))
+            if best[1:]:
+                worst = max(worst, float(hpa.cost) / path_cost(best))
+        return worst
+
+    def test_random_maps(self):
+        """Same reachability as AStar on random maps, including from blocked tiles"""
+        rand = random.Random(7)
+        state = numpy.random.RandomState(7)
+        for trial in range(30):
+            size = rand.choice([17, 20, 37, 64])
+            blocked = state.rand(size, size) < rand.choice([0.1, 0.2, 0.3, 0.4])
+            queries = []
+            for q in range(10):
+                queries.append(((rand.randrange(size), rand.randrange(size)),
+                                (rand.randrange(size), rand.randrange(size))))
+            worst = self.check(blocked, rand.choice([8, 10, 16]), queries)
+            self.assertTrue(worst < 1.5, worst)
+
+    def test_diagonal_entrance(self):
+        """Route which can only cross between clusters diagonally"""
+        blocked = numpy.random.RandomState(8).rand(20, 17) < 0.35
+        grid = pathfinder.MapGrid(blocked)
+        hpa = hpastar.HPAStar(grid, 8)
+        path = hpa.find_path((2, 2), (1, 17))
+        self.assertNotEqual(path, None)
+        self.assertEqual(hpa.cost, 178)
+
+    def test_one_way_entrance(self):
+        """Route from a blocked tile, whose only way out is across a cluster border"""
+        blocked = numpy.zeros((16, 16), dtype=numpy.bool_)
+        blocked[:,5:8] = True
+        # Tile (7, 4) is blocked, but can be moved out of into (8, 3), (8, 4) or (8, 5)
+        self.check(blocked, 8, [((7, 4), (12, 12)), ((7, 4), (2, 2)), ((2, 2), (12, 12))])
+
+    def test_update(self):
+        """Clusters worked out again after tiles change are the same as ones built from scratch"""
+        rand = random.Random(3)
+        blocked = numpy.random.RandomState(3).rand(40, 40) < 0.3
+        grid = pathfinder.MapGrid(blocked)
+        hpa = hpastar.HPAStar(grid, 8)
+        for i in range(20):
+            grid.set_blocked((rand.randrange(40), rand.randrange(40)), rand.random() < 0.5)
+        hpa.refresh()
+        fresh = hpastar.HPAStar(grid, 8)
+        self.assertEqual(hpa.borders, fresh.borders)
+        self.assertEqual(hpa.nodes, fresh.nodes)
+        self.assertEqual(sorted(hpa.between.keys()), sorted(fresh.between.keys()))
+        for cluster, between in hpa.between.items():
+            self.assertTrue((between == fresh.between[cluster]).all(), cluster)
+        self.assertTrue((hpa.components == fresh.components).all())
+        self.assertEqual(dict([(n, c) for n, c in hpa.crossings.items() if c]),
+                         dict([(n, c) for n, c in fresh.crossings.items() if c]))
+
+    def test_trace_unreachable(self):
+        """Tracing back from a tile which can't be reached gives None rather than looping"""
+        grid = pathfinder.MapGrid(numpy.zeros((4, 4), dtype=numpy.bool_))
+        hpa = hpastar.HPAStar(grid, 4)
+        costs = grid.get_costs(0, 0, 4, 4)
+        dist = hpa.relax(costs, [(0, 0)])[0]
+        dist[3,3] = hpastar.INF
+        self.assertEqual(hpa.trace(costs, dist, (3, 3)), None)
+        # Distances which don't match the costs
+        dist = hpa.relax(costs, [(0, 0)])[0]
+        dist[3,3] += 1
+        self.assertEqual(hpa.trace(costs, dist, (3, 3)), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/local/bin/python
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2011 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+import unittest
+
+import numpy
+
+import world
+
+
+class HitboxTest(unittest.TestCase):
+    """Hitboxes generated from the shape of each type of tile"""
+    # Subtiles of a flat tile on the grid of World.HITBOX_CELLS, as in the old hand-written
+    # tables (the top half of the image is empty)
+    flat = [[0,0,0,4,4,0,0,0],
+            [0,0,8,4,4,7,0,0],
+            [0,8,8,9,9,7,7,0],
+            [1,1,9,9,9,9,3,3],
+            [1,1,9,9,9,9,3,3],
+            [0,5,5,9,9,6,6,0],
+            [0,0,5,2,2,6,0,0],
+            [0,0,0,2,2,0,0,0]]
+
+    def setUp(self):
+        self.world = world.World()
+
+    def test_flat(self):
+        """Every pixel of a flat tile picks the same subtile as the old table at every zoom level"""
+        cells_x, cells_y = world.World.HITBOX_CELLS
+        table = numpy.zeros((cells_y, cells_x), numpy.uint8)
+        table[cells_y - len(self.flat):] = self.flat
+        for size in world.ZOOM_LEVELS:
+            hitbox = self.world.get_hitboxes(size)[world.World.type_index["0000"]]
+            # Cell of the table each pixel is in
+            rows = numpy.arange(size) * cells_y / size
+            columns = numpy.arange(size) * cells_x / size
+            expected = table[rows[:,numpy.newaxis], columns[numpy.newaxis,:]]
+            self.assertTrue((hitbox == expected).all(), size)
+
+    def test_raised(self):
+        """Raising a vertex moves its hitbox up the image with it"""
+        size = world.ZOOM_LEVELS[0]
+        hitboxes = self.world.get_hitboxes(size)
+        flat = hitboxes[world.World.type_index["0000"]]
+        bottom = hitboxes[world.World.type_index["0100"]]
+        self.assertEqual(flat[size - 1, size / 2], 2)
+        self.assertEqual(bottom[size - 1, size / 2], 0)
+        self.assertEqual(bottom[size * 13 / 16, size / 2], 2)
+
+    def test_get_subtile(self):
+        """get_subtile() looks pixels up at the current zoom level"""
+        p = world.World.p
+        self.assertEqual(self.world.get_subtile("0000", p / 2, p * 3 / 4), 9)
+        self.assertEqual(self.world.get_subtile("0000", 0, p * 3 / 4), 1)
+        self.assertEqual(self.world.get_subtile("0000", p / 2, 0), 0)
+        self.assertEqual(self.world.get_subtile("0000", p, 0), None)
+
+
+
+class WatchTest(unittest.TestCase):
+    """Sets of changed tiles handed out by World.watch()"""
+    def setUp(self):
+        self.world = world.World()
+
+    def test_changes(self):
+        """Tiles whose height is set are added to every set being watched"""
+        a = self.world.watch()
+        b = self.world.watch()
+        tgrid = self.world.get_height(2, 3)
+        self.world.set_height(tgrid, 2, 3)
+        self.assertEqual(a, set([(2, 3)]))
+        self.assertEqual(b, set([(2, 3)]))
+
+    def test_forgotten(self):
+        """Sets nothing refers to any more aren't kept by the World"""
+        count = len(world.World.watchers)
+        changed = [self.world.watch() for i in range(10)]
+        self.assertEqual(len(world.World.watchers), count + 10)
+        del changed
+        self.assertEqual(len(world.World.watchers), count)
+
+
+if __name__ == "__main__":
+    unittest.main()
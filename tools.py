@@ -22,60 +22,61 @@
 
 import os, sys
 import pygame
-import random
+import random, math
+import numpy
+import threading, Queue, time
 
 import world
 World = world.World()
+import pathfinder
+import routecache
 
 import copy
 
 import logger
 debug = logger.Log()
 
-# Pre-compute often used multiples
-p = 64
-p2 = p / 2
-p4 = p / 4
-p4x3 = p4 * 3
-p8 = p / 8
-p16 = p / 16
-
-#tile height difference
-ph = 8
-
-class MouseSprite(pygame.sprite.Sprite):
-    """Small invisible sprite to use for mouse/sprite collision testing"""
-    # This sprite never gets drawn, so no need to worry about what it looks like
-    image = None
-    mask = None
-    def __init__(self, (mouseX, mouseY)):
-        pygame.sprite.Sprite.__init__(self)
-        if MouseSprite.image is None:
-            MouseSprite.image = pygame.Surface((1,1))
-            MouseSprite.image.fill((1,1,1))
-            MouseSprite.image.set_colorkey((0,0,0), pygame.RLEACCEL)
-        if MouseSprite.mask is None:
-            MouseSprite.mask = pygame.mask.from_surface(MouseSprite.image)
-        self.mask = MouseSprite.mask
-        self.image = MouseSprite.image
-        self.rect = pygame.Rect(mouseX, mouseY, 1,1)
-    def update(self, (x, y)):
-        self.rect = pygame.Rect(x, y, 1,1)
+# Often used multiples of the full size tile, these are defined in world.py
+# Sizes at the current zoom level are available from World (e.g. World.p)
+from world import p, p2, p4, p4x3, p8, p16, ph
 
+class Overlay(object):
+    """Previews of what a tool will do, drawn over the World by the renderer
+    Records highlighted subtiles and extra paths keyed by tile, the World itself is
+    never changed or copied. Tools keep one overlay and clear and refill it as they go"""
+    def __init__(self):
+        """"""
+        self.subtiles = {}
+        self.paths = {}
+    def clear(self):
+        """Remove everything from the overlay"""
+        self.subtiles.clear()
+        self.paths.clear()
+    def set_subtile(self, x, y, subtile):
+        """Highlight a subtile of a tile"""
+        self.subtiles[(x,y)] = subtile
+    def get_subtile(self, x, y):
+        """Return the highlighted subtile of a tile, or None"""
+        return self.subtiles.get((x,y))
+    def add_paths(self, x, y, paths):
+        """Add paths to be drawn on a tile as well as those in the World"""
+        self.paths.setdefault((x,y), []).extend(paths)
+    def get_paths(self, x, y):
+        """Return the extra paths drawn on a tile"""
+        return self.paths.get((x,y), [])
 
 class Tool(object):
-    """Methods which all tools can access"""
+    """Methods which all tools can access
+    Mouse methods take the position of the cursor and a dict of lists of sprites
+    on screen keyed by tile position, with the ground tile sprite first"""
     def __init__(self):
         """"""
-        self.mouseSprite = False
-
         # The tile found through collision detection
         self.tile = None
         # The subtile of that tile
         self.subtile = None
-        # Setup highlight vars
-        self.highlight_changed = False
-        self.highlight = {}
+        # Previews drawn over the World
+        self.overlay = Overlay()
         # Setup aoe vars
         self.aoe_changed = False
         self.aoe = []
@@ -130,61 +131,64 @@ class Tool(object):
                     tiles.append((x + xx, y + yy))
         return tiles
 
-    # Highlight related access functions
-    def get_highlight(self):
-        """Return the current highlight area for this tool"""
-        return self.highlight
-    def set_highlight(self, value):
-        """Set the current highlight for this tool"""
-        self.highlight = value
-        return True
+    # Overlay related access functions
+    def get_overlay(self):
+        """Return the overlay of previews for this tool"""
+        return self.overlay
 
     def collide_locate(self, mousepos, collideagainst):
-        """Locates the sprite(s) that the mouse position intersects with"""
-        # Draw mouseSprite at cursor position
-        if self.mouseSprite:
-            self.mouseSprite.sprite.update(mousepos)
-        else:
-            self.mouseSprite = pygame.sprite.GroupSingle(MouseSprite(mousepos))
-        # Find sprites that the mouseSprite intersects with
-        collision_list1 = pygame.sprite.spritecollide(self.mouseSprite.sprite, collideagainst, False)
-        if collision_list1:
-            collision_list = pygame.sprite.spritecollide(self.mouseSprite.sprite, 
-                                                         collision_list1, False, 
-                                                         pygame.sprite.collide_mask)
-            if collision_list:
-                collision_list.reverse()
-                for t in collision_list:
-                    if t.exclude == False:
-                        return t
-                return None
-            else:
-                # No collision means nothing to select
-                return None
-        else:
-            return None
+        """Locates the ground tile sprite that the mouse position is over
+        collideagainst is a dict of lists of sprites keyed by tile position"""
+        mousex, mousey = mousepos
+        # Cursor position relative to the whole world rather than the screen
+        wx = mousex + World.dxoff
+        wy = mousey + World.dyoff
+        # A tile's image is drawn at:
+        #   xpos = WorldWidth2 + (y - x) * p2 - p2
+        #   ypos = (x + y) * p4 - height * ph
+        # so which tiles can be under the cursor can be found by inverting this.
+        # In x only the two (three if exactly on a boundary) columns with these
+        # values of y - x can cover the cursor
+        u_max = int(math.floor(float(wx - World.WorldWidth2) / World.p2)) + 1
+        columns = [u for u in range(u_max - 2, u_max + 1)
+                   if World.WorldWidth2 + (u - 1) * World.p2 <= wx < World.WorldWidth2 + (u + 1) * World.p2]
+        # In y tiles can be anywhere from ground level to the highest point of the world,
+        # giving a range of values of x + y to check, front (highest) to back
+        s_max = (wy + World.max_height * World.ph) / World.p4
+        s_min = (wy - World.p) / World.p4
+        for s in range(s_max, s_min - 1, -1):
+            for u in columns:
+                # x and y must be whole numbers
+                if (s - u) % 2 != 0:
+                    continue
+                x = (s - u) / 2
+                y = (s + u) / 2
+                if not collideagainst.has_key((x, y)):
+                    continue
+                tile = collideagainst[(x, y)][0]
+                # Test the pixel under the cursor against the tile's transparent colour
+                offx = mousex - tile.rect[0]
+                offy = mousey - tile.rect[1]
+                if 0 <= offx < World.p and 0 <= offy < World.p:
+                    if tile.image.get_at((offx, offy))[:3] != tile.image.get_colorkey()[:3]:
+                        return tile
+        # No collision means nothing to select
+        return None
     def subtile_position(self, mousepos, tile):
         """Find the sub-tile position of the cursor"""
         x = tile.xWorld
         y = tile.yWorld
         # Find where this tile would've been drawn on the screen, and subtract the mouse's position
         mousex, mousey = mousepos
-        posx = World.WorldWidth2 - (x * (p2)) + (y * (p2)) - p2
-        posy = (x * (p4)) + (y * (p4)) - (World.array[x][y][0] * ph)
+        posx = World.WorldWidth2 - (x * (World.p2)) + (y * (World.p2)) - World.p2
+        posy = (x * (World.p4)) + (y * (World.p4)) - (World.array[x][y][0] * World.ph)
         offx = mousex - (posx - World.dxoff)
         offy = mousey - (posy - World.dyoff)
-        # Then compare these offsets to the table of values for this particular kind of tile
-        # to find which overlay selection sprite should be drawn
-        # Height in 16th incremenets, width in 8th increments
-        offx8 = offx / p8
-        offy16 = offy / p16
-        # Then lookup the mask number based on this, this should be drawn on the screen
-        try:
-            tilesubposition = World.type[tile.type][offy16][offx8]
-            return tilesubposition
-        except IndexError:
-            print "offy16: %s, offx8: %s, coltile: %s" % (offy16, offx8, tile.type)
-            return None
+        # Then look up the subtile at this point in the hitbox for this kind of tile
+        tilesubposition = World.get_subtile(tile.type, offx, offy)
+        if tilesubposition is None:
+            print "offy: %s, offx: %s, coltile: %s" % (offy, offx, tile.type)
+        return tilesubposition
 
 
 class Move(Tool):
@@ -224,6 +228,10 @@ class Pathfinder(Tool):
     """Pathfinder demo tool"""
     xdims = 1
     ydims = 1
+    # Costs of moving across the World's terrain, kept up to date as the terrain changes
+    costs = None
+    # Routes already found, dropped as the terrain they cross changes
+    routes = None
     def __init__(self):
         """"""
         # Init parent
@@ -231,6 +239,8 @@ class Pathfinder(Tool):
         # Start/end state
         self.startpos = None
         self.endpos = None
+        # The search, kept while the start stays the same so moving the target reuses it
+        self.astar = None
 
     def process_key(self, key):
         """Process keystrokes sent to this tool"""
@@ -241,70 +251,84 @@ class Pathfinder(Tool):
 
     def find_highlight(self, x, y, subtile):
         """Find the primary area of effect of the tool, based on tool dimensions
-        Return a list of tiles to modify in [(x,y), modifier] form
-        Used to specify region which will be highlighted"""
-        tiles = {}
-        t = copy.copy(World.array[x][y])
-        if len(t) == 2:
-            t.append([])
-        t.append(subtile)
-        tiles[(x,y)] = t
-        return tiles
+        and highlight it in the overlay"""
+        self.overlay.clear()
+        self.overlay.set_subtile(x, y, subtile)
+
+    def get_costs(self):
+        """Return the costs of moving across the World, updated for any terrain changes"""
+        if Pathfinder.costs == None:
+            Pathfinder.costs = pathfinder.CostGrid()
+        else:
+            Pathfinder.costs.refresh()
+        return Pathfinder.costs
+
+    def get_routes(self):
+        """Return the cache of routes already found"""
+        if Pathfinder.routes == None:
+            Pathfinder.routes = routecache.RouteCache(self.get_costs())
+        return Pathfinder.routes
 
     def mouse_up(self, position, collisionlist):
         """Mouse button UP"""
         if self.startpos:
-            # Selection of ending position
-            # First point has already been selected
+            # Selection of ending position, this fixes the route in place until the next click
             tile = self.collide_locate(position, collisionlist)
             if tile and not tile.exclude:
-                subtile = self.subtile_position(position, tile)
-
-                debug("endpos is now: %s" % self.endpos)
-                # Set which tiles need updating
-                self.aoe = [(tile.xWorld, tile.yWorld)]
-                self.set_aoe_changed(True)
+                self.endpos = (tile.xWorld, tile.yWorld)
+                debug("endpos is now: %s" % str(self.endpos))
                 # Reset the tool
-                self.endpos = None
                 self.startpos = None
-                debug("endpos is now: %s" % self.endpos)
-                self.tile = tile
-                self.subtile = subtile
-            else:
-                # Invalid location clicked on, do nothing
-                pass
+                self.astar = None
         else:
             # Selection of starting position
             tile = self.collide_locate(position, collisionlist)
             if tile and not tile.exclude:
                 subtile = self.subtile_position(position, tile)
-
-                debug("startpos is now: %s" % self.startpos)
+                self.startpos = (tile.xWorld, tile.yWorld)
+                self.endpos = None
+                # Costs are brought up to date once per search, the search is then reused as the cursor moves
+                self.astar = pathfinder.AStar(costs=self.get_costs())
+                debug("startpos is now: %s" % str(self.startpos))
                 self.tile = tile
                 self.subtile = subtile
+                self.show_route(self.startpos)
             else:
                 # Invalid location clicked on, do nothing
                 pass
 
+    def show_route(self, target):
+        """Highlight the route from the start position to target"""
+        path = self.get_routes().find_path(self.startpos, target, self.astar.find_path,
+                                           Pathfinder.costs.get_model())
+        if path is None:
+            # No route, just highlight the start and the target
+            path = [self.startpos, target]
+        self.overlay.clear()
+        for x, y in path:
+            self.overlay.set_subtile(x, y, 9)
+        # Set which tiles need updating, tiles on the last route are in last_aoe
+        self.aoe = path
+        self.set_aoe_changed(True)
+
     def mouse_move(self, position, collisionlist):
         """Tool updated, current cursor position is newpos"""
         if self.startpos:
-            # First point already selected, find closest endpoint and draw highlight between them
+            # First point already selected, show the route from there to the cursor
             tile = self.collide_locate(position, collisionlist)
             if tile and not tile.exclude:
-                x = tile.xWorld
-                y = tile.yWorld
                 subtile = self.subtile_position(position, tile)
-                # Assign highlight in dict
-                self.set_highlight({(x,y): t})
-                # Set which tiles need updating
-                self.aoe = [(x,y)]
-                self.set_aoe_changed(True)
+                # Only find a new route if the cursor has moved to another tile
+                if tile != self.tile:
+                    self.show_route((tile.xWorld, tile.yWorld))
                 self.tile = tile
                 self.subtile = subtile
             else:
-                # Invalid location clicked on, do nothing
+                # Invalid location, leave the last route showing
                 pass
+        elif self.endpos:
+            # Route has been fixed in place, leave it showing until the next click
+            pass
         else:
             # If startpos is None there's no dragging operation ongoing, just update the position of the highlight
             tile = self.collide_locate(position, collisionlist)
@@ -312,7 +336,7 @@ class Pathfinder(Tool):
                 subtile = self.subtile_position(position, tile)
                 # Only update the highlight if the cursor has changed enough to require it
                 if tile != self.tile or subtile != self.subtile:
-                    self.set_highlight(self.find_highlight(tile.xWorld, tile.yWorld, subtile))
+                    self.find_highlight(tile.xWorld, tile.yWorld, subtile)
                     self.set_aoe_changed(True)
                     self.aoe = self.find_rect_aoe(tile.xWorld, tile.yWorld)
                 else:
@@ -320,32 +344,11 @@ class Pathfinder(Tool):
                 self.tile = tile
                 self.subtile = subtile
             else:
-                self.set_highlight({})
+                self.overlay.clear()
                 self.set_aoe_changed(True)
                 self.tile = None
                 self.subtile = None
 
-    def collide_convert(self, subtile, start=False, end=False):
-        """Convert subtile edge locations from collide_detect form to track drawing form"""
-        # 9 equates to the middle of the tile, not doing anything with that for the moment
-        if subtile == 9:
-            return None
-        b = [5,3,1,7,4,2,0,6][subtile-1]
-        # Convert to an endpoint, depends on whether we're drawing single or double track
-        if Track.width == 1:
-            # Single track, return only one endpoint, found by multiplying the side the endpoint is on
-            # by three, then adding one (to offset to the middle of the side)
-            return [b*3+1]
-        else:
-            # Double track, return two endpoints, found by multiplying the side the endpoing is on
-            # by three, then adding 2 to one (to offset correctly). Which one we add 2 to depends on
-            # whether this is the start or end of a segment (since if we did the same on both, the
-            # tracks would produce a crossover)
-            if start:
-                return [b*3,b*3+2]
-            elif end:
-                return [b*3+2,b*3]
-
 class Track(Tool):
     """Track drawing tool"""
     # Variables that persist through instances of this tool
@@ -362,6 +365,7 @@ class Track(Tool):
         # Set start state
         self.startpos = None
         self.endpos = None
+        self.router = None
 
     def process_key(self, key):
         """Process keystrokes sent to this tool"""
@@ -378,57 +382,21 @@ class Track(Tool):
 
     def find_highlight(self, x, y, subtile):
         """Find the primary area of effect of the tool, based on tool dimensions
-        Return a list of tiles to modify in [(x,y), modifier] form
-        Used to specify region which will be highlighted"""
-        tiles = {}
-        t = copy.copy(World.array[x][y])
-        if len(t) == 2:
-            t.append([])
-        t.append(subtile)
-        tiles[(x,y)] = t
-        return tiles
+        and highlight it in the overlay"""
+        self.overlay.clear()
+        self.overlay.set_subtile(x, y, subtile)
 
-    def mouse_up(self, position, collisionlist):
-        """Mouse button UP"""
-        if self.startpos:
-            # First point has already been selected
-            tile = self.collide_locate(position, collisionlist)
-            if tile and not tile.exclude:
-                subtile = self.subtile_position(position, tile)
-                # If user's clicked in the middle of the tile, don't do anything for the moment
-                if self.collide_convert(subtile, end=True):
-                    self.endpos = [(tile.xWorld,tile.yWorld), self.collide_convert(subtile, end=True)]
-                else:
-                    return False
-                debug("endpos is now: %s" % self.endpos)
-                # If we're doing a 2->1 type of track, need to ensure both arrays have same number of items
-                if len(self.startpos[1]) > len(self.endpos[1]):
-                    self.endpos[1].append(self.endpos[1][0])
-                elif len(self.startpos[1]) < len(self.endpos[1]):
-                    self.startpos[1].append(self.startpos[1][0])
-                # Add a path to the World for each set of start/end positions
-                for s, e in zip(self.startpos[1], self.endpos[1]):
-                    World.add_path(tile.xWorld, tile.yWorld, [s,e])
-                # Set which tiles need updating
-                self.aoe = [(tile.xWorld, tile.yWorld)]
-                self.set_aoe_changed(True)
-                # Reset the tool
-                self.endpos = None
-                self.startpos = None
-                debug("endpos is now: %s" % self.endpos)
-                self.tile = tile
-                self.subtile = subtile
-            else:
-                # Invalid location clicked on, do nothing
-                pass
-        else:
-            # First point selection
+    def mouse_down(self, position, collisionlist):
+        """Mouse button DOWN, selects the point to start laying track from"""
+        if not self.startpos:
             tile = self.collide_locate(position, collisionlist)
             if tile and not tile.exclude:
                 subtile = self.subtile_position(position, tile)
                 # If user's clicked in the middle of the tile, don't do anything for the moment
                 if self.collide_convert(subtile, start=True):
                     self.startpos = [(tile.xWorld,tile.yWorld), self.collide_convert(subtile, start=True)]
+                    # Routes to wherever the cursor goes are all found by one search from here
+                    self.router = pathfinder.TrackRouter((tile.xWorld, tile.yWorld, self.collide_point(subtile)))
                 else:
                     return False
                 debug("startpos is now: %s" % self.startpos)
@@ -438,44 +406,83 @@ class Track(Tool):
                 # Invalid location clicked on, do nothing
                 pass
 
+    def mouse_up(self, position, collisionlist):
+        """Mouse button UP, if the cursor has been dragged (or clicked again) to an end point
+        lay track from the start point to there"""
+        if self.startpos:
+            routed = self.find_route(position, collisionlist)
+            if routed is None:
+                # Not over an end point (or it's the start point, e.g. this is the end of the
+                # click which selected it), keep the start point and wait for another click
+                return False
+            # Add the paths to the World for every tile along the route
+            for k, paths in routed.iteritems():
+                for path in paths:
+                    World.add_path(k[0], k[1], path)
+            # Set which tiles need updating, those showing the preview are in last_aoe
+            self.overlay.clear()
+            self.aoe = routed.keys()
+            self.set_aoe_changed(True)
+            # Reset the tool
+            self.endpos = None
+            self.startpos = None
+            self.router = None
+            debug("endpos is now: %s" % self.endpos)
+
+    def find_route(self, position, collisionlist):
+        """Find the track to lay from the start point to the end point under the cursor
+        Returns a dict of lists of paths keyed by tile, or None if there's no track to lay"""
+        tile = self.collide_locate(position, collisionlist)
+        if not tile or tile.exclude:
+            return None
+        subtile = self.subtile_position(position, tile)
+        self.tile = tile
+        self.subtile = subtile
+        # If user's over the middle of the tile, don't do anything for the moment
+        if not self.collide_convert(subtile, end=True):
+            return None
+        x = tile.xWorld
+        y = tile.yWorld
+        point = self.collide_point(subtile)
+        if (x,y) == self.startpos[0]:
+            if point == self.router.start[2]:
+                return None
+            # Start and end in the same tile, join them directly
+            startpos = copy.copy(self.startpos[1])
+            endpos = self.collide_convert(subtile, end=True)
+            # If we're doing a 2->1 type of track, need to ensure both arrays have same number of items
+            if len(startpos) > len(endpos):
+                endpos.append(endpos[0])
+            elif len(startpos) < len(endpos):
+                startpos.append(startpos[0])
+            return {(x,y): [[s,e] for s, e in zip(startpos, endpos)]}
+        route = self.router.route((x, y, point))
+        if route is None:
+            return None
+        debug("route is now: %s" % route)
+        routed = {}
+        for k, a, b in route:
+            # Convert the points the track enters and leaves each tile by into endpoints
+            if Track.width == 1:
+                paths = [[a*3+1, b*3+1]]
+            else:
+                paths = [[a*3, b*3+2], [a*3+2, b*3]]
+            routed.setdefault(k, []).extend(paths)
+        return routed
+
     def mouse_move(self, position, collisionlist):
         """Tool updated, current cursor position is newpos"""
         if self.startpos:
-            # First point already selected, find closest endpoint and draw highlight between them
-            tile = self.collide_locate(position, collisionlist)
-            if tile and not tile.exclude:
-                x = tile.xWorld
-                y = tile.yWorld
-                subtile = self.subtile_position(position, tile)
-                # If user's clicked in the middle of the tile, don't do anything for the moment
-                if self.collide_convert(subtile, end=True):
-                    self.temp_endpos = [(tile.xWorld,tile.yWorld), self.collide_convert(subtile, end=True)]
-                else:
-                    return False
-                debug("(temporary) endpos is now: %s" % self.temp_endpos)
-                # If we're doing a 2->1 type of track, need to ensure both arrays have same number of items
-                self.temp_startpos = copy.copy(self.startpos)
-                if len(self.temp_startpos[1]) > len(self.temp_endpos[1]):
-                    self.temp_endpos[1].append(self.temp_endpos[1][0])
-                elif len(self.temp_startpos[1]) < len(self.temp_endpos[1]):
-                    self.temp_startpos[1].append(self.temp_startpos[1][0])
-                # Copy World for this tile
-                t = copy.deepcopy(World.array[x][y])
-                if len(t) == 2:
-                    t.append([])
-                # Add a path to the World for each set of start/end positions
-                for s, e in zip(self.temp_startpos[1], self.temp_endpos[1]):
-                    t[2].append([s,e])
-                # Assign highlight in dict
-                self.set_highlight({(x,y): t})
-                # Set which tiles need updating
-                self.aoe = [(x,y)]
-                self.set_aoe_changed(True)
-                self.tile = tile
-                self.subtile = subtile
-            else:
-                # Invalid location clicked on, do nothing
-                pass
+            # First point already selected, route track to the cursor and highlight it
+            routed = self.find_route(position, collisionlist)
+            if routed is None:
+                return False
+            self.overlay.clear()
+            for k, paths in routed.iteritems():
+                self.overlay.add_paths(k[0], k[1], paths)
+            # Set which tiles need updating, those showing the last preview are in last_aoe
+            self.aoe = routed.keys()
+            self.set_aoe_changed(True)
         else:
             # If startpos is None there's no dragging operation ongoing, just update the position of the highlight
             tile = self.collide_locate(position, collisionlist)
@@ -483,7 +490,7 @@ class Track(Tool):
                 subtile = self.subtile_position(position, tile)
                 # Only update the highlight if the cursor has changed enough to require it
                 if tile != self.tile or subtile != self.subtile:
-                    self.set_highlight(self.find_highlight(tile.xWorld, tile.yWorld, subtile))
+                    self.find_highlight(tile.xWorld, tile.yWorld, subtile)
                     self.set_aoe_changed(True)
                     self.aoe = self.find_rect_aoe(tile.xWorld, tile.yWorld)
                 else:
@@ -491,17 +498,23 @@ class Track(Tool):
                 self.tile = tile
                 self.subtile = subtile
             else:
-                self.set_highlight({})
+                self.overlay.clear()
                 self.set_aoe_changed(True)
                 self.tile = None
                 self.subtile = None
  
+    def collide_point(self, subtile):
+        """Convert a subtile to the endpoint position (0-7) it's at"""
+        # 9 equates to the middle of the tile, not doing anything with that for the moment
+        if subtile in [None, 0, 9]:
+            return None
+        return [5,3,1,7,4,2,0,6][subtile-1]
+
     def collide_convert(self, subtile, start=False, end=False):
         """Convert subtile edge locations from collide_detect form to track drawing form"""
-        # 9 equates to the middle of the tile, not doing anything with that for the moment
-        if subtile == 9:
+        b = self.collide_point(subtile)
+        if b is None:
             return None
-        b = [5,3,1,7,4,2,0,6][subtile-1]
         # Convert to an endpoint, depends on whether we're drawing single or double track
         if Track.width == 1:
             # Single track, return only one endpoint, found by multiplying the side the endpoint is on
@@ -518,6 +531,178 @@ class Track(Tool):
                 return [b*3+2,b*3]
 
 
+class TerrainEdit(object):
+    """One edit to the terrain, see TerrainEdits"""
+    def __init__(self, function, args):
+        """function(*args) works out the edit, returning a result and a dict
+        of new [height, vertices] keyed by tile"""
+        self.function = function
+        self.args = args
+        self.result = None
+        # Called with this edit once it's been applied to the World
+        self.callback = None
+        self.cancelled = False
+        # Set once the edit has been completely applied (or cancelled)
+        self.finished = threading.Event()
+        # [height, vertices] before the edit, of the tiles it's changed so far
+        self.old = {}
+
+class TerrainEdits(object):
+    """Applies edits to the World's terrain and keeps them so they can be undone
+    Large edits are worked out by a background thread, which passes the results back
+    in chunks. The main loop commits the chunks to the World a few at a time with
+    commit() and redraws them, so the screen fills in as the edit goes and input
+    isn't held up. Only the main thread ever changes the World"""
+    # Number of tiles in each chunk
+    chunk_size = 64
+    # Time the main loop spends committing chunks each frame, in seconds
+    # If None, commit() waits for every pending edit to be completely applied (replays can use this, see DisplayMain.Replay())
+    commit_time = 0.01
+    # Number of edits which can be undone
+    undo_levels = 20
+    def __init__(self):
+        """"""
+        self.jobs = Queue.Queue()
+        self.chunks = Queue.Queue()
+        # Held by read() while an edit reads the World, and by commit_chunk() and revert()
+        # while changing it. Edits are worked out without it, so it's never held for long
+        self.lock = threading.Lock()
+        # Edits submitted which haven't been completely applied yet, in order
+        self.pending = []
+        # Edits which have been applied, most recent last
+        self.done = []
+        # Tiles changed by cancel() or undo() which need redrawing
+        self.reverted = []
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def busy(self):
+        """Return True if any edits are still being worked out or applied"""
+        return len(self.pending) > 0
+
+    def submit(self, function, args):
+        """Queue an edit to be worked out in the background, returns the edit"""
+        edit = TerrainEdit(function, args)
+        self.pending.append(edit)
+        self.jobs.put(edit)
+        return edit
+
+    def work(self):
+        """Background thread, works out each edit and passes it back in chunks"""
+        while True:
+            edit = self.jobs.get()
+            if not edit.cancelled:
+                # Edits before this one have been completely applied, so the World is up to date
+                # The edit reads what it needs from the World with read(), so cancel() and the
+                # main loop aren't held up while it's worked out
+                edit.result, changes = edit.function(*edit.args)
+                items = changes.items()
+                for i in range(0, len(items), self.chunk_size):
+                    if edit.cancelled:
+                        break
+                    self.chunks.put((edit, items[i:i+self.chunk_size]))
+            # Marks the end of this edit's chunks
+            self.chunks.put((edit, None))
+            # The next edit has to start from the World with this one applied
+            edit.finished.wait()
+
+    def read(self, function, *args):
+        """Call function with args while holding the lock and return what it returns, used
+        by edits to read the World without tiles changing part way through"""
+        self.lock.acquire()
+        try:
+            return function(*args)
+        finally:
+            self.lock.release()
+
+    def apply(self, changes):
+        """Apply an edit straight away, changes is a dict of new [height, vertices] keyed by tile"""
+        edit = TerrainEdit(None, None)
+        self.commit_chunk(edit, changes.items())
+        self.finish(edit)
+
+    def commit_chunk(self, edit, chunk):
+        """Change the World to match part of an edit, keeping what was there before"""
+        self.lock.acquire()
+        try:
+            for t, (height, vertices) in chunk:
+                if not edit.old.has_key(t):
+                    tgrid = World.get_height(t)
+                    edit.old[t] = [tgrid.height, list(tgrid.array)]
+                World.set_height(world.TGrid(height, vertices), t)
+        finally:
+            self.lock.release()
+
+    def finish(self, edit):
+        """Record an edit as completely applied"""
+        self.done.append(edit)
+        if len(self.done) > self.undo_levels:
+            self.done.pop(0)
+        edit.finished.set()
+        if edit.callback:
+            edit.callback(edit)
+
+    def commit(self):
+        """Commit chunks of edits from the background thread to the World
+        Called by the main loop every frame, returns the list of tiles which need redrawing"""
+        tiles = self.reverted
+        self.reverted = []
+        if self.commit_time != None:
+            end = time.time() + self.commit_time
+        while self.commit_time == None or time.time() < end:
+            if self.commit_time == None:
+                if not self.pending:
+                    break
+                edit, chunk = self.chunks.get()
+            else:
+                try:
+                    edit, chunk = self.chunks.get_nowait()
+                except Queue.Empty:
+                    break
+            if edit.cancelled:
+                if chunk is None:
+                    edit.finished.set()
+            elif chunk is None:
+                self.pending.remove(edit)
+                self.finish(edit)
+            else:
+                self.commit_chunk(edit, chunk)
+                tiles.extend([t for t, v in chunk])
+        return tiles
+
+    def revert(self, edit):
+        """Put back the tiles an edit has changed"""
+        self.lock.acquire()
+        try:
+            for t, (height, vertices) in edit.old.iteritems():
+                World.set_height(world.TGrid(height, vertices), t)
+        finally:
+            self.lock.release()
+        self.reverted.extend(edit.old.keys())
+        edit.old = {}
+
+    def cancel(self):
+        """Cancel all the edits still being worked out or applied, putting back
+        anything they've changed already. Returns True if there was anything to cancel"""
+        if not self.pending:
+            return False
+        # Most recent first, so tiles changed by several edits end up as they started
+        for edit in reversed(self.pending):
+            edit.cancelled = True
+            self.revert(edit)
+        self.pending = []
+        return True
+
+    def undo(self):
+        """Undo the most recent edit, cancelling any edits still in progress"""
+        if self.cancel():
+            return True
+        if self.done:
+            self.revert(self.done.pop())
+            return True
+        return False
+
 class Terrain(Tool):
     """Terrain modification tool"""
     # Variables that persist through instances of this tool
@@ -525,10 +710,19 @@ class Terrain(Tool):
     xdims = 1
     ydims = 1
     smooth = False
+    # Edits to more than this many tiles * levels are done in the background, soft edits
+    # count as soft_cost times as many because of the softening around them
+    background_size = 400
+    soft_cost = 4
+    # Applies edits to the World, kept between instances so edits still finish
+    # (and can be undone) after switching tools
+    edits = None
     def __init__(self):
         """First time the Terrain tool is used"""
         # Call init method of parent
         super(Terrain, self).__init__()
+        if Terrain.edits == None:
+            Terrain.edits = TerrainEdits()
         # tiles - all the tiles in the primary area of effect (ones which are modified first)
         self.tiles = []
         # Other variables used
@@ -557,9 +751,17 @@ class Terrain(Tool):
         elif keyname == "s":
             Terrain.smooth = not(Terrain.smooth)
             ret = True
+        elif keyname == "c":
+            # Cancel edits still being worked on or applied, the main loop redraws them
+            Terrain.edits.cancel()
+            ret = True
+        elif keyname == "u":
+            # Undo the last edit, the main loop redraws it
+            Terrain.edits.undo()
+            ret = True
         if keyname in ["i","o","k","l"]:
             if self.tile:
-                self.set_highlight(self.find_highlight(self.tile.xWorld, self.tile.yWorld, self.subtile))
+                self.find_highlight(self.tile.xWorld, self.tile.yWorld, self.subtile)
                 self.set_aoe_changed(True)
                 self.aoe = self.find_rect_aoe(self.tile.xWorld, self.tile.yWorld)
             ret = True
@@ -567,29 +769,13 @@ class Terrain(Tool):
 
     def find_highlight(self, x, y, subtile):
         """Find the primary area of effect of the tool, based on tool dimensions
-        Return a list of tiles to modify in [(x,y), modifier] form
-        Used to specify region which will be highlighted"""
-        tiles = {}
+        and highlight it in the overlay"""
+        self.overlay.clear()
         if self.xdims > 1 or self.ydims > 1:
-            for xx in range(self.xdims):
-                for yy in range(self.ydims):
-                    try:
-                        World.array[x+xx][y+yy]
-                    except IndexError:
-                        pass
-                    else:
-                        t = copy.copy(World.array[x+xx][y+yy])
-                        if len(t) == 2:
-                            t.append([])
-                        t.append(9)
-                        tiles[(x+xx,y+yy)] = t
+            for xx, yy in self.find_rect_aoe(x, y):
+                self.overlay.set_subtile(xx, yy, 9)
         else:
-            t = copy.copy(World.array[x][y])
-            if len(t) == 2:
-                t.append([])
-            t.append(subtile)
-            tiles[(x,y)] = t
-        return tiles
+            self.overlay.set_subtile(x, y, subtile)
 
     def mouse_down(self, position, collisionlist):
         """Reset the start position for a new operation"""
@@ -611,7 +797,7 @@ class Terrain(Tool):
                 subtile = self.subtile_position(self.current, tile)
                 # Only update the highlight if the cursor has changed enough to require it
                 if tile != self.tile or subtile != self.subtile:
-                    self.set_highlight(self.find_highlight(tile.xWorld, tile.yWorld, subtile))
+                    self.find_highlight(tile.xWorld, tile.yWorld, subtile)
                     self.set_aoe_changed(True)
                     self.aoe = self.find_rect_aoe(tile.xWorld, tile.yWorld)
                 else:
@@ -619,7 +805,7 @@ class Terrain(Tool):
                 self.tile = tile
                 self.subtile = subtile
             else:
-                self.set_highlight({})
+                self.overlay.clear()
                 self.set_aoe_changed(True)
                 self.tile = None
                 self.subtile = None
@@ -658,7 +844,16 @@ class Terrain(Tool):
                     diff -= 1
                     self.addback -= 1
 
-            if diff != 0:
+            if diff != 0 and self.is_large_edit(self.tiles, diff, Terrain.smooth):
+                # Too big to do between frames, work it out in the background
+                # The World and the screen are updated as the results come in
+                if len(self.tiles) > 1:
+                    edit = Terrain.edits.submit(self.find_modify_tiles, (self.tiles, diff, 9, Terrain.smooth))
+                else:
+                    edit = Terrain.edits.submit(self.find_modify_tiles, (self.tiles, diff, self.subtile, Terrain.smooth))
+                if diff < 0:
+                    edit.callback = self.lowered
+            elif diff != 0:
                 if len(self.tiles) > 1:
                     r = self.modify_tiles(self.tiles, diff, soft=Terrain.smooth)
                 else:
@@ -678,193 +873,192 @@ class Terrain(Tool):
                 self.set_aoe_changed(True)
 
 
+    def is_large_edit(self, tiles, amount, soft):
+        """Return True if an edit should be done in the background
+        Once one edit is being done in the background all the following ones must be too,
+        so they're applied in order"""
+        size = len(tiles) * abs(amount)
+        if soft:
+            size *= Terrain.soft_cost
+        return size >= Terrain.background_size or Terrain.edits.busy()
+
+    def lowered(self, edit):
+        """Called when an edit lowering terrain finishes in the background"""
+        # Same as for edits done straight away, see mouse_move
+        self.addback += edit.result - edit.args[1]
+
     def modify_tiles(self, tiles, amount, subtile=9, soft=False):
         """Raise or lower a region of tiles"""
+        r, changes = self.find_modify_tiles(tiles, amount, subtile, soft)
+        # The area of effect of the tool (list of tiles modified)
+        self.aoe = changes.keys()
+        Terrain.edits.apply(changes)
+        return r
+
+    def copy_tiles(self, tiles):
+        """Returns a dict of copies of the TGrids of the tiles given which are on the map,
+        keyed by tile, TGrid shares its vertex list with the World so these can be changed"""
+        tgrids = {}
+        for t in tiles:
+            tgrid = World.get_height(t)
+            if tgrid:
+                tgrids[t] = world.TGrid(tgrid.height, list(tgrid.array))
+        return tgrids
+
+    def find_modify_tiles(self, tiles, amount, subtile=9, soft=False):
+        """Work out a raise or lower of a region of tiles without changing the World
+        Returns the amount actually raised/lowered and a dict of new [height, vertices]
+        keyed by tile for every tile which is changed"""
         # r measures the total amount of raising/lowering *actually* done
         # This can then be compared with the amount requested to calculate the cursor offset
         r = 0
-        # The area of effect of the tool (list of tiles modified)
-        self.aoe = []
         # This will always be a whole tile raise/lower
         # If subtile is None, this is always a whole tile raise/lower
         # If subtile is something, and there's only one tile in the array then this is a single tile action
         # If subtile is something, and there's more than one tile in the array then this is a multi-tile action, but based
         #   off a vertex rather than a face
-        vertices = []
-        # Lowering terrain, find maximum value to start from
+        # Tiles are kept in buckets by the level they're at (the top of the tile when lowering,
+        # the base of the tile when raising). Each step only the frontier bucket (highest when
+        # lowering, lowest when raising) is modified, and its tiles then join the next bucket
+        # down/up so the frontier is always a single level
+        buckets = {}
+        tgrids = Terrain.edits.read(self.copy_tiles, tiles)
+        for t, tgrid in tgrids.iteritems():
+            if amount < 0:
+                level = tgrid.height + max(tgrid.array)
+            else:
+                level = tgrid.height
+            buckets.setdefault(level, []).append(t)
+        if not buckets:
+            return r, {}
+        # Lowering terrain, start from the maximum value
         if amount < 0:
-            for t in tiles:
-                x = t[0]
-                y = t[1]
-                tgrid = World.get_height(x,y)
-                if tgrid:
-                    vertices.append([tgrid.height + max(tgrid.array), (x, y)])
-                    self.aoe.append((x,y))
-            step = -1
-            for i in range(0, amount, step):
-                maxval = max(vertices, key=lambda x: x[0])[0]
-                if maxval != 0:
-                    rr = 0
-                    for p in vertices:
-                        if p[0] == maxval:
-                            p[0] -= 1
-                            # Whole tile lower
-                            if subtile == 9:
-                                tgrid = World.get_height(p[1])
-                                rr = tgrid.lower_face()
-                                World.set_height(tgrid, p[1])
-                            # Edge lower
-                            elif subtile in [5,6,7,8]:
-                                st1 = subtile - 5
-                                st2 = st1 + 1
-                                tgrid = World.get_height(p[1])
-                                rr = tgrid.lower_edge(st1, st2)
-                                World.set_height(tgrid, p[1])
-                            # Vertex lower
-                            elif subtile in [1,2,3,4]:
-                                tgrid = World.get_height(p[1])
-                                rr = tgrid.lower_vertex(subtile - 1)
-                                World.set_height(tgrid, p[1])
+            level = max(buckets.keys())
+            for i in range(0, amount, -1):
+                if level == 0:
+                    break
+                rr = 0
+                for t in buckets[level]:
+                    tgrid = tgrids[t]
+                    # Whole tile lower
+                    if subtile == 9:
+                        lowered = tgrid.lower_face()
+                    # Edge lower
+                    elif subtile in [5,6,7,8]:
+                        st1 = subtile - 5
+                        st2 = st1 + 1
+                        lowered = tgrid.lower_edge(st1, st2)
+                    # Vertex lower
+                    elif subtile in [1,2,3,4]:
+                        lowered = tgrid.lower_vertex(subtile - 1)
                     # Since we're potentially modifying a large number of individual tiles we only want to know if
                     # *any* of them were lowered for the purposes of calculating the real raise/lower amount
                     # Thus r should only be incremented once per raise/lower level
-                    r += rr
-            if soft:
-                # Soften around the modified tiles
-                self.soften(self.aoe, soften_down=True)
-        # Raising terrain, find minimum value to start from
+                    rr = min(rr, lowered)
+                buckets.setdefault(level - 1, []).extend(buckets.pop(level))
+                level -= 1
+                r += rr
+        # Raising terrain, start from the minimum value
         else:
-            for t in tiles:
-                x = t[0]
-                y = t[1]
-                tgrid = World.get_height(x,y)
-                if tgrid:
-                    vertices.append([tgrid.height, (x, y)])
-                    self.aoe.append((x,y))
-            step = 1
-            for i in range(0, amount, step):
-                minval = min(vertices, key=lambda x: x[0])[0]
-                for p in vertices:
-                    if p[0] == minval:
-                        p[0] += 1
-                        # Whole tile raise
-                        if subtile == 9:
-                            tgrid = World.get_height(p[1])
-                            tgrid.raise_face()
-                            World.set_height(tgrid, p[1])
-                        # Edge raise
-                        elif subtile in [5,6,7,8]:
-                            st1 = subtile - 5
-                            st2 = st1 + 1
-                            tgrid = World.get_height(p[1])
-                            tgrid.raise_edge(st1, st2)
-                            World.set_height(tgrid, p[1])
-                        # Vertex raise
-                        elif subtile in [1,2,3,4]:
-                            tgrid = World.get_height(p[1])
-                            tgrid.raise_vertex(subtile - 1)
-                            World.set_height(tgrid, p[1])
-            if soft:
-                # Soften around the modified tiles
-                self.soften(self.aoe, soften_up=True)
-        return r
+            level = min(buckets.keys())
+            for i in range(0, amount, 1):
+                for t in buckets[level]:
+                    tgrid = tgrids[t]
+                    # Whole tile raise
+                    if subtile == 9:
+                        tgrid.raise_face()
+                    # Edge raise
+                    elif subtile in [5,6,7,8]:
+                        st1 = subtile - 5
+                        st2 = st1 + 1
+                        tgrid.raise_edge(st1, st2)
+                    # Vertex raise
+                    elif subtile in [1,2,3,4]:
+                        tgrid.raise_vertex(subtile - 1)
+                buckets.setdefault(level + 1, []).extend(buckets.pop(level))
+                level += 1
+        changes = {}
+        for t, tgrid in tgrids.iteritems():
+            changes[t] = [tgrid.height, tgrid.array]
+        if soft:
+            # Soften around the modified tiles
+            if amount < 0:
+                changes.update(self.soften(changes, soften_down=True))
+            else:
+                changes.update(self.soften(changes, soften_up=True))
+        return r, changes
 
     def soften(self, tiles, soften_up=False, soften_down=False):
         """Soften the tiles around a given set of tiles, raising them to make a smooth slope
-        Can be set to either raise tiles to the same height or lower them"""
-        # Init stacks
-        to_check = {}
-        checking = {}
-        checked = {}
-        # Add all initial tiles to first stack
-        for t in tiles:
-            to_check[t] = World.get_height(t)
-
-        # Find any neighbours of this tile which have the same vertex height before we raise it
-        # Need to compare 4 corners and 4 edges
-        # Corners:
-        # x+1,y-1 -> 0:2
-        # x+1,y+1 -> 1:3
-        # x-1,y+1 -> 2:0
-        # x-1,y-1 -> 3:1
-        # Edges:
-        # x,y-1 -> 3:2,0:1
-        # x+1,y -> 0:3,1:2
-        # x,y+1 -> 1:0,2:3
-        # x-1,y -> 2:1,3:0
-        c_x = [ 1,       1,        -1,       -1,        0,    1,     0,     -1   ]
-        c_y = [-1,       1,         1,       -1,       -1,    0,     1,      0   ]
-        c_a = [(0,None), (1,None), (2,None), (3,None), (3,0), (0,1), (1,2), (2,3)]
-        c_b = [(2,None), (3,None), (0,None), (1,None), (2,1), (3,2), (0,3), (1,0)]
-
-        while to_check:
-            # Checking should be empty from the end of the last loop
-            checking = to_check
-            # To check should be emptied at this point ready to add values this look
-            to_check = {}
-            for key, value in checking.iteritems():
-                # Find all neighbours which haven't already been added to to_check and which aren't already
-                # Needs to be changed so that it checks if this tile has already been checked (will be speedier)
-                for x, y, a, b in zip(c_x, c_y, c_a, c_b):
-                    x = key[0] + x
-                    y = key[1] + y
-                    # Check if the potential tile has been checked before, if so use the existing object
-                    if checked.has_key((x,y)):
-##                        potential = checked[(x,y)]
-                        potential = None
-                    elif checking.has_key((x,y)):
-##                        potential = checking[(x,y)]
-                        potential = None
-                    elif to_check.has_key((x,y)):
-                        potential = to_check[(x,y)]
-##                        potential = None
-                    # Otherwise create a new tile object for that tile
-                    else:
-                        potential = World.get_height(x, y)
-                    m = 0
-                    # If there is a tile to compare to (bounds check) and the comparison tile is lower
-                    if potential and soften_up:
-                        # Raise vertex to same height as the tile we're comparing against
-                        # Do this twice for edges, only once for corners
-                        for aa, bb in zip(a, b):
-                            while self.compare_vertex_higher(value, potential, aa, bb):
-                                potential.raise_vertex(bb)
-                                m = 1
-                    elif potential and soften_down:
-                        # Lower vertex to same height as the tile we're comparing against
-                        for aa, bb in zip(a, b):
-                            while self.compare_vertex_lower(value, potential, aa, bb):
-                                potential.lower_vertex(bb)
-                                m = 1
-                    elif potential:
-                        checked[(x, y)] = potential
-                    # Since we've modified this vertex, add it to the list to be checked next time around
-                    if m == 1:
-                        to_check[(x, y)] = potential
-                        self.aoe.append((x,y))
-
-            # Add the last iteration's checked values to the checked stack
-            checked.update(checking)
-            # Clear the checking stack
-            checking = {}
-
-        # Finally modify the world to reflect changes made by this tool
-        for k in checked.keys():
-            World.set_height(checked[k], k)
-
-    def compare_vertex_higher(self, tgrid1, tgrid2, v1, v2):
-        """Return True if specified vertex of tgrid1 is higher than specified vertex of tgrid2"""
-        if v1 == None or v2 == None:
-            return False
-        if tgrid1[v1] + tgrid1.height > tgrid2[v2] + tgrid2.height:
-            return True
+        Can be set to either raise tiles to the same height or lower them
+        tiles is a dict of [height, vertices] keyed by tile, which are used in place of
+        those in the World. Returns a dict in the same form of the other tiles changed,
+        the World itself isn't changed"""
+        if not tiles:
+            return {}
+        # Vertices of neighbouring tiles can be no more than one level apart for each step
+        # between them, so softening can't spread further from the tiles than the difference
+        # between their heights and the lowest (or highest) the World can be. Only the tiles
+        # that far around them are read and softened
+        tops = [height + max(vertices) for height, vertices in tiles.itervalues()]
+        bottoms = [height + min(vertices) for height, vertices in tiles.itervalues()]
+        if soften_up:
+            spread = max(tops)
         else:
-            return False
-    def compare_vertex_lower(self, tgrid1, tgrid2, v1, v2):
-        """Return True if specified vertex of tgrid1 is lower than specified vertex of tgrid2"""
-        if v1 == None or v2 == None:
-            return False
-        if tgrid1[v1] + tgrid1.height < tgrid2[v2] + tgrid2.height:
-            return True
+            spread = max(World.max_height - min(bottoms), 0)
+        xs = [x for x, y in tiles]
+        ys = [y for x, y in tiles]
+        x0 = max(min(xs) - spread, 0)
+        y0 = max(min(ys) - spread, 0)
+        x1 = min(max(xs) + spread + 1, World.WorldX)
+        y1 = min(max(ys) + spread + 1, World.WorldY)
+        heights = Terrain.edits.read(World.get_vertex_heights, x0, y0, x1, y1)
+        xsize, ysize = heights.shape[:2]
+        # Tiles softening started from never change, they're what everything else slopes to
+        fixed = numpy.zeros((xsize, ysize), bool)
+        for (x, y), (height, vertices) in tiles.iteritems():
+            heights[x-x0,y-y0] = [height + v for v in vertices]
+            fixed[x-x0,y-y0] = True
+        changed = numpy.zeros((xsize, ysize), bool)
+        # Vertices of neighbouring tiles meet at the points of a (WorldX+1, WorldY+1) grid
+        # Offset into this grid of each vertex, [left, bottom, right, top]
+        g_x = [1, 1, 0, 0]
+        g_y = [0, 1, 1, 0]
+        # Distance between vertices around the tile, a vertex can be no more than this many
+        # levels different from another vertex of the same tile
+        dist = [[0,1,2,1], [1,0,1,2], [2,1,0,1], [1,2,1,0]]
+        if soften_up:
+            combine = numpy.maximum
+            limit = 1
+            empty = -1
         else:
-            return False
+            combine = numpy.minimum
+            limit = -1
+            empty = World.max_height + 3
+        # Each pass spreads the vertex heights of the tiles changed last pass (starting with the
+        # original tiles) to all the tiles meeting them, until no more tiles need changing
+        active = fixed
+        while active.any():
+            # Find the highest (or lowest) vertex of an active tile at each point of the grid
+            grid = numpy.zeros((xsize + 1, ysize + 1), int) + empty
+            for k in range(4):
+                v = numpy.where(active, heights[:,:,k], empty)
+                grid[g_x[k]:g_x[k]+xsize, g_y[k]:g_y[k]+ysize] = combine(grid[g_x[k]:g_x[k]+xsize, g_y[k]:g_y[k]+ysize], v)
+            # Move every vertex to meet those points...
+            new = numpy.empty_like(heights)
+            for k in range(4):
+                new[:,:,k] = combine(heights[:,:,k], grid[g_x[k]:g_x[k]+xsize, g_y[k]:g_y[k]+ysize])
+            # ... then drag the rest of each tile along with it, keeping the tile a valid shape
+            shaped = new.copy()
+            for k in range(4):
+                for j in range(4):
+                    shaped[:,:,k] = combine(shaped[:,:,k], new[:,:,j] - limit * dist[j][k])
+            active = (shaped != heights).any(axis=2) & ~fixed
+            heights[active] = shaped[active]
+            changed |= active
+
+        out = {}
+        for x, y in zip(*changed.nonzero()):
+            base = heights[x,y].min()
+            out[(int(x + x0), int(y + y0))] = [int(base), [int(v - base) for v in heights[x,y]]]
+        return out
@@ -0,0 +1,188 @@
+# coding: UTF-8
+#
+# This file is part of the pyTile project
+#
+# http://entropy.me.uk/pytile
+#
+## Copyright  2008-2009 Timothy Baldock. All Rights Reserved.
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## 3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission from the author.
+##
+## 4. Products derived from this software may not be called "pyTile" nor may "pyTile" appear in their names without specific prior written permission from the author.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+
+
+
+
+import sys
+import math
+import heapq
+
+import world
+World = world.World()
+import pathfinder
+
+import logger
+debug = logger.Log()
+
+
+class TrackGraph(object):
+    """Connectivity of all the track laid in the World
+    Nodes are track endpoints, (x, y, endpoint), each path on a tile joins two of them and
+    endpoints meet the endpoints of neighbouring tiles at tile borders (see World.get_endpoint_pair)
+    Searches follow a path through a tile and then always cross the border at its far end,
+    so routes can't double back at junctions. The graph is updated from the tiles which
+    have had paths added whenever it's used, so it never needs rebuilding"""
+    # Extra cost of a curve, as used when laying track (see pathfinder.TrackRouter)
+    curve_cost = pathfinder.TrackRouter.curve_cost
+    positions = pathfinder.TrackRouter.positions
+
+    def __init__(self):
+        """Build the graph from the paths of every tile in the World"""
+        # For each endpoint, list of (endpoint at the other end of a path on the same tile, cost,
+        # the endpoint on the next tile that meets that one or None at the edge of the World)
+        self.rails = {}
+        # Endpoints on each tile which have paths, so the tile can be rebuilt
+        self.tiles = {}
+        self.changed = World.watch_paths()
+        self.changed.clear()
+        for x in range(World.WorldX):
+            for y in range(World.WorldY):
+                self.update_tile(x, y)
+        debug("Track graph built, %s endpoints on %s tiles" % (len(self.rails), len(self.tiles)))
+
+    def refresh(self):
+        """Update the tiles which have had paths added since the last refresh"""
+        for x, y in self.changed:
+            self.update_tile(x, y)
+        self.changed.clear()
+
+    def update_tile(self, x, y):
+        """Rebuild the paths through one tile"""
+        for e in self.tiles.pop((x,y), []):
+            del self.rails[(x, y, e)]
+        paths = World.get_paths(x, y)
+        if not paths:
+            return
+        for a, b in paths:
+            cost = self.get_cost(a, b)
+            self.rails.setdefault((x, y, a), []).append((b, cost, World.get_endpoint_pair(x, y, b)))
+            self.rails.setdefault((x, y, b), []).append((a, cost, World.get_endpoint_pair(x, y, a)))
+        self.tiles[(x,y)] = set([e for path in paths for e in path])
+
+    def get_cost(self, a, b):
+        """Length of a path between endpoints a and b of a tile"""
+        pa = a / 3
+        pb = b / 3
+        cost = self.distance(self.positions[pa], self.positions[pb])
+        if (pb - pa) % 8 != 4:
+            cost += self.curve_cost
+        return cost
+
+    def distance(self, a, b):
+        """Straight line distance between two positions"""
+        return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+
+    def get_position(self, node):
+        """Position of an endpoint in the World, in tile vertex grid units"""
+        x, y, e = node
+        px, py = self.positions[e / 3]
+        return (x + px, y + py)
+
+    def get_neighbours(self, node):
+        """Endpoints joined to this one by a path, with the cost of each"""
+        self.refresh()
+        return [((node[0], node[1], e), cost) for e, cost, n in self.rails.get(node, [])]
+
+    def find_route(self, start, target):
+        """Find the shortest route along laid track from endpoint start to endpoint target
+        Returns a list of [(x,y), start endpoint, end endpoint] for each path along the route
+        in order (the same form as TrackRouter.route()), or None if they aren't connected"""
+        self.refresh()
+        rails = self.rails
+        if not rails.has_key(start) or not rails.has_key(target):
+            return None
+        if start == target:
+            return []
+        # Nodes searched are endpoints where a train is about to travel through the tile
+        # A train at the start can set off either way, into its tile or into the next one
+        # The target is reached by a train which is at it, on either side of the border
+        other = World.get_endpoint_pair(*start)
+        targets = set([target, World.get_endpoint_pair(*target)])
+        positions = self.positions
+        sqrt = math.sqrt
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        tx, ty = self.get_position(target)
+        g = {start: 0}
+        # For each node, the node before it and the endpoint its path was left by
+        parents = {start: None}
+        # Open list entries are (f, g, node, ends), ends is True for the end of a route
+        open = [(0, 0, start, False)]
+        if rails.has_key(other):
+            g[other] = 0
+            parents[other] = None
+            open.append((0, 0, other, False))
+        closed = set()
+        while open:
+            f, gn, node, ends = heappop(open)
+            if ends:
+                # End of a route is the cheapest thing left, so this is the best route
+                return self.make_route(parents, node[0], node[1])
+            if node in closed or gn != g[node]:
+                continue
+            if node in targets:
+                return self.make_route(parents, node, None)
+            closed.add(node)
+            x, y, e = node
+            for b, cost, next in rails[node]:
+                ng = gn + cost
+                if (x, y, b) in targets:
+                    heappush(open, (ng, ng, (node, b), True))
+                    continue
+                # Track has to carry on over the border
+                if next is None or next in closed or not rails.has_key(next):
+                    continue
+                if not g.has_key(next) or ng < g[next]:
+                    g[next] = ng
+                    parents[next] = (node, b)
+                    px, py = positions[next[2] / 3]
+                    heappush(open, (ng + sqrt((next[0] + px - tx) ** 2 + (next[1] + py - ty) ** 2), ng, next, False))
+        return None
+
+    def make_route(self, parents, node, end):
+        """Follow the chain of parents back from the last node, listing the paths taken
+        end is the endpoint the last path was left by, None if the route ends at node"""
+        route = []
+        if end is not None:
+            route.append([node[:2], node[2], end])
+        while parents[node] is not None:
+            node, b = parents[node]
+            route.append([node[:2], node[2], b])
+        route.reverse()
+        return route
+
+    def get_length(self, route):
+        """Length of a route returned by find_route()"""
+        return sum([self.get_cost(a, b) for k, a, b in route])
+
+
+if __name__ == "__main__":
+    # Route between two endpoints given as x y endpoint x y endpoint
+    graph = TrackGraph()
+    start = tuple([int(a) for a in sys.argv[1:4]])
+    target = tuple([int(a) for a in sys.argv[4:7]])
+    route = graph.find_route(start, target)
+    if route is None:
+        print "No route from %s to %s" % (start, target)
+    else:
+        for r in route:
+            print r
+        print "Length: %s" % graph.get_length(route)
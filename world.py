@@ -23,6 +23,8 @@
 import os, sys
 import pygame
 import random
+import numpy
+import weakref
 
 import logger
 debug = logger.Log()
@@ -38,6 +40,15 @@ p16 = p / 16
 #tile height difference
 ph = 8
 
+# Tile sizes (in pixels) at each zoom level, level 0 is fully zoomed in
+# Each level is half the size of the one before so images can be mipmapped
+ZOOM_LEVELS = [64, 32, 16, 8]
+
+class Changes(set):
+    """Set of changed tiles handed out by watch(), unlike a plain set it can be weakly
+    referenced, so whatever hands it out forgets it once its user has gone"""
+    pass
+
 class TGrid(object):
     """Represents a tile's vertex height and can be used to modify that height"""
     def __init__(self, height, vertices):
@@ -209,6 +220,8 @@ class World(object):
                     # Display variables (need moving to world class?)
     dxoff = None       # Horizontal offset position of displayed area
     dyoff = None       # Vertical offset (from top)
+    zoom = None        # Current zoom level, index into ZOOM_LEVELS
+    max_height = None  # Highest vertex in the world, never decreases so may be an overestimate
     blah = None
 
     # Hitboxes for subtile selection
@@ -225,332 +238,35 @@ class World(object):
 
     type_lookup = [[0,0,0,0],[1,0,0,0],[0,1,0,0],[0,0,1,0],[0,0,0,1],[1,1,0,0],[0,1,1,0],[0,0,1,1],[1,0,0,1],[1,1,1,1]]
 
-    type = {}
-
-    # Flat tile
-    type["0000"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,8,8,9,9,7,7,0],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Left vertex
-    type["1000"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,8,4,4,0,0,0],
-                    [1,1,8,4,4,7,0,0],
-                    [1,1,8,9,9,7,7,0],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,9,3,3],
-                    [0,0,5,9,9,6,6,0],
-                    [0,0,0,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Bottom vertex
-    type["0100"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,8,8,9,9,7,7,0],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,5,2,2,6,3,3],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Right vertex
-    type["0010"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,7,0,0],
-                    [0,0,8,4,4,7,3,3],
-                    [0,8,8,9,9,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,6,6,0],
-                    [0,5,5,9,9,6,0,0],
-                    [0,0,5,2,2,0,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Top vertex
-    type["0001"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,1,8,9,9,7,3,0],
-                    [1,1,8,9,9,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Bottom-Left edge
-    type["1100"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,8,4,4,0,0,0],
-                    [1,1,8,4,4,7,0,0],
-                    [1,1,8,9,9,7,7,0],
-                    [1,1,5,9,9,9,3,3],
-                    [0,5,5,2,2,6,3,3],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Bottom-Right edge
-    type["0110"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,7,0,0],
-                    [0,0,8,4,4,7,3,3],
-                    [0,8,8,9,9,7,3,3],
-                    [1,1,9,9,9,6,3,3],
-                    [1,1,5,2,2,6,6,0],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Top-Right edge
-    type["0011"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,0,8,9,9,7,3,3],
-                    [0,8,8,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,6,6,0],
-                    [0,5,5,9,9,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Top-Left edge
-    type["1001"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [1,1,8,9,9,7,0,0],
-                    [1,1,9,9,9,7,7,0],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,9,3,3],
-                    [0,5,5,9,9,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Right vertex down
-    type["1101"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,8,8,9,9,7,7,0],
-                    [1,1,9,9,9,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,5,9,9,6,3,3],
-                    [0,5,5,2,2,6,3,3],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,0,0,0,0,0],]
-    # Top vertex down
-    type["1110"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,8,8,4,4,7,7,0],
-                    [1,8,8,4,4,7,7,3],
-                    [1,1,8,4,4,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,5,9,9,6,3,3],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,0,0,0,0,0],]
-    # Left vertex down
-    type["0111"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,8,8,9,9,7,7,0],
-                    [1,1,8,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,5,9,9,6,3,3],
-                    [1,1,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,0,0,0,0,0],]
-    # Bottom vertex down
-    type["1011"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,8,8,9,9,7,7,0],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,6,6,0],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Left vertex two-up
-    type["2101"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,8,4,4,0,0,0],
-                    [1,1,8,4,4,7,7,0],
-                    [1,1,8,4,4,7,7,3],
-                    [1,1,8,4,4,7,3,3],
-                    [1,1,5,9,9,9,3,3],
-                    [0,5,5,9,9,6,3,3],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,0,0,0,0,0],]
-    # Bottom vertex two-up
-    type["1210"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,8,8,4,4,7,7,0],
-                    [1,8,8,4,4,7,7,3],
-                    [1,1,8,4,4,7,3,3],
-                    [1,1,5,9,9,6,3,3],
-                    [1,1,5,2,2,6,3,3],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,0,0,0,0,0],]
-    # Right vertex two-up
-    type["0121"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,7,0,0],
-                    [0,8,8,4,4,7,3,3],
-                    [1,8,8,4,4,7,3,3],
-                    [1,1,8,4,4,7,3,3],
-                    [1,1,9,9,9,6,3,3],
-                    [1,1,5,9,9,6,6,0],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,0,0,0,0,0],]
-    # Top vertex two-up
-    type["1012"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,8,8,9,9,7,7,0],
-                    [1,1,8,9,9,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,6,6,0],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Left & Right vertices up
-    type["1010"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [1,1,8,4,4,7,3,3],
-                    [1,1,8,9,9,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [0,5,5,9,9,6,6,0],
-                    [0,0,5,9,9,6,0,0],
-                    [0,0,0,2,2,0,0,0],
-                    [0,0,0,2,2,0,0,0],]
-    # Bottom & Top vertices up
-    type["0101"] = [[0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,0,0,0,0,0],
-                    [0,0,0,4,4,0,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,0,8,4,4,7,0,0],
-                    [0,1,8,9,9,7,3,0],
-                    [1,1,8,9,9,7,3,3],
-                    [1,1,9,9,9,9,3,3],
-                    [1,1,5,2,2,6,3,3],
-                    [0,5,5,2,2,6,6,0],
-                    [0,0,5,2,2,6,0,0],
-                    [0,0,0,2,2,0,0,0],]
-
+    # Hitboxes are generated from the shape of each type of tile, see make_hitboxes()
+    # The tile image is divided into a grid of HITBOX_CELLS (across, down) and each pixel
+    # takes the subtile at the middle of its cell, the same grid as the old hand-written
+    # tables, which flat tiles match exactly
+    HITBOX_CELLS = (8, 16)
+    # A point within HITBOX_EDGE (as a fraction of the way across the tile face) of an
+    # edge selects that edge, a point within HITBOX_VERTEX of both edges meeting at a
+    # vertex selects that vertex. The middles of the cells of a flat tile are 1/8 of the
+    # way across the face apart, these fall between them
+    HITBOX_EDGE = 0.1875
+    HITBOX_VERTEX = 0.3125
+    # Tile type strings (e.g. "1000") in hitbox array order, and the reverse lookup
+    tile_types = None
+    type_index = None
+    # Hitbox arrays of shape (len(tile_types), size, size) keyed by tile size
+    hitboxes = {}
+
+    # Track endpoints, there are 3 endpoints (2 sides and middle of the track) at each of 8
+    # points around a tile, point n has endpoints n*3 to n*3+2. Points go clockwise from the
+    # middle of the top-right edge, even points are the middles of edges and odd points are
+    # vertices (right, bottom, left, top)
+    # For each point, offset to the tile which meets this one there and the point on that tile
+    endpoint_neighbours = [(-1,0,4), (-1,1,5), (0,1,6), (1,1,7), (1,0,0), (1,-1,1), (0,-1,2), (-1,-1,3)]
+
+    # Sets of tiles whose height has changed, one for each user of watch(), keyed by id()
+    # Only weakly held, a set is dropped when the object watching with it is
+    watchers = weakref.WeakValueDictionary()
+    # Sets of tiles which have had paths added, one for each user of watch_paths()
+    path_watchers = weakref.WeakValueDictionary()
 
     array = None
     def __init__(self):
@@ -564,17 +280,141 @@ class World(object):
             World.array = self.MakeArray()
         World.WorldX = len(self.array)
         World.WorldY = len(self.array[0])
-
-        # Width and Height of the world, in pixels
-        World.WorldWidth = (World.WorldX + World.WorldY) * p2
-        World.WorldWidth2 = World.WorldWidth / 2
-        World.WorldHeight = ((World.WorldX + World.WorldY) * p4) + p2
+        if World.tile_types == None:
+            self.make_tile_types()
+        if World.max_height == None:
+            World.max_height = max([t[0] + max(t[1]) for row in World.array for t in row])
+        if World.zoom == None:
+            World.zoom = 0
+        self.update_zoom_dimensions()
+
+    def update_zoom_dimensions(self):
+        """Recalculate pixel dimensions for the current zoom level"""
+        # Often used multiples of the tile size at this zoom level, these
+        # match the module level constants when fully zoomed in
+        World.p = ZOOM_LEVELS[World.zoom]
+        World.p2 = World.p / 2
+        World.p4 = World.p / 4
+        World.p4x3 = World.p4 * 3
+        World.ph = World.p / 8
         # Width and Height of the world, in pixels
-        World.WorldWidth = (World.WorldX + World.WorldY) * p2
+        World.WorldWidth = (World.WorldX + World.WorldY) * World.p2
         World.WorldWidth2 = World.WorldWidth / 2
-        World.WorldHeight = ((World.WorldX + World.WorldY) * p4) + p2
+        World.WorldHeight = ((World.WorldX + World.WorldY) * World.p4) + World.p2
+
+    def make_tile_types(self):
+        """Find every valid tile shape
+        Vertex heights are 0-2 above the tile's height, at least one vertex must
+        be at 0 and neighbouring vertices may differ by no more than 1"""
+        World.tile_types = []
+        World.type_index = {}
+        for n in range(3 ** 4):
+            v = [n / 27, n / 9 % 3, n / 3 % 3, n % 3]
+            if min(v) == 0 and max([abs(v[k] - v[k-1]) for k in range(4)]) <= 1:
+                World.type_index["%s%s%s%s" % tuple(v)] = len(World.tile_types)
+                World.tile_types.append("%s%s%s%s" % tuple(v))
+
+    def get_hitboxes(self, size):
+        """Return the hitbox arrays for a tile size, generating them if needed
+        Indexed by [type_index, y, x] giving the subtile at that pixel of a tile image"""
+        if not World.hitboxes.has_key(size):
+            World.hitboxes[size] = self.make_hitboxes(size)
+        return World.hitboxes[size]
+
+    def make_hitboxes(self, size):
+        """Generate hitbox arrays for every tile type for a given tile size"""
+        hitboxes = numpy.zeros((len(World.tile_types), size, size), numpy.uint8)
+        # Middle of the cell each pixel of the tile image is in
+        cells_x, cells_y = World.HITBOX_CELLS
+        xs = ((numpy.arange(size) * cells_x / size) + 0.5) * size / float(cells_x)
+        ys = ((numpy.arange(size) * cells_y / size) + 0.5) * size / float(cells_y)
+        ys, xs = numpy.meshgrid(ys, xs, indexing="ij")
+        for n, tiletype in enumerate(World.tile_types):
+            # Screen y of each vertex, vertices are raised by 1/8 of the tile size per unit
+            l, b, r, t = [float(v) * size / 8 for v in tiletype]
+            Ly = size * 0.75 - l
+            By = size - b
+            Ry = size * 0.75 - r
+            Ty = size * 0.5 - t
+            # Position on the tile face in (s,t) coordinates, top vertex (0,0), right (1,0),
+            # left (0,1), bottom (1,1). Screen x depends only on s - t, screen y is bilinear
+            # in s and t so for a known s - t it gives a quadratic in t
+            d = 2 * xs / size - 1
+            qa = Ty - Ry - Ly + By
+            qb = Ry + Ly - 2 * Ty + qa * d
+            qc = (Ry - Ty) * d - (ys - Ty)
+            disc = numpy.maximum(qb * qb - 4 * qa * qc, 0)
+            # This form of the root stays finite when the tile face is flat (qa == 0)
+            root = numpy.sqrt(disc) + qb
+            root[root == 0] = numpy.inf
+            tt = -2 * qc / root
+            ss = tt + d
+            # Points on the edges of the face count as inside, some middles of cells are
+            inside = (ss >= -1e-9) & (ss <= 1 + 1e-9) & (tt >= -1e-9) & (tt <= 1 + 1e-9)
+            # Classify, face first, then edges, then vertices on top
+            hitbox = numpy.where(inside, 9, 0).astype(numpy.uint8)
+            edge = World.HITBOX_EDGE
+            hitbox[inside & (ss < edge)] = 8
+            hitbox[inside & (ss > 1 - edge)] = 6
+            hitbox[inside & (tt < edge)] = 7
+            hitbox[inside & (tt > 1 - edge)] = 5
+            corner = inside & (numpy.minimum(ss, 1 - ss) < World.HITBOX_VERTEX) \
+                            & (numpy.minimum(tt, 1 - tt) < World.HITBOX_VERTEX)
+            hitbox[corner & (ss < 0.5) & (tt < 0.5)] = 4
+            hitbox[corner & (ss >= 0.5) & (tt < 0.5)] = 3
+            hitbox[corner & (ss >= 0.5) & (tt >= 0.5)] = 2
+            hitbox[corner & (ss < 0.5) & (tt >= 0.5)] = 1
+            hitboxes[n] = hitbox
+        return hitboxes
+
+    def get_subtile(self, tiletype, offx, offy):
+        """Return the subtile at pixel offset (offx, offy) within the image of a
+        tile of type tiletype at the current zoom level, or None if off the image"""
+        if 0 <= offx < World.p and 0 <= offy < World.p:
+            return int(self.get_hitboxes(World.p)[World.type_index[tiletype], offy, offx])
+        else:
+            return None
 
-    # Tile structure [height, vertexheight[left, bottom, right, top], [path_start, path_end], highlightinfo]
+    def screen_to_subtiles(self, points):
+        """Resolve many screen positions to tiles and subtiles at once
+        Takes a sequence of (x,y) screen positions, returns arrays of tile x, tile y
+        and subtile for each point, x and y are -1 and subtile 0 where there's no tile"""
+        points = numpy.asarray(points, dtype=int).reshape(-1, 2)
+        wx = points[:,0] + World.dxoff
+        wy = points[:,1] + World.dyoff
+        heights = numpy.array([[t[0] for t in row] for row in World.array])
+        types = numpy.array([[World.type_index["%s%s%s%s" % tuple(t[1])] for t in row] for row in World.array])
+        hitboxes = self.get_hitboxes(World.p)
+        tx = numpy.zeros(len(points), int) - 1
+        ty = numpy.zeros(len(points), int) - 1
+        subtiles = numpy.zeros(len(points), numpy.uint8)
+        found = numpy.zeros(len(points), bool)
+        # Same search as the single point picking in tools, for every point at once
+        # Tiles which can cover each point lie on diagonal columns u = y - x ...
+        u_max = numpy.floor_divide(wx - World.WorldWidth2, World.p2) + 1
+        # ... and have x + y no greater than s_max, search from the front backwards
+        s_max = numpy.floor_divide(wy + World.max_height * World.ph, World.p4)
+        for ds in range((World.max_height * World.ph + World.p) / World.p4 + 2):
+            s = s_max - ds
+            for du in [-2, -1, 0]:
+                u = u_max + du
+                x = (s - u) / 2
+                y = (s + u) / 2
+                valid = ~found & ((s - u) % 2 == 0) & (x >= 0) & (y >= 0) & (x < World.WorldX) & (y < World.WorldY)
+                xc = numpy.where(valid, x, 0)
+                yc = numpy.where(valid, y, 0)
+                offx = wx - (World.WorldWidth2 + (yc - xc) * World.p2 - World.p2)
+                offy = wy - ((xc + yc) * World.p4 - heights[xc, yc] * World.ph)
+                valid &= (offx >= 0) & (offx < World.p) & (offy >= 0) & (offy < World.p)
+                sub = hitboxes[types[xc, yc], numpy.clip(offy, 0, World.p - 1), numpy.clip(offx, 0, World.p - 1)]
+                hit = valid & (sub != 0)
+                tx[hit] = x[hit]
+                ty[hit] = y[hit]
+                subtiles[hit] = sub[hit]
+                found |= hit
+        return tx, ty, subtiles
+
+    # Tile structure [height, vertexheight[left, bottom, right, top], [path_start, path_end]]
 
 
     def MakeArray(self):
@@ -615,8 +455,19 @@ class World(object):
         else:
             World.array[x][y][2].append(path)
             debug("(EXISTING) Adding path: %s to location: (%s,%s)" % (path, x, y))
+        for w in World.path_watchers.values():
+            w.add((x,y))
         return True
 
+    def watch_paths(self):
+        """Returns a set which every tile that has a path added from now on is added to
+        The user of the set should clear it once it has dealt with the changes
+        Only a weak reference to the set is kept, so it stops being updated once the
+        user lets go of it"""
+        w = Changes()
+        World.path_watchers[id(w)] = w
+        return w
+
     def get_paths(self, x, y):
         """Return paths at specified tile coordinate"""
         try:
@@ -625,32 +476,45 @@ class World(object):
             return []
         else:
             return World.array[x][y][2]
-    def get_4_neighbour_paths(self, x, y, override={}):
+    def get_4_neighbour_paths(self, x, y, extra={}):
         """Return paths of 4 tiles edge-neighbouring this one
-        If tile off world, or tile has no paths, return empty array for that tile"""
+        If tile off world, or tile has no paths, return empty array for that tile
+        extra is a dict of lists of paths keyed by tile to add to those in the World (e.g. previews)"""
         paths = []
         for xx, yy in zip([x-1,x,x+1,x],[y,y+1,y,y-1]):
-            if override.has_key((xx,yy)):
-                try:
-                    override[(xx,yy)][2]
-                except IndexError:
-                    paths.append([])
-                else:
-                    paths.append(override[(xx,yy)][2])
+            try:
+                World.array[xx][yy]
+            except IndexError:
+                tilepaths = []
             else:
                 try:
-                    World.array[xx][yy]
+                    tilepaths = World.array[xx][yy][2]
                 except IndexError:
-                    paths.append([])
-                else:
-                    try:
-                        World.array[xx][yy][2]
-                    except IndexError:
-                        paths.append([])
-                    else:
-                        paths.append(World.array[xx][yy][2])
+                    tilepaths = []
+            if extra.has_key((xx,yy)):
+                tilepaths = tilepaths + extra[(xx,yy)]
+            paths.append(tilepaths)
         return paths
 
+    def get_endpoint_neighbour(self, x, y, point):
+        """Return the tile which meets this one at one of its 8 endpoint positions and
+        the position on that tile, as (x, y, point), or None if that's off the World"""
+        dx, dy, npoint = World.endpoint_neighbours[point]
+        if 0 <= x + dx < World.WorldX and 0 <= y + dy < World.WorldY:
+            return (x + dx, y + dy, npoint)
+        else:
+            return None
+
+    def get_endpoint_pair(self, x, y, endpoint):
+        """Return the endpoint on the neighbouring tile which is at the same place as this one,
+        as (x, y, endpoint), or None if that's off the World
+        Endpoints around a point are numbered clockwise on both tiles, so they pair up in reverse"""
+        n = self.get_endpoint_neighbour(x, y, endpoint / 3)
+        if n is None:
+            return None
+        nx, ny, npoint = n
+        return (nx, ny, npoint*3 + 2 - endpoint % 3)
+
     def get_4_overlap_paths(self, neighbour_paths):
         """Return paths of tiles to NESW which overlap the tile in question
         Takes a list of 4 sets of paths for the 4 points of the compass"""
@@ -693,12 +557,43 @@ class World(object):
         """Return the offset of the display"""
         return (World.dxoff, World.dyoff)
 
+    def set_zoom(self, zoom, centre=(0,0)):
+        """Change the zoom level, keeping the world position under the
+        screen coordinate centre in the same place on screen"""
+        zoom = max(0, min(zoom, len(ZOOM_LEVELS) - 1))
+        if zoom == World.zoom:
+            return False
+        cx, cy = centre
+        old_p = World.p
+        World.zoom = zoom
+        self.update_zoom_dimensions()
+        # All screen space dimensions scale linearly with the tile size
+        World.dxoff = (World.dxoff + cx) * World.p / old_p - cx
+        World.dyoff = (World.dyoff + cy) * World.p / old_p - cy
+        return True
+
+    def get_zoom(self):
+        """Return the current zoom level"""
+        return World.zoom
+
     def set_height(self, tgrid, x, y=None):
         """Sets the height of a tile"""
         if y is None:
             x, y = x
         World.array[x][y][0] = tgrid.height
         World.array[x][y][1] = tgrid.array
+        World.max_height = max(World.max_height, tgrid.height + max(tgrid.array))
+        for w in World.watchers.values():
+            w.add((x,y))
+
+    def watch(self):
+        """Returns a set which every tile whose height changes from now on is added to
+        The user of the set should clear it once it has dealt with the changes
+        Only a weak reference to the set is kept, so it stops being updated once the
+        user lets go of it"""
+        w = Changes()
+        World.watchers[id(w)] = w
+        return w
 
     def get_height(self, x, y=None):
         """Get height of a tile, return as TGrid object"""
@@ -710,6 +605,16 @@ class World(object):
         else:
             return TGrid(World.array[x][y][0], World.array[x][y][1])
 
+    def get_vertex_heights(self, x0=0, y0=0, x1=None, y1=None):
+        """Return the absolute height of every tile vertex as an array of shape (WorldX, WorldY, 4)
+        Vertices are in the same order as in the world array, [left, bottom, right, top]
+        If x0, y0, x1, y1 are given only tiles from (x0,y0) up to but not including (x1,y1) are returned"""
+        if x1 is None:
+            x1 = World.WorldX
+        if y1 is None:
+            y1 = World.WorldY
+        return numpy.array([[[t[0] + v for v in t[1]] for t in row[y0:y1]] for row in World.array[x0:x1]])
+
     def get_neighbours(self, x, y=None):
         """Return an array of tiles neighbouring the tile specified"""
         if y is None: